@@ -2,11 +2,23 @@ import { NextResponse } from "next/server";
 
 export const dynamic = "force-dynamic";
 
+// Last body seen from the traffic server, revalidated with its ETag so an
+// unchanged snapshot costs a 304 instead of a full response.
+let cached: { etag: string; data: unknown } | null = null;
+
 export async function GET() {
   try {
     const response = await fetch("http://127.0.0.1:5000/traffic", {
       cache: "no-store",
+      headers: cached ? { "If-None-Match": cached.etag } : {},
     });
+    if (response.status === 304 && cached) {
+      return NextResponse.json(cached.data, {
+        headers: {
+          "Cache-Control": "no-store",
+        },
+      });
+    }
     if (!response.ok) {
       return NextResponse.json(
         { error: "traffic server not reachable" },
@@ -14,6 +26,8 @@ export async function GET() {
       );
     }
     const data = await response.json();
+    const etag = response.headers.get("ETag");
+    cached = etag ? { etag, data } : null;
     return NextResponse.json(data, {
       headers: {
         "Cache-Control": "no-store",
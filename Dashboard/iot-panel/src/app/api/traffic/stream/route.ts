@@ -0,0 +1,30 @@
+import { NextResponse } from "next/server";
+
+export const dynamic = "force-dynamic";
+
+// Relays the traffic server's Server-Sent Events to the browser.
+export async function GET(request: Request) {
+  try {
+    const response = await fetch("http://127.0.0.1:5000/traffic/stream", {
+      cache: "no-store",
+      signal: request.signal,
+    });
+    if (!response.ok || !response.body) {
+      return NextResponse.json(
+        { error: "traffic server not reachable" },
+        { status: 502 }
+      );
+    }
+    return new Response(response.body, {
+      headers: {
+        "Content-Type": "text/event-stream",
+        "Cache-Control": "no-store",
+      },
+    });
+  } catch (error) {
+    return NextResponse.json(
+      { error: "traffic server not reachable" },
+      { status: 502 }
+    );
+  }
+}
@@ -80,12 +80,35 @@ export default function TrafficDashboard({ streamUrl }: TrafficDashboardProps) {
       }
     };
 
-    fetchTraffic();
-    const timer = window.setInterval(fetchTraffic, 2000);
+    // Counts are pushed as they change; polling only runs while the
+    // stream is down (EventSource reconnects on its own).
+    let timer: number | undefined;
+    const startPolling = () => {
+      if (timer === undefined) {
+        fetchTraffic();
+        timer = window.setInterval(fetchTraffic, 2000);
+      }
+    };
+    const stopPolling = () => {
+      window.clearInterval(timer);
+      timer = undefined;
+    };
+
+    const events = new EventSource("/api/traffic/stream");
+    events.onopen = stopPolling;
+    events.onmessage = (event) => {
+      if (!mounted) return;
+      setTraffic(JSON.parse(event.data) as TrafficState);
+      setLastUpdated(new Date());
+      setError(null);
+    };
+    events.onerror = startPolling;
+    startPolling();
 
     return () => {
       mounted = false;
-      window.clearInterval(timer);
+      events.close();
+      stopPolling();
     };
   }, []);
 
@@ -1,17 +1,23 @@
 import os
+import queue
+import threading
 import time
-from typing import Generator
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Deque, Dict, Generator, Optional
 
 import cv2
-from flask import Flask, Response
+import numpy as np
+from flask import Flask, Response, jsonify, request
 
+from lane_map import LaneMap
+from motion_gate import MotionGate
 from server import (
     CONF_THRESHOLD,
     IOU_THRESHOLD,
     MODEL_NAME,
-    X_MIDPOINT,
-    Y_MIDPOINT,
     YOLO_TFLite,
+    lane_map,
 )
 
 app = Flask(__name__)
@@ -20,22 +26,43 @@ STREAM_PORT = 5001
 STREAM_BUFFER = 3
 DROP_FRAMES = 0
 FRAME_SKIP = 1
+MOTION_GATE = True
 JPEG_QUALITY = 80
 RESIZE_TO = (960, 540)
 SPEED_MULTIPLIER = 1.25
+SUBSCRIBER_QUEUE = 2
+ENCODE_WORKERS = 2
+# Stream tiers, best first: (scale of the annotated frame, JPEG quality).
+# Chosen per client with /stream.mjpg?tier=<name>.
+TIERS = {
+    "high": (1.0, JPEG_QUALITY),
+    "medium": (0.67, 70),
+    "low": (0.44, 55),
+}
+TIER_NAMES = list(TIERS)
+DEFAULT_TIER = "high"
+# A client that loses DOWNGRADE_DROPS frames within DOWNGRADE_WINDOW seconds
+# is moved one tier down; after UPGRADE_AFTER seconds without a loss it
+# moves back up towards the tier it asked for.
+DOWNGRADE_DROPS = 5
+DOWNGRADE_WINDOW = 5.0
+UPGRADE_AFTER = 30.0
+# Encodes kept for the per-tier timing percentiles, and the window the
+# byte rates are measured over.
+STATS_WINDOW = 300
+RATE_WINDOW = 10.0
 VIDEO_PATH = os.path.abspath(
     os.path.join(os.path.dirname(__file__), "..", "..", "intersection.mp4")
 )
 
 
-def draw_overlay(frame, results):
-    l1 = l2 = l3 = l4 = 0
+def draw_overlay(frame, results, lanes=lane_map):
+    # Boxes are in the coordinates of `frame`, which may be resized; the
+    # lane map scales them back to the resolution it was defined in.
+    counts = lanes.count(results, frame.shape)
 
     for res in results:
         x1, y1, x2, y2 = map(int, res["box"])
-        cx = int((x1 + x2) / 2)
-        cy = int((y1 + y2) / 2)
-
         label = f"{int(res['conf'] * 100)}%"
         cv2.rectangle(frame, (x1, y1), (x2, y2), (0, 230, 140), 2)
         cv2.putText(
@@ -48,20 +75,10 @@ def draw_overlay(frame, results):
             2,
         )
 
-        if cy < Y_MIDPOINT:
-            if cx < X_MIDPOINT:
-                l1 += 1
-            else:
-                l2 += 1
-        else:
-            if cx < X_MIDPOINT:
-                l3 += 1
-            else:
-                l4 += 1
-
+    lanes.draw(frame)
     cv2.putText(
         frame,
-        f"L1:{l1} L2:{l2} L3:{l3} L4:{l4}",
+        " ".join(f"L{n + 1}:{count}" for n, count in enumerate(counts)),
         (24, 36),
         cv2.FONT_HERSHEY_SIMPLEX,
         1,
@@ -71,9 +88,199 @@ def draw_overlay(frame, results):
     return frame
 
 
-def frame_generator() -> Generator[bytes, None, None]:
+def multipart(jpeg: bytes) -> bytes:
+    return (
+        b"--frame\r\n"
+        b"Content-Type: image/jpeg\r\n"
+        + f"Content-Length: {len(jpeg)}\r\n\r\n".encode()
+        + jpeg
+        + b"\r\n"
+    )
+
+
+class Subscriber:
+    def __init__(self, tier: str, adaptive: bool):
+        self.queue: queue.Queue = queue.Queue(maxsize=SUBSCRIBER_QUEUE)
+        self.requested = tier
+        self.tier = tier
+        self.adaptive = adaptive
+        # Only the last DOWNGRADE_DROPS matter; older ones age out even
+        # when adapt() never runs (adaptive=0).
+        self.drops: Deque[float] = deque(maxlen=DOWNGRADE_DROPS)
+        # Last drop or tier change; upgrades wait UPGRADE_AFTER from here.
+        self.settled_at = time.monotonic()
+
+
+class TierStats:
+    def __init__(self):
+        self.encode_s: Deque[float] = deque(maxlen=STATS_WINDOW)
+        self.encoded: Deque[tuple] = deque()  # (time, bytes) per encode
+        self.sent: Deque[tuple] = deque()  # (time, bytes) per frame sent to a client
+        # record_sent() runs on every client's thread.
+        self.lock = threading.Lock()
+        self.frames = 0
+        self.skipped = 0
+        self.downgrades = 0
+        self.upgrades = 0
+
+    def record_encode(self, now: float, seconds: float, size: int) -> None:
+        self.frames += 1
+        self.encode_s.append(seconds)
+        self.add(self.encoded, now, size)
+
+    def record_sent(self, now: float, size: int) -> None:
+        self.add(self.sent, now, size)
+
+    def add(self, samples: Deque[tuple], now: float, size: int) -> None:
+        # Trimmed on every append, so the window stays bounded whether or
+        # not anyone reads /stats.
+        with self.lock:
+            samples.append((now, size))
+            self.trim(samples, now)
+
+    def trim(self, samples: Deque[tuple], now: float) -> None:
+        while samples and now - samples[0][0] > RATE_WINDOW:
+            samples.popleft()
+
+    def rate(self, samples: Deque[tuple], now: float) -> float:
+        with self.lock:
+            self.trim(samples, now)
+            return sum(size for _, size in samples) / RATE_WINDOW
+
+    def snapshot(self) -> dict:
+        now = time.monotonic()
+        encode_ms = np.array(self.encode_s) * 1000
+        return {
+            "frames": self.frames,
+            "skipped": self.skipped,
+            "encode_ms": {
+                "p50": round(float(np.percentile(encode_ms, 50)), 2),
+                "p95": round(float(np.percentile(encode_ms, 95)), 2),
+            } if len(encode_ms) else None,
+            "encoded_bytes_per_s": round(self.rate(self.encoded, now)),
+            "sent_bytes_per_s": round(self.rate(self.sent, now)),
+            "downgrades": self.downgrades,
+            "upgrades": self.upgrades,
+        }
+
+
+class FrameBroadcaster:
+    # The producer hands each annotated frame to encode(); a small thread
+    # pool turns it into one JPEG per tier that has viewers, so encoding
+    # never holds up detection and a frame is encoded once per tier however
+    # many clients watch it. Each tier has at most one encode in flight, so
+    # its frames go out in order; the tiers run in parallel.
+    def __init__(self, workers: int = ENCODE_WORKERS):
+        self.subscribers = set()
+        self.lock = threading.Lock()
+        self.has_subscribers = threading.Event()
+        self.dropped = 0
+        self.gate = None
+        # Model load and warm-up times, set once the producer can serve.
+        self.ready = None
+        self.workers = workers
+        self.pool: Optional[ThreadPoolExecutor] = None
+        self.in_flight = dict.fromkeys(TIERS, False)
+        self.tier_stats: Dict[str, TierStats] = {tier: TierStats() for tier in TIERS}
+
+    def subscribe(self, tier: str = DEFAULT_TIER, adaptive: bool = True) -> Subscriber:
+        subscriber = Subscriber(tier, adaptive)
+        with self.lock:
+            self.subscribers.add(subscriber)
+            self.has_subscribers.set()
+        return subscriber
+
+    def unsubscribe(self, subscriber: Subscriber) -> None:
+        with self.lock:
+            self.subscribers.discard(subscriber)
+            if not self.subscribers:
+                self.has_subscribers.clear()
+
+    def encode(self, seq: int, frame) -> None:
+        # `frame` must not be modified after this call.
+        if self.pool is None:
+            self.pool = ThreadPoolExecutor(self.workers, thread_name_prefix="jpeg")
+        with self.lock:
+            tiers = {subscriber.tier for subscriber in self.subscribers}
+        for tier in tiers:
+            with self.lock:
+                # Still encoding the previous frame for this tier: skip this
+                # one rather than queue up stale frames.
+                if self.in_flight[tier]:
+                    self.tier_stats[tier].skipped += 1
+                    continue
+                self.in_flight[tier] = True
+            self.pool.submit(self.encode_tier, tier, seq, frame)
+
+    def encode_tier(self, tier: str, seq: int, frame) -> None:
+        try:
+            start = time.perf_counter()
+            scale, quality = TIERS[tier]
+            if scale != 1:
+                frame = cv2.resize(frame, None, fx=scale, fy=scale, interpolation=cv2.INTER_LINEAR)
+            ok, buffer = cv2.imencode(".jpg", frame, [int(cv2.IMWRITE_JPEG_QUALITY), quality])
+            if not ok:
+                return
+            chunk = multipart(buffer.tobytes())
+            self.tier_stats[tier].record_encode(time.monotonic(), time.perf_counter() - start, len(chunk))
+            self.publish(tier, chunk)
+        except Exception as e:
+            print(f"Encoding {tier} frame {seq} failed: {e}")
+        finally:
+            with self.lock:
+                self.in_flight[tier] = False
+
+    def publish(self, tier: str, chunk: bytes) -> None:
+        with self.lock:
+            subscribers = [subscriber for subscriber in self.subscribers if subscriber.tier == tier]
+        now = time.monotonic()
+        for subscriber in subscribers:
+            # A slow client loses its oldest frame instead of stalling the
+            # producer for everyone else.
+            while True:
+                try:
+                    subscriber.queue.put_nowait((tier, chunk))
+                    break
+                except queue.Full:
+                    try:
+                        subscriber.queue.get_nowait()
+                        self.dropped += 1
+                        subscriber.drops.append(now)
+                        subscriber.settled_at = now
+                    except queue.Empty:
+                        pass
+            self.adapt(subscriber, now)
+
+    def adapt(self, subscriber: Subscriber, now: float) -> None:
+        if not subscriber.adaptive:
+            return
+        while subscriber.drops and now - subscriber.drops[0] > DOWNGRADE_WINDOW:
+            subscriber.drops.popleft()
+        index = TIER_NAMES.index(subscriber.tier)
+        if len(subscriber.drops) >= DOWNGRADE_DROPS and index + 1 < len(TIER_NAMES):
+            step = 1
+            self.tier_stats[subscriber.tier].downgrades += 1
+        elif index > TIER_NAMES.index(subscriber.requested) and now - subscriber.settled_at >= UPGRADE_AFTER:
+            step = -1
+            self.tier_stats[subscriber.tier].upgrades += 1
+        else:
+            return
+        with self.lock:
+            subscriber.tier = TIER_NAMES[index + step]
+        subscriber.drops.clear()
+        subscriber.settled_at = now
+
+
+broadcaster = FrameBroadcaster()
+producer_lock = threading.Lock()
+producer_thread = None
+
+
+def produce_frames(output: FrameBroadcaster) -> None:
     model_path = os.path.join(os.path.dirname(__file__), MODEL_NAME)
+    start = time.perf_counter()
     model = YOLO_TFLite(model_path, conf_thres=CONF_THRESHOLD, iou_thres=IOU_THRESHOLD)
+    loaded = time.perf_counter()
     cap = cv2.VideoCapture(VIDEO_PATH)
     if not cap.isOpened():
         raise RuntimeError(f"Could not open video file: {VIDEO_PATH}")
@@ -82,10 +289,22 @@ def frame_generator() -> Generator[bytes, None, None]:
     if fps <= 0 or fps > 60:
         fps = 30
     frame_interval = 1 / (fps * SPEED_MULTIPLIER)
+    # The lane geometry is in source pixels; give it the real source size so
+    # counts stay right when frames are resized before detection.
+    source_size = (int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)), int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+    lanes = LaneMap(lane_map.lanes, source_size, lane_map.step)
+    width, height = RESIZE_TO or source_size
+    warmup = model.warmup((height, width, 3))
+    output.ready = {"model_load_s": round(loaded - start, 3), "warmup_s": round(warmup, 3)}
+    print(f"Model ready: loaded in {loaded - start:.2f}s, warm-up {warmup * 1000:.0f} ms")
     last_results = []
     frame_index = 0
+    gate = MotionGate() if MOTION_GATE else None
+    output.gate = gate
 
     while True:
+        output.has_subscribers.wait()
+
         for _ in range(DROP_FRAMES):
             cap.grab()
 
@@ -100,38 +319,93 @@ def frame_generator() -> Generator[bytes, None, None]:
             frame = cv2.resize(frame, RESIZE_TO)
 
         frame_index += 1
-        if FRAME_SKIP > 0 and frame_index % (FRAME_SKIP + 1) != 0:
-            results = last_results
-        else:
-            results = model.detect(frame)
-            last_results = results
+        if gate is not None:
+            if gate.should_infer(frame):
+                detect_start = time.monotonic()
+                last_results = model.detect(frame)
+                gate.record(time.monotonic() - detect_start)
+        elif FRAME_SKIP == 0 or frame_index % (FRAME_SKIP + 1) == 0:
+            last_results = model.detect(frame)
+        results = last_results
 
-        annotated = draw_overlay(frame, results)
-        ok, buffer = cv2.imencode(
-            ".jpg", annotated, [int(cv2.IMWRITE_JPEG_QUALITY), JPEG_QUALITY]
-        )
-        if not ok:
-            continue
+        # Encoding runs on the broadcaster's pool; the frame is fresh from
+        # the decoder each loop, so it is not touched again here.
+        output.encode(frame_index, draw_overlay(frame, results, lanes))
 
         processing_time = time.time() - loop_start
         sleep_time = frame_interval - processing_time
         if sleep_time > 0:
             time.sleep(sleep_time)
 
-        frame_bytes = buffer.tobytes()
-        yield (
-            b"--frame\r\n"
-            b"Content-Type: image/jpeg\r\n"
-            + f"Content-Length: {len(frame_bytes)}\r\n\r\n".encode()
-            + frame_bytes
-            + b"\r\n"
-        )
+
+def ensure_producer() -> None:
+    global producer_thread
+    with producer_lock:
+        if producer_thread is None or not producer_thread.is_alive():
+            producer_thread = threading.Thread(
+                target=produce_frames, args=(broadcaster,), daemon=True
+            )
+            producer_thread.start()
+
+
+def frame_generator(tier: str = DEFAULT_TIER, adaptive: bool = True) -> Generator[bytes, None, None]:
+    ensure_producer()
+    subscriber = broadcaster.subscribe(tier, adaptive)
+    try:
+        while True:
+            try:
+                tier, chunk = subscriber.queue.get(timeout=1)
+                broadcaster.tier_stats[tier].record_sent(time.monotonic(), len(chunk))
+                yield chunk
+            except queue.Empty:
+                if not producer_thread.is_alive():
+                    break
+    finally:
+        broadcaster.unsubscribe(subscriber)
+
+
+@app.route("/stats")
+def stats():
+    gate_stats = broadcaster.gate.stats() if broadcaster.gate is not None else None
+    with broadcaster.lock:
+        viewers = len(broadcaster.subscribers)
+        tiers = [subscriber.tier for subscriber in broadcaster.subscribers]
+    tier_stats = {
+        tier: dict(stats.snapshot(), viewers=tiers.count(tier))
+        for tier, stats in broadcaster.tier_stats.items()
+    }
+    return jsonify(
+        {
+            "viewers": viewers,
+            "dropped_frames": broadcaster.dropped,
+            "motion_gate": gate_stats,
+            "tiers": tier_stats,
+        }
+    )
+
+
+@app.route("/ready")
+def ready():
+    if broadcaster.ready is None:
+        return jsonify({"ready": False}), 503
+    return jsonify(dict(broadcaster.ready, ready=True))
 
 
 @app.route("/stream.mjpg")
 def stream():
-    return Response(frame_generator(), mimetype="multipart/x-mixed-replace; boundary=frame")
+    # ?tier=high|medium|low picks the starting tier; ?adaptive=0 keeps the
+    # client on it even when it falls behind.
+    tier = request.args.get("tier", DEFAULT_TIER)
+    if tier not in TIERS:
+        return jsonify({"error": f"unknown tier '{tier}'", "tiers": TIER_NAMES}), 400
+    adaptive = request.args.get("adaptive", "1") != "0"
+    return Response(
+        frame_generator(tier, adaptive), mimetype="multipart/x-mixed-replace; boundary=frame"
+    )
 
 
 if __name__ == "__main__":
+    # Load and warm the model now rather than when the first viewer connects;
+    # the producer then waits for subscribers.
+    ensure_producer()
     app.run(host="0.0.0.0", port=STREAM_PORT, debug=False, use_reloader=False)
@@ -0,0 +1,307 @@
+import argparse
+import hashlib
+import json
+import os
+import queue
+import threading
+import time
+
+import cv2
+import numpy as np
+
+from detection_cache import cache_key
+from lane_map import LaneMap
+from server import (CONF_THRESHOLD, FRAME_SIZE, IOU_THRESHOLD, MODEL_PATH, SKY_LINE, VIDEO_PATH, X_MIDPOINT,
+                    Y_MIDPOINT, YOLO_TFLite)
+
+# Videos are split into chunks of this many frames, decoded by whichever
+# decoder thread is free.
+CHUNK_FRAMES = 250
+# Finished records are appended to the output file this often.
+FLUSH_EVERY = 500
+PROGRESS_INTERVAL = 5
+# How long a partial batch waits for more frames before it is run anyway.
+BATCH_WAIT = 0.05
+
+
+def record_dtype(signals):
+    # One fixed-width row per frame: 4 + 4 + 3 bytes per lane.
+    return np.dtype([
+        ("frame", np.uint32),
+        ("t", np.float32),
+        ("counts", np.uint16, signals),
+        ("occupancy", np.uint8, signals),  # percent of the lane covered
+    ])
+
+
+def load_counts(path):
+    # Reads a <video>.counts.bin written by this tool as a structured array.
+    with open(path + ".json") as f:
+        meta = json.load(f)
+    return np.fromfile(path, dtype=record_dtype(meta["signals"]))
+
+
+class CountsFile:
+    # Per-frame lane counts of one video, appended in frame order to a raw
+    # file of fixed-width records, with a JSON sidecar holding the key it was
+    # made with. A rerun with the same key resumes after the last whole
+    # record; any other key starts the file over.
+    def __init__(self, path, key, signals, fps):
+        self.path = path
+        self.meta_path = path + ".json"
+        self.dtype = record_dtype(signals)
+        self.meta = {"key": key, "signals": signals, "fps": fps, "frames_total": None}
+        self.done = 0
+        if os.path.exists(self.meta_path) and os.path.exists(path):
+            with open(self.meta_path) as f:
+                meta = json.load(f)
+            if meta.get("key") == key:
+                self.meta = meta
+                self.done = os.path.getsize(path) // self.dtype.itemsize
+            else:
+                print(f"Restarting {path}: made with another model, video or lane setup")
+        if self.done == 0:
+            self.meta["frames_total"] = None
+        self.file = open(path, "r+b" if self.done else "wb")
+        # Drops a record cut short by an interrupted run.
+        self.file.truncate(self.done * self.dtype.itemsize)
+        self.file.seek(0, os.SEEK_END)
+        self.write_meta()
+        self.next_frame = self.done
+        self.pending = {}
+        self.buffer = []
+
+    @property
+    def complete(self):
+        return self.meta["frames_total"] is not None and self.done >= self.meta["frames_total"]
+
+    def write_meta(self):
+        tmp = self.meta_path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.meta, f)
+        os.replace(tmp, self.meta_path)
+
+    def add(self, frame, t, counts, occupancy):
+        # Frames may finish out of order; they are written in order.
+        self.pending[frame] = (frame, t, counts, np.round(np.asarray(occupancy) * 100))
+        while self.next_frame in self.pending:
+            self.buffer.append(self.pending.pop(self.next_frame))
+            self.next_frame += 1
+        if len(self.buffer) >= FLUSH_EVERY:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            self.file.write(np.array(self.buffer, dtype=self.dtype).tobytes())
+            self.file.flush()
+            self.done += len(self.buffer)
+            self.buffer = []
+
+    def finish(self, frames_total):
+        self.meta["frames_total"] = frames_total
+        self.flush()
+        self.write_meta()
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+
+class Video:
+    def __init__(self, index, path, out, frames, fps):
+        self.index = index
+        self.path = path
+        self.out = out
+        self.frames = frames  # from the container; 0 if unknown
+        self.fps = fps
+        self.chunks_left = 0
+        self.end = None  # set once a decoder hits the end of the file
+        self.started = time.perf_counter()
+
+
+def probe(path):
+    cap = cv2.VideoCapture(path)
+    if not cap.isOpened():
+        raise SystemExit(f"Could not open {path}")
+    frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    fps = cap.get(cv2.CAP_PROP_FPS)
+    cap.release()
+    return max(frames, 0), fps if 0 < fps <= 120 else 30
+
+
+def lanes_digest(lanes):
+    return hashlib.sha256(json.dumps([lanes.lanes, lanes.size]).encode()).hexdigest()[:16]
+
+
+def letterbox_rgb(model, image, canvas):
+    # The model's letterbox, as 8-bit RGB; the input LUT is applied when the
+    # frame is copied into the batch.
+    r, new_unpad, dw, dh, top, left = model.letterbox_geometry(image.shape[:2])
+    canvas[:] = 114
+    region = canvas[top:top + new_unpad[1], left:left + new_unpad[0]]
+    if image.shape[1::-1] != new_unpad:
+        cv2.resize(image, new_unpad, dst=region, interpolation=cv2.INTER_LINEAR)
+    else:
+        region[:] = image
+    cv2.cvtColor(canvas, cv2.COLOR_BGR2RGB, dst=canvas)
+    return (r, r), (dw, dh)
+
+
+def decoder(model, tasks, frames, stop):
+    # Decodes whole chunks: ("frame", ...) per frame, then ("chunk", ...)
+    # with how many frames it actually read.
+    while not stop.is_set():
+        try:
+            video, start, end = tasks.get_nowait()
+        except queue.Empty:
+            return
+        cap = cv2.VideoCapture(video.path)
+        read = 0
+        try:
+            if start:
+                cap.set(cv2.CAP_PROP_POS_FRAMES, start)
+            while (end is None or start + read < end) and not stop.is_set():
+                ret, image = cap.read()
+                if not ret:
+                    break
+                canvas = np.empty((model.input_h, model.input_w, 3), dtype=np.uint8)
+                ratio, pad = letterbox_rgb(model, image, canvas)
+                frames.put(("frame", video, start + read, canvas, ratio, pad, image.shape[:2]))
+                read += 1
+        finally:
+            # Always reported, so the main loop never waits on a dead chunk.
+            cap.release()
+            frames.put(("chunk", video, start, read, end))
+
+
+def fill_batch(model, items):
+    # The input view is dropped on return; the interpreter refuses to
+    # invoke() while one is alive.
+    inputs = model.input_tensor()
+    for i, item in enumerate(items):
+        cv2.LUT(item[3], model.input_lut, dst=inputs[i])
+
+
+def run_batch(model, batch, items, lanes):
+    # items: ("frame", video, index, canvas, ratio, pad, shape) tuples.
+    fill_batch(model, items)
+    model.interpreter.invoke()
+    for i, (_, video, index, _, ratio, pad, shape) in enumerate(items):
+        results = model.nms(*model.decode(model.read_output(i), ratio, *pad))
+        video.out.add(index, index / video.fps, lanes.count(results, shape), lanes.occupancy(results, shape))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Count vehicles per lane in recorded videos as fast as possible")
+    parser.add_argument("videos", nargs="*", default=[VIDEO_PATH])
+    parser.add_argument("--out-dir", help="where to write <video>.counts.bin (default: next to each video)")
+    parser.add_argument("--model", default=MODEL_PATH)
+    parser.add_argument("--lanes", help="JSON lane polygons (default: quadrants around X/Y_MIDPOINT)")
+    parser.add_argument("--batch", type=int, default=4, help="frames per interpreter call, if the model allows")
+    parser.add_argument("--decoders", type=int, default=max(1, min(4, (os.cpu_count() or 1) - 1)),
+                        help="decoder threads")
+    parser.add_argument("--threads", type=int, help="interpreter threads (default: autotune)")
+    parser.add_argument("--conf", type=float, default=CONF_THRESHOLD)
+    parser.add_argument("--iou", type=float, default=IOU_THRESHOLD)
+    parser.add_argument("--sky-line", type=float, default=SKY_LINE)
+    args = parser.parse_args()
+
+    lanes = LaneMap.load(args.lanes) if args.lanes else LaneMap.quadrants(X_MIDPOINT, Y_MIDPOINT, FRAME_SIZE)
+    model = YOLO_TFLite(args.model, conf_thres=args.conf, iou_thres=args.iou, num_threads=args.threads,
+                        sky_line=args.sky_line)
+    batch = model.set_batch_size(args.batch)
+    settings = f"lanes={lanes_digest(lanes)}:iou={args.iou:g}:sky={args.sky_line:g}"
+
+    tasks = queue.Queue()
+    videos = []
+    for path in args.videos:
+        frames, fps = probe(path)
+        name = os.path.splitext(os.path.basename(path))[0] + ".counts.bin"
+        out_path = os.path.join(args.out_dir or os.path.dirname(os.path.abspath(path)), name)
+        out = CountsFile(out_path, f"{cache_key(args.model, path, args.conf)}:{settings}", lanes.signals, fps)
+        video = Video(len(videos), path, out, frames, fps)
+        if out.complete:
+            print(f"{path}: already done ({out.done} frames)")
+            out.close()
+            continue
+        # Whole chunks after what is already written; one open-ended chunk
+        # when the container does not say how long the video is.
+        if frames:
+            for start in range(out.done, frames, CHUNK_FRAMES):
+                tasks.put((video, start, min(start + CHUNK_FRAMES, frames)))
+                video.chunks_left += 1
+        tasks.put((video, max(out.done, frames), None))
+        video.chunks_left += 1
+        print(f"{path}: {out.done} of {frames or '?'} frames done -> {out_path}")
+        videos.append(video)
+    if not videos:
+        return
+
+    # Bounded, so decoders stay a few batches ahead and no further.
+    frames = queue.Queue(maxsize=batch * (args.decoders + 2))
+    stop = threading.Event()
+    workers = [threading.Thread(target=decoder, args=(model, tasks, frames, stop), daemon=True)
+               for _ in range(args.decoders)]
+    for worker in workers:
+        worker.start()
+    print(f"{args.decoders} decoders, batch {batch}")
+
+    active = len(videos)
+    processed = 0
+    start = report = time.perf_counter()
+    report_processed = 0
+    items = []
+    try:
+        while active:
+            try:
+                message = frames.get(timeout=BATCH_WAIT if items else None)
+            except queue.Empty:
+                message = None
+            if message is not None and message[0] == "frame":
+                items.append(message)
+            if items and (len(items) == batch or message is None or message[0] == "chunk"):
+                run_batch(model, batch, items, lanes)
+                processed += len(items)
+                items = []
+            if message is not None and message[0] == "chunk":
+                _, video, chunk_start, read, end = message
+                if end is None or chunk_start + read < end:
+                    video.end = chunk_start + read if video.end is None else min(video.end, chunk_start + read)
+                video.chunks_left -= 1
+                if video.chunks_left == 0:
+                    video.out.finish(video.end)
+                    video.out.close()
+                    elapsed = time.perf_counter() - video.started
+                    print(f"{video.path}: {video.end} frames, {video.out.path} ({elapsed:.1f}s)")
+                    active -= 1
+
+            now = time.perf_counter()
+            if now - report >= PROGRESS_INTERVAL:
+                fps = (processed - report_processed) / (now - report)
+                done = sum(v.out.next_frame for v in videos)
+                total = sum(v.end or v.frames for v in videos)
+                left = int((total - done) / fps) if fps and total else None
+                eta = f", ETA {left // 3600}:{left // 60 % 60:02d}:{left % 60:02d}" if left is not None else ""
+                print(f"{done}/{total or '?'} frames ({100 * done / max(total, 1):.1f}%), {fps:.1f} FPS{eta}")
+                report, report_processed = now, processed
+    except KeyboardInterrupt:
+        print("Interrupted; rerun the same command to resume")
+    finally:
+        stop.set()
+        # Drained until every decoder has seen `stop`, so none is left
+        # blocked on a full queue.
+        while any(worker.is_alive() for worker in workers):
+            try:
+                frames.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        for video in videos:
+            if not video.out.file.closed:
+                video.out.close()
+
+    elapsed = time.perf_counter() - start
+    print(f"{processed} frames in {elapsed:.1f}s ({processed / max(elapsed, 1e-9):.1f} FPS)")
+
+
+if __name__ == "__main__":
+    main()
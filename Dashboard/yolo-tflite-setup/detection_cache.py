@@ -0,0 +1,167 @@
+import hashlib
+import os
+
+import cv2
+import numpy as np
+
+CACHE_FORMAT = 1
+# Candidates are recorded down to this confidence, so replays can use any
+# threshold at or above it.
+RECORD_CONF = 0.25
+# Videos are identified by their size plus this many bytes from the start
+# and from the end, so a long recording is keyed in milliseconds.
+SOURCE_SAMPLE_BYTES = 4 << 20
+
+
+def file_digest(path, sample=None):
+    size = os.path.getsize(path)
+    digest = hashlib.sha256(str(size).encode())
+    with open(path, "rb") as f:
+        if sample is None or size <= 2 * sample:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                digest.update(chunk)
+        else:
+            digest.update(f.read(sample))
+            f.seek(-sample, os.SEEK_END)
+            digest.update(f.read(sample))
+    return digest.hexdigest()[:16]
+
+
+def cache_key(model_path, source_path, conf_floor=RECORD_CONF):
+    # model_path None stands for the benchmark stub interpreter.
+    model = "stub" if model_path is None else file_digest(model_path)
+    source = file_digest(source_path, SOURCE_SAMPLE_BYTES)
+    return f"v{CACHE_FORMAT}:model={model}:source={source}:conf={conf_floor:g}"
+
+
+class DetectionCache:
+    # Raw model output per source frame: the decoded candidates (box as
+    # x, y, w, h, confidence, class id) before the sky line and NMS, kept
+    # column-wise in one .npz with per-frame offsets into the candidate
+    # columns. Replays re-apply the confidence threshold, sky line and NMS,
+    # so those can change without running the model again. The file is only
+    # reused when its key (model file, source file and recording threshold)
+    # matches; otherwise it is ignored and overwritten on the next save.
+    def __init__(self, path, key, conf_floor=RECORD_CONF):
+        self.path = path
+        self.key = key
+        self.conf_floor = conf_floor
+        self.frames_total = None
+        self.shape = None
+        self.frame = np.zeros(0, dtype=np.int64)
+        self.t = np.zeros(0)
+        self.offsets = np.zeros(1, dtype=np.int64)
+        self.boxes = np.zeros((0, 4), dtype=np.int32)
+        self.confidences = np.zeros(0, dtype=np.float32)
+        self.class_ids = np.zeros(0, dtype=np.uint16)
+        self.positions = {}
+        self.pending = {}
+        self.dirty = False
+
+    @classmethod
+    def open(cls, path, key, conf_floor=RECORD_CONF):
+        cache = cls(path, key, conf_floor)
+        if not os.path.exists(path):
+            return cache
+        with np.load(path) as data:
+            if str(data["key"]) != key:
+                print(f"Ignoring {path}: recorded with another model, source or threshold")
+                return cache
+            cache.frame = data["frame"]
+            cache.t = data["t"]
+            cache.offsets = data["offsets"]
+            cache.boxes = data["boxes"]
+            cache.confidences = data["confidences"]
+            cache.class_ids = data["class_ids"]
+            frames_total = int(data["frames_total"])
+            cache.frames_total = frames_total if frames_total >= 0 else None
+            cache.shape = tuple(data["shape"]) if len(data["shape"]) else None
+        cache.positions = dict(zip(cache.frame.tolist(), range(len(cache.frame))))
+        return cache
+
+    def __len__(self):
+        return len(self.positions) + sum(1 for frame in self.pending if frame not in self.positions)
+
+    def __contains__(self, frame):
+        return frame in self.pending or frame in self.positions
+
+    @property
+    def complete(self):
+        return self.frames_total is not None and len(self) >= self.frames_total
+
+    def frames(self):
+        return sorted(set(self.positions) | set(self.pending))
+
+    def mark_complete(self, frames_total):
+        # Called once a pass has read the source to its end.
+        if self.frames_total != frames_total:
+            self.frames_total = frames_total
+            self.dirty = True
+
+    def add(self, frame, t, boxes, confidences, class_ids, shape=None):
+        self.pending[frame] = (
+            t,
+            np.asarray(boxes, dtype=np.int32).reshape(-1, 4),
+            np.asarray(confidences, dtype=np.float32),
+            np.asarray(class_ids, dtype=np.uint16),
+        )
+        if shape is not None:
+            self.shape = tuple(shape[:2])
+        self.dirty = True
+
+    def get(self, frame):
+        # (t, boxes, confidences, class_ids) or None if the frame was never
+        # recorded.
+        row = self.pending.get(frame)
+        if row is not None:
+            return row
+        i = self.positions.get(frame)
+        if i is None:
+            return None
+        start, end = self.offsets[i], self.offsets[i + 1]
+        return self.t[i], self.boxes[start:end], self.confidences[start:end], self.class_ids[start:end]
+
+    def results(self, frame, conf_thres, iou_thres, sky_line):
+        # Same result dicts as YOLO_TFLite.detect(), or None if not cached.
+        row = self.get(frame)
+        if row is None:
+            return None
+        _, boxes, confidences, class_ids = row
+        keep = (boxes[:, 1] >= sky_line) & (confidences > conf_thres)
+        if not keep.any():
+            return []
+        boxes, confidences, class_ids = boxes[keep].tolist(), confidences[keep].tolist(), class_ids[keep].tolist()
+        indices = cv2.dnn.NMSBoxes(boxes, confidences, conf_thres, iou_thres)
+        results = []
+        for i in np.asarray(indices, dtype=np.int64).flatten():
+            x, y, w, h = boxes[i]
+            results.append({"box": [x, y, x + w, y + h], "conf": confidences[i], "class_id": class_ids[i]})
+        return results
+
+    def save(self):
+        if not self.dirty:
+            return
+        frames = self.frames()
+        rows = [self.get(frame) for frame in frames]
+        counts = np.array([len(row[1]) for row in rows], dtype=np.int64)
+        columns = {
+            "key": np.array(self.key),
+            "frames_total": np.array(-1 if self.frames_total is None else self.frames_total),
+            "shape": np.array(self.shape or (), dtype=np.int64),
+            "frame": np.array(frames, dtype=np.int64),
+            "t": np.array([row[0] for row in rows], dtype=np.float64),
+            "offsets": np.concatenate([[0], np.cumsum(counts)]),
+            "boxes": np.concatenate([self.boxes[:0]] + [row[1] for row in rows]).astype(np.int32),
+            "confidences": np.concatenate([self.confidences[:0]] + [row[2] for row in rows]).astype(np.float32),
+            "class_ids": np.concatenate([self.class_ids[:0]] + [row[3] for row in rows]).astype(np.uint16),
+        }
+        # Written next to the target and swapped in, so an interrupted save
+        # never leaves a truncated cache behind.
+        tmp = self.path + ".tmp.npz"
+        np.savez_compressed(tmp, **columns)
+        os.replace(tmp, self.path)
+        self.frame, self.t, self.offsets = columns["frame"], columns["t"], columns["offsets"]
+        self.boxes, self.confidences, self.class_ids = columns["boxes"], columns["confidences"], columns["class_ids"]
+        self.positions = dict(zip(frames, range(len(frames))))
+        self.pending = {}
+        self.dirty = False
@@ -1,13 +1,28 @@
+import time
+STARTED_AT = time.perf_counter()
+import argparse
+import importlib
 import os
+import sys
 import cv2
 import threading
 import numpy as np
-import tensorflow.lite as tflite 
-from flask import Flask, jsonify
-import time
+from flask import Flask, Response, jsonify
+from detection_cache import RECORD_CONF, DetectionCache, cache_key
+from lane_map import LaneMap
+from motion_gate import MotionGate
 
 app = Flask(__name__)
 
+# The interpreter module is imported on first use. The standalone runtimes
+# (LiteRT, then tflite_runtime) load in a fraction of the time of full
+# TensorFlow, which is only the fallback.
+TFLITE_MODULES = ("ai_edge_litert.interpreter", "tflite_runtime.interpreter", "tensorflow.lite")
+tflite = None
+
+# Seconds from the start of this module to each startup step; served by /ready.
+startup = {"imports": round(time.perf_counter() - STARTED_AT, 3)}
+
 BASE_DIR = os.path.dirname(__file__)
 MODEL_NAME = 'detect_traffic_s_float32.tflite'
 MODEL_PATH = os.path.join(BASE_DIR, MODEL_NAME)
@@ -21,6 +36,8 @@ VIDEO_PATH = os.path.abspath(
 SKY_LINE = 200
 Y_MIDPOINT = 300
 X_MIDPOINT = 1105
+# Resolution the lane geometry is given in.
+FRAME_SIZE = (1920, 1080)
 
 traffic_state = {
     "lane1_count": 0, "lane2_count": 0, 
@@ -28,26 +45,110 @@ traffic_state = {
 }
 
 detection_results = []
-detection_frame = None
 results_lock = threading.Lock()
+latest_frame = None
+inference_count = 0
+
+FPS_REPORT_INTERVAL = 10
+SNAPSHOT_QUALITY = 80
+# Newly inferred frames are written to the detection cache this often.
+CACHE_SAVE_EVERY = 250
+
+WARMUP_RUNS = 5
+
+def load_tflite():
+    global tflite
+    if tflite is None:
+        for name in TFLITE_MODULES:
+            try:
+                tflite = importlib.import_module(name)
+            except ImportError:
+                continue
+            print(f"TFLite runtime: {name}")
+            break
+    return tflite
+
+def mark_startup(step):
+    if step not in startup:
+        startup[step] = round(time.perf_counter() - STARTED_AT, 3)
+
+def thread_candidates():
+    cpus = os.cpu_count() or 1
+    return sorted({n for n in (1, 2, 4, cpus) if n <= cpus})
+
+def autotune_threads(model_path, runs=WARMUP_RUNS):
+    # Build one interpreter per candidate thread count and keep the one with
+    # the fastest warm invoke().
+    best = None
+    for num_threads in thread_candidates():
+        interpreter = tflite.Interpreter(model_path=model_path, num_threads=num_threads)
+        interpreter.allocate_tensors()
+        interpreter.invoke()
+        start = time.perf_counter()
+        for _ in range(runs):
+            interpreter.invoke()
+        elapsed = (time.perf_counter() - start) / runs
+        print(f"  {num_threads} threads: {elapsed * 1000:.1f} ms/invoke")
+        if best is None or elapsed < best[1]:
+            best = (num_threads, elapsed, interpreter)
+    return best[0], best[2]
 
 class YOLO_TFLite:
-    def __init__(self, model_path, conf_thres=0.5, iou_thres=0.45):
+    def __init__(self, model_path, conf_thres=0.5, iou_thres=0.45, zero_copy=True, num_threads=None, sky_line=SKY_LINE,
+                 interpreter=None):
         self.conf_thres = conf_thres
+        self.sky_line = sky_line
         self.iou_thres = iou_thres
-        try:
-            delegate = tflite.load_delegate('libmetal_delegate.dylib')
-            self.interpreter = tflite.Interpreter(model_path=model_path, experimental_delegates=[delegate])
-            print("GPU (Metal) delegate loaded!")
-        except:
-            self.interpreter = tflite.Interpreter(model_path=model_path, num_threads=4)
-            print("Using CPU with 4 threads")
+        self.conf_logit = np.log(conf_thres / (1 - conf_thres))
+        # An interpreter can be passed in (e.g. a stub for benchmarks).
+        self.interpreter = interpreter
+        if self.interpreter is None and load_tflite() is None:
+            raise ImportError("No TFLite runtime installed (ai-edge-litert, tflite-runtime or tensorflow)")
+        if self.interpreter is None and sys.platform == 'darwin':
+            try:
+                delegate = tflite.load_delegate('libmetal_delegate.dylib')
+                self.interpreter = tflite.Interpreter(model_path=model_path, experimental_delegates=[delegate])
+                print("GPU (Metal) delegate loaded!")
+            except (ValueError, OSError):
+                pass
+        if self.interpreter is None:
+            # The default op resolver already routes supported ops (float32,
+            # float16 and int8) through XNNPACK on CPU.
+            if num_threads is None:
+                print("Tuning interpreter threads...")
+                num_threads, self.interpreter = autotune_threads(model_path)
+            else:
+                self.interpreter = tflite.Interpreter(model_path=model_path, num_threads=num_threads)
+            print(f"Using CPU (XNNPACK) with {num_threads} threads")
+        self.num_threads = num_threads
         self.interpreter.allocate_tensors()
         self.input_details = self.interpreter.get_input_details()[0]
         self.output_details = self.interpreter.get_output_details()[0]
         self.input_shape = self.input_details['shape'] 
         self.input_h = self.input_shape[1]
         self.input_w = self.input_shape[2]
+        self.zero_copy = zero_copy
+        self.input_tensor = self.interpreter.tensor(self.input_details['index'])
+        self.output_tensor = self.interpreter.tensor(self.output_details['index'])
+        self.letterbox_cache = {}
+        self.canvas = np.full((self.input_h, self.input_w, 3), 114, dtype=np.uint8)
+        self.rgb_canvas = np.empty_like(self.canvas)
+        self.canvas_shape = None
+
+        # Map every 8-bit pixel value to its model input value once, folding
+        # the /255 scaling and any input quantization into one table.
+        self.input_dtype = self.input_details['dtype']
+        levels = np.arange(256, dtype=np.float32) / 255.0
+        if np.issubdtype(self.input_dtype, np.integer):
+            in_scale, in_zero = self.input_details['quantization']
+            info = np.iinfo(self.input_dtype)
+            levels = np.clip(np.round(levels / in_scale + in_zero), info.min, info.max)
+        self.input_lut = levels.astype(self.input_dtype)
+
+        self.output_quantized = np.issubdtype(self.output_details['dtype'], np.integer)
+        out_scale, out_zero = self.output_details['quantization']
+        self.output_scale = np.float32(out_scale)
+        self.output_zero = np.float32(out_zero)
     
     def sigmoid(self, x):
         return 1 / (1 + np.exp(-np.clip(x, -500, 500)))
@@ -66,108 +167,283 @@ class YOLO_TFLite:
         img = cv2.copyMakeBorder(img, top, bottom, left, right, cv2.BORDER_CONSTANT, value=color)
         return img, (r, r), (dw, dh)
 
-    def detect(self, image):
+    def letterbox_geometry(self, shape):
+        geometry = self.letterbox_cache.get(shape)
+        if geometry is None:
+            r = min(self.input_h / shape[0], self.input_w / shape[1])
+            new_unpad = int(round(shape[1] * r)), int(round(shape[0] * r))
+            dw = (self.input_w - new_unpad[0]) / 2
+            dh = (self.input_h - new_unpad[1]) / 2
+            top, left = int(round(dh - 0.1)), int(round(dw - 0.1))
+            geometry = (r, new_unpad, dw, dh, top, left)
+            self.letterbox_cache[shape] = geometry
+        return geometry
+
+    def preprocess(self, image):
         img_rgb = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
         img_resized, ratio, (pad_w, pad_h) = self.letterbox(img_rgb, (self.input_w, self.input_h))
-        input_data = (img_resized / 255.0).astype(np.float32)
+        input_data = self.input_lut[img_resized]
         input_data = np.expand_dims(input_data, axis=0)
-        self.interpreter.set_tensor(self.input_details['index'], input_data)
+        return input_data, ratio, (pad_w, pad_h)
+
+    def preprocess_into(self, image, out):
+        # Letterbox into the persistent canvas, then write the RGB input
+        # values straight into `out` (normally the interpreter's input view).
+        shape = image.shape[:2]
+        r, new_unpad, dw, dh, top, left = self.letterbox_geometry(shape)
+        if self.canvas_shape != shape:
+            self.canvas[:] = 114
+            self.canvas_shape = shape
+        region = self.canvas[top:top + new_unpad[1], left:left + new_unpad[0]]
+        if shape[::-1] != new_unpad:
+            cv2.resize(image, new_unpad, dst=region, interpolation=cv2.INTER_LINEAR)
+        else:
+            region[:] = image
+        cv2.cvtColor(self.canvas, cv2.COLOR_BGR2RGB, dst=self.rgb_canvas)
+        cv2.LUT(self.rgb_canvas, self.input_lut, dst=out)
+        return (r, r), (dw, dh)
+
+    def detect(self, image, sky_line=None):
+        return self.postprocess(*self.run(image), sky_line)
+
+    def warmup(self, shape=(FRAME_SIZE[1], FRAME_SIZE[0], 3)):
+        # One inference on a blank frame, so the interpreter's one-time setup
+        # and the letterbox geometry are paid before live frames arrive.
+        start = time.perf_counter()
+        self.detect(np.zeros(shape, dtype=np.uint8))
+        return time.perf_counter() - start
+
+    def run(self, image):
+        # Letterbox, invoke, and return the raw output with its geometry.
+        if self.zero_copy:
+            ratio, (pad_w, pad_h) = self.preprocess_into(image, self.input_tensor()[0])
+        else:
+            input_data, ratio, (pad_w, pad_h) = self.preprocess(image)
+            self.interpreter.set_tensor(self.input_details['index'], input_data)
         self.interpreter.invoke()
-        output_data = self.interpreter.get_tensor(self.output_details['index'])[0]
+        return self.read_output(), ratio, pad_w, pad_h
+
+    def set_batch_size(self, batch):
+        # Resizes the input to `batch` frames for offline runs. Returns the
+        # batch size in effect: 1 if the model cannot take batches.
+        index = self.input_details['index']
+        if batch > 1:
+            try:
+                self.interpreter.resize_tensor_input(index, [batch, self.input_h, self.input_w, 3])
+                self.interpreter.allocate_tensors()
+                if self.interpreter.tensor(self.output_details['index'])().shape[0] != batch:
+                    raise ValueError("output is not batched")
+            except (AttributeError, RuntimeError, ValueError) as e:
+                print(f"Model does not take a batch of {batch} ({e}); running one frame at a time")
+                batch = 1
+        if batch == 1 and hasattr(self.interpreter, 'resize_tensor_input'):
+            self.interpreter.resize_tensor_input(index, [1, self.input_h, self.input_w, 3])
+            self.interpreter.allocate_tensors()
+        self.input_tensor = self.interpreter.tensor(index)
+        self.output_tensor = self.interpreter.tensor(self.output_details['index'])
+        return batch
+
+    def read_output(self, index=0):
+        # `index` picks one frame's output from a batch.
+        if self.zero_copy:
+            output_data = self.output_tensor()[index]
+        else:
+            output_data = self.interpreter.get_tensor(self.output_details['index'])[index]
+        if self.output_quantized:
+            output_data = (output_data.astype(np.float32) - self.output_zero) * self.output_scale
         if output_data.shape[0] < output_data.shape[1]: 
             output_data = output_data.transpose()
-        return self.postprocess(output_data, ratio, pad_w, pad_h)
+        return output_data
 
-    def postprocess(self, output_data, ratio, pad_w, pad_h):
-        boxes, confidences, class_ids = [], [], []
+    def postprocess(self, output_data, ratio, pad_w, pad_h, sky_line=None):
+        return self.nms(*self.decode(output_data, ratio, pad_w, pad_h, sky_line))
+
+    def decode(self, output_data, ratio, pad_w, pad_h, sky_line=None):
+        # Candidate boxes as [x, y, w, h] lists with their confidences and
+        # class ids.
+        if sky_line is None:
+            sky_line = self.sky_line
         sample_val = np.max(output_data[:, 0])
         is_normalized = sample_val < 2.0
         norm_w = self.input_w if is_normalized else 1
         norm_h = self.input_h if is_normalized else 1
 
-        for row in output_data:
-            classes_scores = row[4:] 
-            max_raw_score = np.amax(classes_scores)
-            score_prob = self.sigmoid(max_raw_score)
-            if score_prob > self.conf_thres:
-                class_id = np.argmax(classes_scores)
-                x1, y1, x2, y2 = row[0] * norm_w, row[1] * norm_h, row[2] * norm_w, row[3] * norm_h
-                x1 = (x1 - pad_w) / ratio[0]
-                y1 = (y1 - pad_h) / ratio[1]
-                x2 = (x2 - pad_w) / ratio[0]
-                y2 = (y2 - pad_h) / ratio[1]
-                left, top = int(x1), int(y1)
-                width, height = int(x2 - x1), int(y2 - y1)
-                if top < SKY_LINE:
-                    continue
-                boxes.append([left, top, width, height])
-                confidences.append(float(score_prob))
-                class_ids.append(class_id)
+        # Threshold the raw class scores in logit space so the sigmoid only
+        # runs on the handful of rows that survive.
+        max_raw_scores = output_data[:, 4:].max(axis=1)
+        keep = max_raw_scores > self.conf_logit
+        if not keep.any():
+            return [], [], []
+
+        scale = np.array([norm_w, norm_h, norm_w, norm_h], dtype=np.float64)
+        xyxy = output_data[keep, :4] * scale
+        xyxy[:, [0, 2]] = (xyxy[:, [0, 2]] - pad_w) / ratio[0]
+        xyxy[:, [1, 3]] = (xyxy[:, [1, 3]] - pad_h) / ratio[1]
+        boxes = np.empty((len(xyxy), 4), dtype=np.int64)
+        boxes[:, 0] = xyxy[:, 0]
+        boxes[:, 1] = xyxy[:, 1]
+        boxes[:, 2] = xyxy[:, 2] - xyxy[:, 0]
+        boxes[:, 3] = xyxy[:, 3] - xyxy[:, 1]
 
+        below_sky = boxes[:, 1] >= sky_line
+        boxes = boxes[below_sky]
+        confidences = self.sigmoid(max_raw_scores[keep][below_sky])
+        class_ids = output_data[keep, 4:][below_sky].argmax(axis=1)
+        return boxes.tolist(), confidences.tolist(), class_ids.tolist()
+
+    def nms(self, boxes, confidences, class_ids=None):
+        if len(boxes) == 0:
+            return []
         indices = cv2.dnn.NMSBoxes(boxes, confidences, self.conf_thres, self.iou_thres)
         results = []
         if len(indices) > 0:
-            for i in indices.flatten():
+            for i in np.asarray(indices).flatten():
                 x, y, w, h = boxes[i]
-                results.append({"box": [x, y, x + w, y + h], "conf": confidences[i]})
+                class_id = class_ids[i] if class_ids is not None else 0
+                results.append({"box": [x, y, x + w, y + h], "conf": confidences[i], "class_id": class_id})
         return results
 
 inference_frame = None
 inference_lock = threading.Lock()
+motion_gate = None
+detection_cache = None
+cache_lock = threading.Lock()
+lane_map = LaneMap.quadrants(X_MIDPOINT, Y_MIDPOINT, FRAME_SIZE)
+
+def draw_overlay(frame, results):
+    for res in results:
+        x1, y1, x2, y2 = map(int, res['box'])
+        cv2.rectangle(frame, (x1, y1), (x2, y2), (0, 255, 0), 2)
+        cv2.putText(frame, f"{int(res['conf']*100)}%", (x1, y1 - 10), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 255, 0), 2)
+    
+    lane_map.draw(frame)
+    counts = " ".join(f"L{n}:{traffic_state.get(f'lane{n}_count', 0)}" for n in range(1, lane_map.signals + 1))
+    cv2.putText(frame, counts, (50, 90), cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 255, 0), 2)
+    return frame
+
+def detect_cached(model, index, t, frame):
+    # Frames of the video that are already in the cache skip the model.
+    with cache_lock:
+        results = detection_cache.results(index, CONF_THRESHOLD, IOU_THRESHOLD, SKY_LINE)
+    if results is not None or model is None:
+        return results or []
+    candidates = model.decode(*model.run(frame), sky_line=-np.inf)
+    with cache_lock:
+        detection_cache.add(index, t, *candidates, shape=frame.shape)
+        if len(detection_cache.pending) >= CACHE_SAVE_EVERY:
+            detection_cache.save()
+        return detection_cache.results(index, CONF_THRESHOLD, IOU_THRESHOLD, SKY_LINE)
 
 def inference_thread(model):
-    global detection_results, detection_frame, inference_frame
+    global detection_results, inference_frame, inference_count, traffic_state
     
     while True:
         with inference_lock:
-            if inference_frame is None:
-                time.sleep(0.05)
-                continue
-            frame = inference_frame.copy()
+            packet = inference_frame
             inference_frame = None
+        if packet is None:
+            time.sleep(0.01)
+            continue
+        index, t, frame = packet
         
-        results = model.detect(frame)
-        
-        l1, l2, l3, l4 = 0, 0, 0, 0
-        for res in results:
-            x1, y1, x2, y2 = res['box']
-            cx, cy = (x1 + x2) // 2, (y1 + y2) // 2
-            if cy < Y_MIDPOINT: 
-                if cx < X_MIDPOINT: l1 += 1
-                else: l2 += 1
-            else: 
-                if cx < X_MIDPOINT: l3 += 1
-                else: l4 += 1
-        
-        traffic_state.update({"lane1_count": l1, "lane2_count": l2, "lane3_count": l3, "lane4_count": l4})
+        if motion_gate is not None and not motion_gate.should_infer(frame):
+            continue
         
-        for res in results:
-            x1, y1, x2, y2 = map(int, res['box'])
-            cv2.rectangle(frame, (x1, y1), (x2, y2), (0, 255, 0), 2)
-            cv2.putText(frame, f"{int(res['conf']*100)}%", (x1, y1 - 10), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 255, 0), 2)
+        start = time.monotonic()
+        if detection_cache is not None:
+            results = detect_cached(model, index, t, frame)
+        else:
+            results = model.detect(frame)
+        if motion_gate is not None:
+            motion_gate.record(time.monotonic() - start)
         
-        cv2.putText(frame, f"L1:{l1} L2:{l2} L3:{l3} L4:{l4}", (50, 90), cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 255, 0), 2)
+        counts = lane_map.count(results)
+        # A new dict swapped in whole, so readers never see a half-updated one.
+        state = {f"lane{n + 1}_count": count for n, count in enumerate(counts)}
+        state.update({f"lane{n + 1}_occupancy": round(value, 2) for n, value in enumerate(lane_map.occupancy(results))})
+        traffic_state = state
+        if "ready" not in startup:
+            mark_startup("ready")
+            print("Ready: " + ", ".join(f"{step} {t:.2f}s" for step, t in startup.items()))
         
         with results_lock:
             detection_results = results
-            detection_frame = frame
+        inference_count += 1
 
 @app.route('/traffic', methods=['GET'])
 def get_traffic_data():
+    if "ready" not in startup:
+        return jsonify({"status": "starting"}), 503, {"Retry-After": "1"}
     return jsonify(traffic_state)
 
+@app.route('/ready', methods=['GET'])
+def get_ready():
+    # 200 once the model is warm and the first counts are published; the body
+    # has the time each startup step finished, in seconds since launch.
+    ready = "ready" in startup
+    return jsonify(dict(startup, ready=ready)), 200 if ready else 503
+
+@app.route('/inference_stats', methods=['GET'])
+def get_inference_stats():
+    if motion_gate is None:
+        return jsonify({"motion_gate": False})
+    return jsonify(dict(motion_gate.stats(), motion_gate=True))
+
+@app.route('/snapshot.jpg', methods=['GET'])
+def get_snapshot():
+    # The overlay is only drawn when somebody actually asks for a picture.
+    frame = latest_frame
+    if frame is None:
+        return jsonify({"status": "error", "message": "no frame yet"}), 503
+    with results_lock:
+        results = list(detection_results)
+    annotated = draw_overlay(frame.copy(), results)
+    ok, buffer = cv2.imencode(".jpg", annotated, [int(cv2.IMWRITE_JPEG_QUALITY), SNAPSHOT_QUALITY])
+    if not ok:
+        return jsonify({"status": "error"}), 500
+    return Response(buffer.tobytes(), mimetype="image/jpeg")
+
 def run_server():
+    mark_startup("http")
     app.run(host='0.0.0.0', port=5000, debug=False, use_reloader=False, threaded=True)
 
 def main():
-    global inference_frame
+    global inference_frame, latest_frame, motion_gate, detection_cache
+    
+    parser = argparse.ArgumentParser(description="Smart traffic light video server")
+    parser.add_argument("--motion-gate", action="store_true",
+                        help="skip inference while the lanes are static")
+    parser.add_argument("--headless", action="store_true",
+                        help="no display window; frames are only drawn for /snapshot.jpg")
+    parser.add_argument("--unpaced", action="store_true",
+                        help="decode as fast as possible instead of at the video frame rate")
+    parser.add_argument("--max-frames", type=int, default=0,
+                        help="stop after this many frames and print the achieved FPS")
+    parser.add_argument("--cache", metavar="PATH",
+                        help="reuse detections recorded for this video and model, recording missing frames")
+    args = parser.parse_args()
+    
+    if args.motion_gate:
+        motion_gate = MotionGate(split=(X_MIDPOINT, Y_MIDPOINT), top=SKY_LINE)
     
     server_thread = threading.Thread(target=run_server, daemon=True)
     server_thread.start()
     print("Flask Server on port 5000")
 
-    model = YOLO_TFLite(MODEL_PATH, conf_thres=CONF_THRESHOLD)
-    print("Model loaded")
+    if args.cache:
+        detection_cache = DetectionCache.open(args.cache, cache_key(MODEL_PATH, VIDEO_PATH))
+        print(f"Detection cache: {len(detection_cache)} frames")
+    if detection_cache is not None and detection_cache.complete:
+        model = None
+        print("Every frame is cached, model not loaded")
+    else:
+        # With a cache, candidates are recorded down to RECORD_CONF and
+        # thresholded on the way out.
+        model = YOLO_TFLite(MODEL_PATH, conf_thres=RECORD_CONF if detection_cache is not None else CONF_THRESHOLD)
+        mark_startup("model_loaded")
+        print("Model loaded")
+        print(f"Warm-up inference: {model.warmup() * 1000:.0f} ms")
+        mark_startup("warmed_up")
     
     detector = threading.Thread(target=inference_thread, args=(model,), daemon=True)
     detector.start()
@@ -186,37 +462,67 @@ def main():
     print(f"Video FPS: {fps}, Frame delay: {frame_delay}ms")
     
     frame_count = 0
+    position = 0
+    start_time = report_time = time.monotonic()
+    report_frames = report_inferences = 0
+    next_frame_time = start_time
     
     while True:
         ret, frame = cap.read()
         if not ret:
             cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+            if detection_cache is not None:
+                with cache_lock:
+                    detection_cache.mark_complete(position)
+            position = 0
             continue
         
         frame_count += 1
+        position += 1
+        latest_frame = frame
+        
+        now = time.monotonic()
+        if now - report_time >= FPS_REPORT_INTERVAL:
+            elapsed = now - report_time
+            print(f"Capture: {(frame_count - report_frames) / elapsed:.1f} FPS, "
+                  f"inference: {(inference_count - report_inferences) / elapsed:.1f} FPS")
+            report_time, report_frames, report_inferences = now, frame_count, inference_count
         
         with inference_lock:
             if inference_frame is None:
-                inference_frame = frame.copy()
+                inference_frame = (position - 1, (position - 1) / fps, frame)
         
-        with results_lock:
-            results = detection_results.copy()
+        if args.max_frames and frame_count >= args.max_frames:
+            break
         
-        for res in results:
-            x1, y1, x2, y2 = map(int, res['box'])
-            cv2.rectangle(frame, (x1, y1), (x2, y2), (0, 255, 0), 2)
-            cv2.putText(frame, f"{int(res['conf']*100)}%", (x1, y1 - 10), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 255, 0), 2)
+        if args.headless:
+            # Pace on the video clock rather than on a GUI delay.
+            if not args.unpaced:
+                next_frame_time += 1 / fps
+                sleep_time = next_frame_time - time.monotonic()
+                if sleep_time > 0:
+                    time.sleep(sleep_time)
+                else:
+                    next_frame_time = time.monotonic()
+            continue
         
-        l1, l2, l3, l4 = traffic_state["lane1_count"], traffic_state["lane2_count"], traffic_state["lane3_count"], traffic_state["lane4_count"]
-        cv2.putText(frame, f"L1:{l1} L2:{l2} L3:{l3} L4:{l4}", (50, 90), cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 255, 0), 2)
+        with results_lock:
+            results = detection_results.copy()
         
-        cv2.imshow("Traffic Monitor", frame)
+        cv2.imshow("Traffic Monitor", draw_overlay(frame.copy(), results))
         
-        if cv2.waitKey(frame_delay) & 0xFF == ord('q'): 
+        if cv2.waitKey(1 if args.unpaced else frame_delay) & 0xFF == ord('q'): 
             break
     
+    elapsed = time.monotonic() - start_time
+    print(f"Processed {frame_count} frames in {elapsed:.1f}s: "
+          f"capture {frame_count / elapsed:.1f} FPS, inference {inference_count / elapsed:.1f} FPS")
     cap.release()
-    cv2.destroyAllWindows()
+    if detection_cache is not None:
+        with cache_lock:
+            detection_cache.save()
+    if not args.headless:
+        cv2.destroyAllWindows()
 
 if __name__ == "__main__":
     main()
@@ -27,9 +27,18 @@ const unsigned long YELLOW_TIME = 2000;
 const int BLINK_INTERVAL = 500;
 const float SAT_THRESHOLD = 0.15;       // If saturation < 15%, cut the light (Gap Out)
 const float SKIP_THRESHOLD = 0.05;      // If saturation < 5%, skip the lane entirely
+// Act on the server's lane occupancy instead of counts / capacity. The
+// thresholds above are tuned for counts / capacity: re-derive them with
+// controller_sim.py --signal occupancy on a recorded history first
+const bool USE_OCCUPANCY = false;
+// The server sends a keepalive at least every 15 s; a stream silent for
+// twice that is dead even if the socket still looks connected
+const unsigned long STREAM_SILENCE = 30000;
 
 // --- GLOBALS ---
 int counts[4] = {0, 0, 0, 0};
+// Lane occupancy from the server (0..1), or -1 if it did not send one
+float occupancy[4] = {-1, -1, -1, -1};
 
 // State Machine
 enum State { SEARCH_NEXT, MIN_GREEN_PHASE, ADAPTIVE_PHASE, YELLOW_PHASE };
@@ -40,6 +49,18 @@ int searchIndex = 0;                // Used to cycle through lanes
 unsigned long phaseStart = 0;       // Phase start time
 unsigned long lastTrafficCheck = 0; // Last traffic check time
 unsigned long lastStatusPost = 0;   // Last status post time
+unsigned long lastStreamAttempt = 0; // Last attempt to open the traffic stream
+unsigned long lastStreamData = 0;    // Last event or keepalive on the stream
+
+// Counts are pushed over /traffic/stream; polling /traffic is the fallback
+HTTPClient streamHttp;
+WiFiClient* trafficStream = NULL;
+String trafficEtag = "";
+
+// Polls and status posts share one keep-alive connection (--http async keeps
+// it open; the Flask server closes it and it is simply reopened)
+WiFiClient apiClient;
+HTTPClient apiHttp;
 
 void setup() {
     Serial.begin(115200);
@@ -63,6 +84,7 @@ void setup() {
     }
     Serial.println(" Connected!");
     fetch_traffic_data();
+    open_traffic_stream();
     // Start Logic (Assume we just finished Lane 4, so we start search at Lane 1)
     currentLane = 4;
 }
@@ -70,9 +92,15 @@ void setup() {
 void loop() {
     unsigned long now = millis();
 
-    if (now - lastTrafficCheck >= 500) {
-        fetch_traffic_data();
-        lastTrafficCheck = now;
+    if (!read_traffic_stream()) {
+        if (now - lastTrafficCheck >= 500) {
+            fetch_traffic_data();
+            lastTrafficCheck = now;
+        }
+        if (now - lastStreamAttempt >= 5000) {
+            open_traffic_stream();
+            lastStreamAttempt = now;
+        }
     }
 
     if (now - lastStatusPost >= 1000) {
@@ -140,6 +168,8 @@ void loop() {
 
 float getSaturation(int lane) {
     if (lane < 1 || lane > 4) return 0.0;
+    // With USE_OCCUPANCY, the server's occupancy; counts / capacity otherwise
+    if (USE_OCCUPANCY && occupancy[lane-1] >= 0) return occupancy[lane-1];
     float cap = LANE_CAPACITIES[lane-1];
     if (cap == 0) cap = 1; // Prevent div by zero
     float sat = counts[lane-1] / cap;
@@ -191,34 +221,81 @@ void turnLaneOff(int lane) {
 }
 
 // --- NETWORK ---
+void apply_traffic_json(const String& payload) {
+    StaticJsonDocument<768> doc;
+    DeserializationError error = deserializeJson(doc, payload);
+    if (!error) {
+        counts[0] = doc["lane1_count"];
+        counts[1] = doc["lane2_count"];
+        counts[2] = doc["lane3_count"];
+        counts[3] = doc["lane4_count"];
+        occupancy[0] = doc["lane1_occupancy"] | -1.0;
+        occupancy[1] = doc["lane2_occupancy"] | -1.0;
+        occupancy[2] = doc["lane3_occupancy"] | -1.0;
+        occupancy[3] = doc["lane4_occupancy"] | -1.0;
+    }
+}
+
 void fetch_traffic_data() {
-    HTTPClient http;
-    http.setTimeout(200);
+    apiHttp.setReuse(true);
+    apiHttp.setTimeout(200);
     String url = String(server_base) + "/traffic";
-    http.begin(url);
-    int httpCode = http.GET();
+    apiHttp.begin(apiClient, url);
+    const char* headerKeys[] = {"ETag"};
+    apiHttp.collectHeaders(headerKeys, 1);
+    if (trafficEtag.length() > 0) apiHttp.addHeader("If-None-Match", trafficEtag);
+    int httpCode = apiHttp.GET();
 
+    // 304 means the counts have not changed since the last poll
     if (httpCode == 200) {
-        String payload = http.getString();
-        StaticJsonDocument<200> doc;
-        DeserializationError error = deserializeJson(doc, payload);
-        if (!error) {
-            counts[0] = doc["lane1_count"];
-            counts[1] = doc["lane2_count"];
-            counts[2] = doc["lane3_count"];
-            counts[3] = doc["lane4_count"];
-        }
+        trafficEtag = apiHttp.header("ETag");
+        apply_traffic_json(apiHttp.getString());
+    }
+    apiHttp.end();
+}
+
+void open_traffic_stream() {
+    if (WiFi.status() != WL_CONNECTED) return;
+
+    streamHttp.setTimeout(1000);
+    streamHttp.begin(String(server_base) + "/traffic/stream");
+    if (streamHttp.GET() == 200) {
+        trafficStream = streamHttp.getStreamPtr();
+        lastStreamData = millis();
+        Serial.println("Traffic stream open");
+    } else {
+        streamHttp.end();
+    }
+}
+
+// Applies every event waiting on the stream. Returns false if it is down.
+bool read_traffic_stream() {
+    if (trafficStream == NULL) return false;
+    bool silent = millis() - lastStreamData >= STREAM_SILENCE;
+    if (!trafficStream->connected() || silent) {
+        // A half-open connection (server gone, NAT timeout) never reports
+        // disconnected; the missing keepalives give it away
+        Serial.println(silent ? "Traffic stream silent, polling" : "Traffic stream lost, polling");
+        streamHttp.end();
+        trafficStream = NULL;
+        return false;
+    }
+    while (trafficStream->available()) {
+        String line = trafficStream->readStringUntil('\n');
+        lastStreamData = millis();
+        if (line.startsWith("data:")) apply_traffic_json(line.substring(5));
     }
-    http.end();
+    return true;
 }
 
 void post_device_status() {
     if (WiFi.status() != WL_CONNECTED) return;
 
-    HTTPClient http;
+    apiHttp.setReuse(true);
+    apiHttp.setTimeout(200);
     String url = String(server_base) + "/esp_update";
-    http.begin(url);
-    http.addHeader("Content-Type", "application/json");
+    apiHttp.begin(apiClient, url);
+    apiHttp.addHeader("Content-Type", "application/json");
 
     String phaseStr = "UNKNOWN";
     if (currentState == SEARCH_NEXT) phaseStr = "SEARCHING";
@@ -235,6 +312,6 @@ void post_device_status() {
     String requestBody;
     serializeJson(doc, requestBody);
 
-    http.POST(requestBody);
-    http.end();
+    apiHttp.POST(requestBody);
+    apiHttp.end();
 }
\ No newline at end of file
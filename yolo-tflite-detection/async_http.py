@@ -0,0 +1,232 @@
+import asyncio
+import io
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+from urllib.parse import parse_qsl, unquote, urlsplit
+
+# An idle keep-alive connection is closed after this many seconds.
+KEEPALIVE_TIMEOUT = 30
+MAX_HEADER_BYTES = 16 * 1024
+MAX_BODY_BYTES = 64 * 1024
+# Threads for routes that fall back to the WSGI app.
+WSGI_THREADS = 4
+
+
+class Request:
+    def __init__(self, method, target, version, headers, body, peer):
+        parts = urlsplit(target)
+        self.method = method
+        self.path = unquote(parts.path)
+        self.query_string = parts.query
+        self.args = dict(parse_qsl(parts.query))
+        self.version = version
+        self.headers = headers
+        self.body = body
+        self.peer = peer
+
+
+class Response:
+    # body is bytes, or an async iterator of bytes for a stream (sent without
+    # a length, and the connection is closed after it).
+    def __init__(self, body=b"", status=200, headers=None, content_type="application/json"):
+        self.body = body
+        self.status = status
+        self.headers = dict(headers or {})
+        if content_type:
+            self.headers.setdefault("Content-Type", content_type)
+
+
+class AsyncHTTPServer:
+    # A small HTTP/1.1 server on one asyncio event loop in its own thread.
+    # Connections are kept alive, so a controller polling every 500 ms reuses
+    # one socket instead of costing a thread and a handshake per request.
+    # Routes registered here are plain functions that return a Response (or
+    # coroutines, for long-lived streams) and run on the loop itself; any
+    # other path is handed to the WSGI app on a small thread pool.
+    def __init__(self, host="0.0.0.0", port=5000, wsgi_app=None, on_response=None):
+        self.host = host
+        self.port = port
+        self.wsgi_app = wsgi_app
+        self.on_response = on_response
+        self.routes = {}
+        self.loop = None
+        self.executor = ThreadPoolExecutor(WSGI_THREADS, thread_name_prefix="wsgi")
+        self.changed = None
+        self.started = threading.Event()
+        self.connections = 0
+        self.requests = 0
+
+    def route(self, method, path, handler):
+        self.routes[(method, path)] = handler
+
+    def notify(self):
+        # Thread-safe: wakes every stream waiting in wait_changed().
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.wake)
+
+    def wake(self):
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+    async def wait_changed(self, timeout):
+        # True if notify() was called, False on timeout.
+        try:
+            await asyncio.wait_for(self.changed.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    def start(self):
+        threading.Thread(target=self.run, daemon=True, name="async-http").start()
+        self.started.wait()
+
+    def run(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.changed = asyncio.Event()
+        self.loop.run_until_complete(
+            asyncio.start_server(self.handle_connection, self.host, self.port, limit=MAX_HEADER_BYTES, backlog=1024)
+        )
+        self.started.set()
+        self.loop.run_forever()
+
+    def stats(self):
+        return {"open_connections": self.connections, "requests": self.requests}
+
+    async def handle_connection(self, reader, writer):
+        self.connections += 1
+        peer = writer.get_extra_info("peername")
+        try:
+            while True:
+                try:
+                    head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), KEEPALIVE_TIMEOUT)
+                except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+                    break
+                try:
+                    request = await self.read_request(head, reader, peer)
+                except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionResetError):
+                    # The client went away (or stalled) mid-body.
+                    break
+                if request is None:
+                    await self.write(writer, Response(b'{"status": "error"}', 400), keep_alive=False)
+                    break
+                keep_alive = self.wants_keep_alive(request)
+                response = await self.dispatch(request)
+                self.requests += 1
+                # The WSGI app does its own accounting.
+                if self.on_response is not None and (request.method, request.path) in self.routes:
+                    self.on_response(request, response)
+                if not isinstance(response.body, bytes):
+                    await self.write_stream(writer, response)
+                    break
+                await self.write(writer, response, keep_alive)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            self.connections -= 1
+            writer.close()
+
+    async def read_request(self, head, reader, peer):
+        try:
+            lines = head.decode("latin-1").split("\r\n")
+            method, target, version = lines[0].split(" ", 2)
+            headers = {}
+            for line in lines[1:]:
+                if line:
+                    name, _, value = line.partition(":")
+                    headers[name.strip().lower()] = value.strip()
+            length = int(headers.get("content-length", 0))
+        except ValueError:
+            return None
+        if length < 0 or length > MAX_BODY_BYTES:
+            return None
+        body = await asyncio.wait_for(reader.readexactly(length), KEEPALIVE_TIMEOUT) if length else b""
+        return Request(method, target, version, headers, body, peer)
+
+    def wants_keep_alive(self, request):
+        connection = request.headers.get("connection", "").lower()
+        if request.version == "HTTP/1.0":
+            return connection == "keep-alive"
+        return connection != "close"
+
+    async def dispatch(self, request):
+        handler = self.routes.get((request.method, request.path))
+        try:
+            if handler is not None:
+                response = handler(request)
+                if asyncio.iscoroutine(response):
+                    response = await response
+                return response
+            if self.wsgi_app is not None:
+                return await self.loop.run_in_executor(self.executor, self.call_wsgi, request)
+        except Exception as e:
+            print(f"Error serving {request.method} {request.path}: {e}")
+            return Response(b'{"status": "error"}', 500)
+        return Response(b'{"status": "error", "message": "not found"}', 404)
+
+    def call_wsgi(self, request):
+        environ = {
+            "REQUEST_METHOD": request.method,
+            "SCRIPT_NAME": "",
+            "PATH_INFO": request.path,
+            "QUERY_STRING": request.query_string,
+            "SERVER_NAME": self.host,
+            "SERVER_PORT": str(self.port),
+            "SERVER_PROTOCOL": request.version,
+            "REMOTE_ADDR": request.peer[0] if request.peer else "",
+            "CONTENT_TYPE": request.headers.get("content-type", ""),
+            "CONTENT_LENGTH": str(len(request.body)),
+            "wsgi.version": (1, 0),
+            "wsgi.url_scheme": "http",
+            "wsgi.input": io.BytesIO(request.body),
+            "wsgi.errors": sys.stderr,
+            "wsgi.multithread": True,
+            "wsgi.multiprocess": False,
+            "wsgi.run_once": False,
+        }
+        for name, value in request.headers.items():
+            if name not in ("content-type", "content-length"):
+                environ["HTTP_" + name.upper().replace("-", "_")] = value
+        started = {}
+
+        def start_response(status, headers, exc_info=None):
+            started["status"] = int(status.split(" ", 1)[0])
+            started["headers"] = headers
+
+        result = self.wsgi_app(environ, start_response)
+        try:
+            body = b"".join(result)
+        finally:
+            if hasattr(result, "close"):
+                result.close()
+        headers = {name: value for name, value in started["headers"] if name.lower() != "content-length"}
+        return Response(body, started["status"], headers, content_type=None)
+
+    async def write(self, writer, response, keep_alive):
+        writer.write(self.head(response, keep_alive, len(response.body)) + response.body)
+        await writer.drain()
+
+    async def write_stream(self, writer, response):
+        writer.write(self.head(response, False, None))
+        try:
+            async for chunk in response.body:
+                writer.write(chunk)
+                await writer.drain()
+        finally:
+            await response.body.aclose()
+
+    def head(self, response, keep_alive, length):
+        try:
+            reason = HTTPStatus(response.status).phrase
+        except ValueError:
+            reason = ""
+        lines = [f"HTTP/1.1 {response.status} {reason}"]
+        lines += [f"{name}: {value}" for name, value in response.headers.items()]
+        if length is not None:
+            lines.append(f"Content-Length: {length}")
+        lines.append("Connection: keep-alive" if keep_alive else "Connection: close")
+        return ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")
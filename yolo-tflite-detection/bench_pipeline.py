@@ -0,0 +1,211 @@
+import argparse
+import json
+import os
+import sys
+import time
+
+import cv2
+import numpy as np
+
+from server import (CONF_THRESHOLD, IOU_THRESHOLD, MODEL_NAME, SKY_LINE, YOLO_TFLite, count_lanes, draw_overlay,
+                    lane_occupancy)
+
+VIDEO_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "intersection.mp4")
+STAGES = ["decode", "letterbox", "invoke", "postprocess", "nms", "lanes", "overlay", "jpeg"]
+WARMUP_FRAMES = 5
+JPEG_QUALITY = 80
+# Slowdowns smaller than this are treated as timer noise.
+MIN_REGRESSION_MS = 0.5
+
+
+class StubInterpreter:
+    # Stands in for tflite.Interpreter so the pipeline can be timed without
+    # TensorFlow or a model file. invoke() optionally sleeps to model the
+    # network and always yields the same synthetic YOLO output: a few
+    # clusters of overlapping boxes below the sky line so NMS has real work.
+    # Like the real interpreter, invoke() raises RuntimeError while a NumPy
+    # view from tensor() is still alive.
+    def __init__(self, input_size=640, anchors=8400, classes=4, invoke_ms=0.0, seed=0):
+        self.invoke_ms = invoke_ms
+        rng = np.random.default_rng(seed)
+        output = np.empty((4 + classes, anchors), dtype=np.float32)
+        output[4:] = -6.0
+        centers = rng.uniform(0.1, 0.9, (anchors, 2))
+        sizes = rng.uniform(0.02, 0.08, (anchors, 2))
+        hot = rng.choice(anchors, anchors // 40, replace=False)
+        clusters = rng.uniform(0.45, 0.95, (len(hot) // 8 + 1, 2))
+        cluster_sizes = rng.uniform(0.03, 0.08, (len(clusters), 2))
+        member = np.arange(len(hot)) % len(clusters)
+        centers[hot] = clusters[member] + rng.normal(0, 0.002, (len(hot), 2))
+        sizes[hot] = cluster_sizes[member] * rng.uniform(0.95, 1.05, (len(hot), 1))
+        output[4 + rng.integers(0, classes, len(hot)), hot] = rng.uniform(0.5, 4.0, len(hot))
+        output[0:2] = (centers - sizes / 2).T
+        output[2:4] = (centers + sizes / 2).T
+        self.frame_output = output
+        self.shapes = [(1, input_size, input_size, 3), (1,) + output.shape]
+        self.allocate_tensors()
+
+    def resize_tensor_input(self, index, shape):
+        # Batches: every frame of the batch gets the same output.
+        self.shapes = [tuple(shape), (shape[0],) + self.frame_output.shape]
+
+    def allocate_tensors(self):
+        # Tensors live in bytearrays; every live view keeps a reference to
+        # one, which is what invoke() checks for.
+        self.buffers = [bytearray(4 * int(np.prod(shape))) for shape in self.shapes]
+        self.view(1)[:] = self.frame_output
+
+    def view(self, index):
+        return np.frombuffer(self.buffers[index], dtype=np.float32).reshape(self.shapes[index])
+
+    def get_input_details(self):
+        return [{"index": 0, "shape": np.array(self.shapes[0]), "dtype": np.float32, "quantization": (0.0, 0)}]
+
+    def get_output_details(self):
+        return [{"index": 1, "shape": np.array(self.shapes[1]), "dtype": np.float32, "quantization": (0.0, 0)}]
+
+    def tensor(self, index):
+        return lambda: self.view(index)
+
+    def set_tensor(self, index, value):
+        self.view(index)[...] = value
+
+    def get_tensor(self, index):
+        return self.view(index).copy()
+
+    def invoke(self):
+        # One reference from self.buffers, one from getrefcount's argument.
+        if any(sys.getrefcount(self.buffers[i]) > 2 for i in range(len(self.buffers))):
+            raise RuntimeError("There is at least 1 reference to internal data in the interpreter in the form of a "
+                               "numpy array or slice. Be sure to only hold the function returned from tensor() if "
+                               "you are using raw data access.")
+        if self.invoke_ms:
+            time.sleep(self.invoke_ms / 1000)
+
+
+def percentiles(samples):
+    ms = np.array(samples) * 1000 if samples else np.zeros(1)
+    return {
+        "p50": round(float(np.percentile(ms, 50)), 3),
+        "p95": round(float(np.percentile(ms, 95)), 3),
+        "p99": round(float(np.percentile(ms, 99)), 3),
+        "mean": round(float(ms.mean()), 3),
+    }
+
+
+def replay(model, video_path, max_frames, warmup):
+    # Runs every frame through the same steps as YOLO_TFLite.detect(), but
+    # timed one stage at a time, with no pacing between frames.
+    cap = cv2.VideoCapture(video_path)
+    if not cap.isOpened():
+        raise SystemExit(f"Could not open {video_path}")
+    timings = {stage: [] for stage in STAGES}
+    detections = 0
+    frames = 0
+    clock = time.perf_counter
+    start = clock()
+    while max_frames is None or frames < max_frames + warmup:
+        if frames == warmup:
+            timings = {stage: [] for stage in STAGES}
+            detections = 0
+            start = clock()
+        t0 = clock()
+        ret, frame = cap.read()
+        if not ret:
+            break
+        t1 = clock()
+        # A fresh input view per frame, gone before invoke(), as in run().
+        ratio, (pad_w, pad_h) = model.preprocess_into(frame, model.input_tensor()[0])
+        t2 = clock()
+        model.interpreter.invoke()
+        t3 = clock()
+        boxes, confidences, class_ids = model.decode(model.read_output(), ratio, pad_w, pad_h)
+        t4 = clock()
+        results = model.nms(boxes, confidences, class_ids)
+        t5 = clock()
+        count_lanes(results)
+        lane_occupancy(results, t5)
+        t6 = clock()
+        draw_overlay(frame, results)
+        t7 = clock()
+        cv2.imencode(".jpg", frame, [int(cv2.IMWRITE_JPEG_QUALITY), JPEG_QUALITY])
+        t8 = clock()
+        for stage, begin, end in zip(STAGES, (t0, t1, t2, t3, t4, t5, t6, t7), (t1, t2, t3, t4, t5, t6, t7, t8)):
+            timings[stage].append(end - begin)
+        detections += len(results)
+        frames += 1
+    elapsed = clock() - start
+    cap.release()
+
+    measured = max(frames - warmup, 0)
+    return {
+        "video": os.path.basename(video_path),
+        "frames": measured,
+        "fps": round(measured / elapsed, 2) if measured else 0.0,
+        "detections_per_frame": round(detections / measured, 2) if measured else 0.0,
+        "stages_ms": {stage: percentiles(samples) for stage, samples in timings.items()},
+    }
+
+
+def regressions(report, baseline, tolerance):
+    # Stages whose p95 grew by more than `tolerance` against a saved report.
+    slower = []
+    for stage, stats in report["stages_ms"].items():
+        before = baseline.get("stages_ms", {}).get(stage)
+        if before and stats["p95"] > max(before["p95"] * (1 + tolerance), before["p95"] + MIN_REGRESSION_MS):
+            slower.append(f"{stage}: p95 {before['p95']:.2f} -> {stats['p95']:.2f} ms")
+    if baseline.get("fps") and report["fps"] < baseline["fps"] / (1 + tolerance):
+        slower.append(f"fps: {baseline['fps']:.1f} -> {report['fps']:.1f}")
+    return slower
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a recorded video through the detection pipeline")
+    parser.add_argument("video", nargs="?", default=VIDEO_PATH)
+    parser.add_argument("--model", default=MODEL_NAME)
+    parser.add_argument("--stub", action="store_true", help="use a synthetic interpreter instead of the model")
+    parser.add_argument("--stub-invoke-ms", type=float, default=0.0, help="time each stub invoke() takes")
+    parser.add_argument("--threads", type=int, help="interpreter threads (default: autotune)")
+    parser.add_argument("--max-frames", type=int)
+    parser.add_argument("--warmup", type=int, default=WARMUP_FRAMES)
+    parser.add_argument("--json", help="write the report to this file ('-' for stdout)")
+    parser.add_argument("--baseline", help="earlier --json report to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed slowdown against --baseline")
+    args = parser.parse_args()
+
+    if args.stub:
+        interpreter = StubInterpreter(invoke_ms=args.stub_invoke_ms)
+        model = YOLO_TFLite(args.model, conf_thres=CONF_THRESHOLD, iou_thres=IOU_THRESHOLD, num_threads=args.threads,
+                            sky_line=SKY_LINE, interpreter=interpreter)
+    else:
+        model = YOLO_TFLite(args.model, conf_thres=CONF_THRESHOLD, iou_thres=IOU_THRESHOLD, num_threads=args.threads,
+                            sky_line=SKY_LINE)
+
+    report = replay(model, args.video, args.max_frames, args.warmup)
+    report["model"] = "stub" if args.stub else os.path.basename(args.model)
+    report["threads"] = model.num_threads
+
+    if args.json == "-":
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        print(f"{report['frames']} frames of {report['video']} with {report['model']}: "
+              f"{report['fps']:.1f} FPS, {report['detections_per_frame']:.1f} detections/frame")
+        print(f"{'stage':>12} {'p50':>8} {'p95':>8} {'p99':>8}  (ms)")
+        for stage, stats in report["stages_ms"].items():
+            print(f"{stage:>12} {stats['p50']:8.2f} {stats['p95']:8.2f} {stats['p99']:8.2f}")
+        if args.json:
+            with open(args.json, "w") as f:
+                json.dump(report, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            slower = regressions(report, json.load(f), args.tolerance)
+        for line in slower:
+            print(f"REGRESSION {line}", file=sys.stderr)
+        if slower:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
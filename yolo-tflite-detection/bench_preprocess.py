@@ -0,0 +1,67 @@
+import argparse
+import time
+import tracemalloc
+
+import cv2
+import numpy as np
+
+from server import MODEL_NAME, YOLO_TFLite
+
+
+def copy_path(model, frame):
+    input_data, _, _ = model.preprocess(frame)
+    model.interpreter.set_tensor(model.input_details["index"], input_data)
+
+
+def zero_copy_path(model, frame):
+    model.preprocess_into(frame, model.input_tensor()[0])
+
+
+def measure(fn, model, frame, iterations):
+    fn(model, frame)
+
+    tracemalloc.start()
+    peak_bytes = 0
+    start = time.perf_counter()
+    for _ in range(iterations):
+        tracemalloc.reset_peak()
+        base, _ = tracemalloc.get_traced_memory()
+        fn(model, frame)
+        _, peak = tracemalloc.get_traced_memory()
+        peak_bytes += peak - base
+    elapsed = time.perf_counter() - start
+    tracemalloc.stop()
+
+    return elapsed / iterations * 1000, peak_bytes / iterations / 1024
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Preprocessing micro-benchmark")
+    parser.add_argument("--model", default=MODEL_NAME)
+    parser.add_argument("--video", help="use the first frame of this video")
+    parser.add_argument("--width", type=int, default=1920)
+    parser.add_argument("--height", type=int, default=1080)
+    parser.add_argument("--iterations", type=int, default=200)
+    args = parser.parse_args()
+
+    if args.video:
+        cap = cv2.VideoCapture(args.video)
+        ret, frame = cap.read()
+        cap.release()
+        if not ret:
+            print(f"Could not read a frame from {args.video}")
+            return
+    else:
+        rng = np.random.default_rng(0)
+        frame = rng.integers(0, 256, (args.height, args.width, 3), dtype=np.uint8)
+
+    model = YOLO_TFLite(args.model)
+    print(f"Frame {frame.shape[1]}x{frame.shape[0]} -> input {model.input_w}x{model.input_h}")
+
+    for name, fn in (("copy", copy_path), ("zero-copy", zero_copy_path)):
+        ms, kb = measure(fn, model, frame, args.iterations)
+        print(f"{name:>10}: {ms:7.3f} ms/frame, {kb:10.1f} KiB allocated/frame")
+
+
+if __name__ == "__main__":
+    main()
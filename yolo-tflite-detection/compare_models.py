@@ -0,0 +1,106 @@
+import argparse
+import time
+
+import cv2
+import numpy as np
+
+from server import CONF_THRESHOLD, IOU_THRESHOLD, YOLO_TFLite
+
+MODEL_VARIANTS = [
+    "detect_traffic_s_float32.tflite",
+    "detect_traffic_s_float16.tflite",
+    "detect_traffic_s_int8.tflite",
+]
+MATCH_IOU = 0.5
+
+
+def load_frames(video_path, max_frames):
+    cap = cv2.VideoCapture(video_path)
+    frames = []
+    while len(frames) < max_frames:
+        ret, frame = cap.read()
+        if not ret:
+            break
+        frames.append(frame)
+    cap.release()
+    return frames
+
+
+def box_iou(a, b):
+    a = np.asarray(a, dtype=np.float32).reshape(-1, 4)
+    b = np.asarray(b, dtype=np.float32).reshape(-1, 4)
+    x1 = np.maximum(a[:, None, 0], b[None, :, 0])
+    y1 = np.maximum(a[:, None, 1], b[None, :, 1])
+    x2 = np.minimum(a[:, None, 2], b[None, :, 2])
+    y2 = np.minimum(a[:, None, 3], b[None, :, 3])
+    inter = np.clip(x2 - x1, 0, None) * np.clip(y2 - y1, 0, None)
+    area_a = (a[:, 2] - a[:, 0]) * (a[:, 3] - a[:, 1])
+    area_b = (b[:, 2] - b[:, 0]) * (b[:, 3] - b[:, 1])
+    return inter / np.maximum(area_a[:, None] + area_b[None, :] - inter, 1e-6)
+
+
+def agreement(reference, candidate):
+    # Greedy one-to-one matching at MATCH_IOU, reported as F1 so missed and
+    # extra boxes count the same.
+    if not reference and not candidate:
+        return 1.0
+    if not reference or not candidate:
+        return 0.0
+    iou = box_iou([r["box"] for r in reference], [c["box"] for c in candidate])
+    matched = 0
+    while iou.size and iou.max() >= MATCH_IOU:
+        i, j = np.unravel_index(iou.argmax(), iou.shape)
+        iou[i, :] = 0
+        iou[:, j] = 0
+        matched += 1
+    return 2 * matched / (len(reference) + len(candidate))
+
+
+def run_model(model_path, frames, num_threads):
+    model = YOLO_TFLite(
+        model_path, conf_thres=CONF_THRESHOLD, iou_thres=IOU_THRESHOLD, num_threads=num_threads
+    )
+    model.detect(frames[0])
+    latencies, detections = [], []
+    for frame in frames:
+        start = time.perf_counter()
+        detections.append(model.detect(frame))
+        latencies.append(time.perf_counter() - start)
+    return model.num_threads, np.array(latencies) * 1000, detections
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare TFLite model variants on a recorded clip")
+    parser.add_argument("video")
+    parser.add_argument("models", nargs="*", default=MODEL_VARIANTS, help="first model is the reference")
+    parser.add_argument("--frames", type=int, default=300)
+    parser.add_argument("--threads", type=int, help="fixed thread count (default: auto-tune)")
+    args = parser.parse_args()
+
+    frames = load_frames(args.video, args.frames)
+    if not frames:
+        print(f"Could not read frames from {args.video}")
+        return
+    print(f"Loaded {len(frames)} frames from {args.video}")
+
+    rows = []
+    reference = None
+    for model_path in args.models:
+        num_threads, latencies, detections = run_model(model_path, frames, args.threads)
+        if reference is None:
+            reference = detections
+        scores = [agreement(ref, det) for ref, det in zip(reference, detections)]
+        rows.append((model_path, num_threads, latencies, detections, np.mean(scores)))
+
+    print()
+    print(f"{'model':<40} {'threads':>7} {'mean ms':>8} {'p95 ms':>8} {'boxes/frame':>11} {'agreement':>9}")
+    for model_path, num_threads, latencies, detections, score in rows:
+        boxes = np.mean([len(d) for d in detections])
+        print(
+            f"{model_path:<40} {str(num_threads):>7} {latencies.mean():8.2f} "
+            f"{np.percentile(latencies, 95):8.2f} {boxes:11.2f} {score:9.3f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
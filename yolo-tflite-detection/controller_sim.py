@@ -0,0 +1,314 @@
+import argparse
+import bisect
+import csv
+import itertools
+import json
+import math
+import os
+import time
+from multiprocessing import Pool
+
+import numpy as np
+
+from history import NUMERIC_FIELDS
+
+# Defaults mirror the constants in SmartTraffic.ino (times in ms).
+LANE_CAPACITIES = (5, 20, 10, 15)
+MIN_GREEN = 5000
+MAX_GREEN = 30000
+YELLOW_TIME = 2000
+SAT_THRESHOLD = 0.15
+SKIP_THRESHOLD = 0.05
+SKIP_DELAY = 100
+
+SEARCH_NEXT, MIN_GREEN_PHASE, ADAPTIVE_PHASE, YELLOW_PHASE = range(4)
+LANES = 4
+
+
+def load_recording(path):
+    # (t, counts, occupancy) from a /history file (.npy, see history.py) or a
+    # CSV with t, lane1_count .. lane4_count and optionally lane1_occupancy ..
+    # lane4_occupancy columns. t is in seconds; occupancy is NaN where it was
+    # not recorded.
+    if path.endswith(".npy"):
+        samples = np.load(path, mmap_mode="r")
+        samples = samples[samples["t"] > 0]
+        samples = samples[np.argsort(samples["t"])]
+        values = np.asarray(samples["values"], dtype=np.float64)
+        counts = np.nan_to_num(values[:, :LANES])
+        if values.shape[1] >= len(NUMERIC_FIELDS):
+            first = NUMERIC_FIELDS.index("lane1_occupancy")
+            occupancy = values[:, first:first + LANES]
+        else:
+            occupancy = np.full((len(values), LANES), np.nan)
+        return np.asarray(samples["t"], dtype=np.float64), counts.astype(np.int64), occupancy
+    with open(path) as f:
+        rows = list(csv.DictReader(f))
+    t = np.array([float(row["t"]) for row in rows])
+    counts = np.array([[int(float(row[f"lane{n + 1}_count"])) for n in range(LANES)] for row in rows])
+    occupancy = np.array([[float(row.get(f"lane{n + 1}_occupancy") or "nan") for n in range(LANES)]
+                          for row in rows]).reshape(-1, LANES)
+    order = np.argsort(t, kind="stable")
+    return t[order], counts[order], occupancy[order]
+
+
+def synthetic_recording(hours, seed=0):
+    # One sample per second; each lane drifts between quiet and busy spells.
+    rng = np.random.default_rng(seed)
+    n = int(hours * 3600)
+    t = np.arange(n, dtype=np.float64)
+    counts = np.empty((n, LANES), dtype=np.int64)
+    for lane, capacity in enumerate(LANE_CAPACITIES):
+        rate = np.abs(np.cumsum(rng.normal(0, 0.02, n))) % 1.0
+        counts[:, lane] = rng.binomial(capacity, rate * (rng.random(n) < 0.98))
+    # No vehicle sizes to derive occupancy from.
+    return t, counts, np.full((n, LANES), np.nan)
+
+
+def next_true(mask):
+    # For each index, the first index at or after it where mask is set
+    # (len(mask) if none).
+    n = len(mask)
+    index = np.where(mask, np.arange(n), n)
+    return np.minimum.accumulate(index[::-1])[::-1]
+
+
+class Recording:
+    def __init__(self, t, counts, occupancy, latency=0):
+        # Times are whole milliseconds, like millis() on the device, so the
+        # replay is exact. The controller sees each sample `latency` ms after
+        # it was taken (0 with the /traffic/stream push, up to 500 when
+        # polling).
+        self.t = np.round((t - t[0]) * 1000).astype(np.int64) + int(latency)
+        self.counts = counts
+        self.occupancy = occupancy
+        self.n = len(t)
+        self.end = int(self.t[-1])
+        self.dt = np.diff(self.t, append=self.t[-1]).astype(np.float64)
+        self.times = self.t.tolist()
+
+    def index(self, now):
+        return max(bisect.bisect_right(self.times, now) - 1, 0)
+
+    def prefix(self, values):
+        # cumulative integral of a per-sample step function, per lane
+        return np.vstack([np.zeros(values.shape[1]), np.cumsum(values * self.dt[:, None], axis=0)])
+
+    def integral(self, cum, values, lane, a, b):
+        # in value * ms
+        def at(x):
+            i = self.index(x)
+            return cum[i, lane] + values[i, lane] * (x - self.times[i])
+
+        return at(b) - at(a) if b > a else 0.0
+
+
+def simulate(recording, capacities=LANE_CAPACITIES, min_green=MIN_GREEN, max_green=MAX_GREEN,
+             yellow_time=YELLOW_TIME, sat_threshold=SAT_THRESHOLD, skip_threshold=SKIP_THRESHOLD,
+             skip_delay=SKIP_DELAY, signal="counts"):
+    # Replays the SmartTraffic.ino state machine against a recording. Time
+    # only jumps from one decision to the next: the end of a phase timer, a
+    # skip delay, or the first sample at which a gap-out or a busy lane
+    # appears (found in precomputed next-index tables). The device's own
+    # loop overhead (HTTP calls) is not modelled. signal picks the lane
+    # saturation: "counts" (counts / capacity) or "occupancy" (the server's
+    # laneN_occupancy, counts / capacity where none was recorded), matching
+    # USE_OCCUPANCY in the firmware.
+    rec = recording
+    t, n = rec.times, rec.n
+    min_green, max_green, yellow_time, skip_delay = int(min_green), int(max_green), int(yellow_time), int(skip_delay)
+
+    # getSaturation() in float32, as on the ESP32
+    caps = np.array([c if c != 0 else 1 for c in capacities], dtype=np.float32)
+    sat = np.minimum(rec.counts.astype(np.float32) / caps, np.float32(1.0))
+    if signal == "occupancy":
+        occupancy = rec.occupancy.astype(np.float32)
+        sat = np.where(np.isnan(occupancy), sat, occupancy)
+    busy = sat > np.float32(skip_threshold)
+    low = sat <= np.float32(sat_threshold)
+    any_busy = busy.any(axis=1)
+    next_busy = [next_true(busy[:, lane]) for lane in range(LANES)]
+    next_low = [next_true(low[:, lane]) for lane in range(LANES)]
+    next_any_busy = next_true(any_busy)
+    counts = rec.counts.astype(np.float64)
+    used = (~low).astype(np.float64)
+    cum_counts, cum_used = rec.prefix(counts), rec.prefix(used)
+
+    state, current, now, phase_start = SEARCH_NEXT, LANES - 1, 0, 0
+    red_since = [0] * LANES
+    waits = []
+    skips, greens = [0] * LANES, [0] * LANES
+    green_time, green_used = [0] * LANES, [0.0] * LANES
+    red_load = 0.0
+    search_time = yellow_total = 0
+    gap_outs = max_outs = 0
+
+    while now < rec.end:
+        i = rec.index(now)
+        if state == SEARCH_NEXT:
+            candidate = (current + 1) % LANES
+            if busy[i, candidate]:
+                j = next_busy[candidate][rec.index(red_since[candidate])]
+                if j < n:
+                    became_busy = max(red_since[candidate], t[j])
+                    if became_busy <= now:
+                        waits.append(now - became_busy)
+                red_load += rec.integral(cum_counts, counts, candidate, red_since[candidate], now)
+                current, state, phase_start = candidate, MIN_GREEN_PHASE, now
+                greens[candidate] += 1
+                continue
+            skips[candidate] += 1
+            current = candidate
+            steps = 1
+            if not any_busy[i]:
+                # Nothing is waiting: the controller keeps skipping one lane
+                # per delay until a lane turns busy.
+                j = next_any_busy[i]
+                target = t[j] if j < n else rec.end
+                steps = max(1, -(-(target - now) // skip_delay))
+                extra = steps - 1
+                for offset in range(min(extra, LANES)):
+                    skips[(current + 1 + offset) % LANES] += (extra - offset + LANES - 1) // LANES
+                current = (current + extra) % LANES
+            search_time += steps * skip_delay
+            now += steps * skip_delay
+        elif state == MIN_GREEN_PHASE:
+            now = phase_start + min_green
+            state = ADAPTIVE_PHASE
+        elif state == ADAPTIVE_PHASE:
+            forced = max(now, phase_start + max_green)
+            j = next_low[current][i]
+            gap = max(now, t[j]) if j < n else math.inf
+            now = gap if gap < phase_start + max_green else forced
+            end = min(now, rec.end)
+            green_time[current] += end - phase_start
+            green_used[current] += rec.integral(cum_used, used, current, phase_start, end)
+            if now >= rec.end:
+                break
+            if gap < phase_start + max_green:
+                gap_outs += 1
+            else:
+                max_outs += 1
+            state, phase_start = YELLOW_PHASE, now
+        else:
+            now = phase_start + yellow_time
+            yellow_total += yellow_time
+            red_since[current] = now
+            state = SEARCH_NEXT
+
+    for lane in range(LANES):
+        if not (state != SEARCH_NEXT and lane == current):
+            red_load += rec.integral(cum_counts, counts, lane, red_since[lane], rec.end)
+
+    duration = max(rec.end, 1)
+    total_green = sum(green_time)
+    waits = np.array(waits) if waits else np.zeros(1)
+    return {
+        "wait_s": {
+            "mean": round(float(waits.mean()) / 1000, 2),
+            "p95": round(float(np.percentile(waits, 95)) / 1000, 2),
+            "max": round(float(waits.max()) / 1000, 2),
+        },
+        # vehicles standing at red, averaged over the recording
+        "mean_vehicles_at_red": round(red_load / duration, 3),
+        "phase_share": {
+            "green": round(total_green / duration, 4),
+            "yellow": round(yellow_total / duration, 4),
+            "search": round(search_time / duration, 4),
+        },
+        "green_utilization": round(sum(green_used) / total_green, 4) if total_green else 0.0,
+        "gap_outs": gap_outs,
+        "max_outs": max_outs,
+        "lanes": [
+            {
+                "greens": greens[lane],
+                "skips": skips[lane],
+                "green_share": round(green_time[lane] / duration, 4),
+                "green_utilization": round(green_used[lane] / green_time[lane], 4) if green_time[lane] else 0.0,
+            }
+            for lane in range(LANES)
+        ],
+    }
+
+
+recording = None
+signal = "counts"
+
+
+def init_worker(source, latency, saturation_signal):
+    global recording, signal
+    t, counts, occupancy = synthetic_recording(*source) if isinstance(source, tuple) else load_recording(source)
+    recording = Recording(t, counts, occupancy, latency)
+    signal = saturation_signal
+
+
+def run_params(params):
+    return params, simulate(recording, signal=signal, **params)
+
+
+def parse_list(text, cast=float):
+    return [cast(v) for v in text.split(",")]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay recorded lane counts through the signal controller logic")
+    parser.add_argument("recording", nargs="?",
+                        help="/history .npy file or CSV (t, lane1_count..lane4_count[, lane1_occupancy..])")
+    parser.add_argument("--synthetic", type=float, metavar="HOURS", help="use generated counts instead")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="delay before the controller sees a count")
+    parser.add_argument("--signal", choices=("counts", "occupancy"), default="counts",
+                        help="lane saturation the controller acts on (USE_OCCUPANCY in the firmware)")
+    parser.add_argument("--capacities", type=lambda s: [tuple(parse_list(v, int)) for v in s.split(";")],
+                        default=[LANE_CAPACITIES], help="e.g. '5,20,10,15;8,20,10,15'")
+    parser.add_argument("--min-green", type=parse_list, default=[MIN_GREEN])
+    parser.add_argument("--max-green", type=parse_list, default=[MAX_GREEN])
+    parser.add_argument("--yellow-time", type=parse_list, default=[YELLOW_TIME])
+    parser.add_argument("--sat-threshold", type=parse_list, default=[SAT_THRESHOLD])
+    parser.add_argument("--skip-threshold", type=parse_list, default=[SKIP_THRESHOLD])
+    parser.add_argument("--processes", type=int, default=os.cpu_count())
+    parser.add_argument("--top", type=int, default=10, help="rows to print, best mean wait first")
+    parser.add_argument("--json", help="write every result to this file")
+    args = parser.parse_args()
+
+    if args.synthetic:
+        source = (args.synthetic, args.seed)
+    elif args.recording:
+        source = args.recording
+    else:
+        parser.error("give a recording or --synthetic HOURS")
+    if args.signal == "occupancy" and args.synthetic:
+        parser.error("--signal occupancy needs a recording with laneN_occupancy")
+
+    names = ["capacities", "min_green", "max_green", "yellow_time", "sat_threshold", "skip_threshold"]
+    grid = [dict(zip(names, values)) for values in itertools.product(
+        args.capacities, args.min_green, args.max_green, args.yellow_time, args.sat_threshold, args.skip_threshold)]
+
+    start = time.perf_counter()
+    if len(grid) == 1 or args.processes == 1:
+        init_worker(source, args.latency_ms, args.signal)
+        results = [run_params(params) for params in grid]
+    else:
+        with Pool(min(args.processes, len(grid)), initializer=init_worker,
+                  initargs=(source, args.latency_ms, args.signal)) as pool:
+            results = pool.map(run_params, grid)
+    elapsed = time.perf_counter() - start
+
+    results.sort(key=lambda item: item[1]["wait_s"]["mean"])
+    print(f"{len(grid)} parameter sets in {elapsed:.1f}s")
+    print(f"{'min':>6} {'max':>6} {'sat':>5} {'skip':>5}  capacities       wait mean/p95/max   green  util  skips")
+    for params, result in results[: args.top]:
+        wait = result["wait_s"]
+        print(f"{params['min_green']:6.0f} {params['max_green']:6.0f} {params['sat_threshold']:5.2f} "
+              f"{params['skip_threshold']:5.2f}  {str(params['capacities']):<16} "
+              f"{wait['mean']:6.1f}/{wait['p95']:6.1f}/{wait['max']:6.1f}  "
+              f"{result['phase_share']['green']:5.2f} {result['green_utilization']:5.2f} "
+              f"{sum(lane['skips'] for lane in result['lanes']):6d}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump([{"params": params, "result": result} for params, result in results], f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
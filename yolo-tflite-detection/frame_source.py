@@ -0,0 +1,189 @@
+import threading
+import time
+from collections import deque
+
+import cv2
+import numpy as np
+
+RING_SIZE = 6
+RECONNECT_DELAY = 2
+LATENCY_WINDOW = 300
+
+
+class FramePacket:
+    def __init__(self, seq, timestamp, image, slot, generation):
+        self.seq = seq
+        self.timestamp = timestamp
+        self.image = image
+        self.slot = slot
+        self.generation = generation
+
+
+class FrameSource:
+    # Decodes on its own thread into a fixed ring of frame buffers. Readers
+    # always get the newest frame ("latest frame wins") and lease its slot
+    # until release(), so the decoder never overwrites a frame in use.
+    def __init__(self, open_capture, scale=1.0, ring_size=RING_SIZE, loop=False):
+        self.open_capture = open_capture
+        self.scale = scale
+        self.ring_size = ring_size
+        self.loop = loop
+
+        self.slots = None
+        self.scratch = None
+        self.leases = [0] * ring_size
+        self.generation = 0
+        self.latest = None
+        self.seq = 0
+        self.cond = threading.Condition()
+        self.running = False
+        self.thread = None
+
+        self.fps = 0.0
+        self.frames_decoded = 0
+        self.frames_dropped = 0
+        self.reconnects = 0
+        self.failed_opens = 0
+        self.lost_at = None
+        self.reconnect_times = deque(maxlen=LATENCY_WINDOW)
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.decode_loop, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join(timeout=5)
+
+    def allocate(self, cap):
+        ok = cap.grab()
+        if not ok:
+            return False
+        ok, first = cap.retrieve()
+        if not ok:
+            return False
+        h, w = first.shape[:2]
+        if self.scale != 1.0:
+            self.scratch = first
+            h, w = max(1, int(round(h * self.scale))), max(1, int(round(w * self.scale)))
+        if self.slots is None or self.slots.shape[1:3] != (h, w):
+            with self.cond:
+                self.slots = np.empty((self.ring_size, h, w, 3), dtype=np.uint8)
+                self.leases = [0] * self.ring_size
+                self.generation += 1
+                self.latest = None
+        return True
+
+    def free_slot(self):
+        latest_slot = self.latest.slot if self.latest is not None else None
+        for offset in range(1, self.ring_size + 1):
+            slot = (self.seq + offset) % self.ring_size
+            if slot != latest_slot and self.leases[slot] == 0:
+                return slot
+        return None
+
+    def decode_loop(self):
+        cap = None
+        while self.running:
+            if cap is None:
+                # open_capture learns how many attempts in a row have failed,
+                # so it can retry a cached URL first and re-resolve after.
+                cap = self.open_capture(self.failed_opens)
+                if cap is None or not cap.isOpened() or not self.allocate(cap):
+                    if cap is not None:
+                        cap.release()
+                    cap = None
+                    self.failed_opens += 1
+                    time.sleep(RECONNECT_DELAY)
+                    continue
+                self.failed_opens = 0
+                cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+                fps = cap.get(cv2.CAP_PROP_FPS)
+                self.fps = fps if 0 < fps <= 60 else 30
+
+            if not cap.grab():
+                if self.loop:
+                    cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+                    continue
+                print("Connection lost, reconnecting...")
+                cap.release()
+                cap = None
+                self.reconnects += 1
+                self.lost_at = time.time()
+                continue
+            timestamp = time.time()
+
+            with self.cond:
+                slot = self.free_slot()
+            if slot is None:
+                # Every buffer is leased; drop this frame rather than block.
+                self.frames_dropped += 1
+                continue
+
+            if self.scale != 1.0:
+                ok, _ = cap.retrieve(self.scratch)
+                if ok:
+                    size = (self.slots.shape[2], self.slots.shape[1])
+                    cv2.resize(self.scratch, size, dst=self.slots[slot], interpolation=cv2.INTER_AREA)
+            else:
+                ok, _ = cap.retrieve(self.slots[slot])
+            if not ok:
+                continue
+
+            with self.cond:
+                self.latest = FramePacket(self.seq, timestamp, self.slots[slot], slot, self.generation)
+                self.seq += 1
+                self.frames_decoded += 1
+                self.cond.notify_all()
+            if self.lost_at is not None:
+                self.reconnect_times.append(timestamp - self.lost_at)
+                print(f"Stream back after {timestamp - self.lost_at:.1f}s")
+                self.lost_at = None
+
+        if cap is not None:
+            cap.release()
+
+    def read(self, after_seq=-1, timeout=None):
+        # Returns the newest frame with seq > after_seq, leased to the caller.
+        with self.cond:
+            ready = self.cond.wait_for(
+                lambda: self.latest is not None and self.latest.seq > after_seq, timeout
+            )
+            if not ready:
+                return None
+            packet = self.latest
+            self.leases[packet.slot] += 1
+            return packet
+
+    def release(self, packet):
+        with self.cond:
+            # Packets from before a resolution change point at the old ring.
+            if packet.generation == self.generation:
+                self.leases[packet.slot] -= 1
+
+    def record_latency(self, timestamp):
+        self.latencies.append(time.time() - timestamp)
+
+    def stats(self):
+        latencies = np.array(self.latencies) * 1000 if self.latencies else np.zeros(1)
+        outages = np.array(self.reconnect_times) if self.reconnect_times else np.zeros(1)
+        return {
+            "frames_decoded": self.frames_decoded,
+            "frames_dropped": self.frames_dropped,
+            "reconnects": self.reconnects,
+            "reconnect_s": {
+                "last": float(outages[-1]),
+                "mean": float(outages.mean()),
+                "max": float(outages.max()),
+            },
+            "stream_fps": self.fps,
+            "capture_to_count_ms": {
+                "p50": float(np.percentile(latencies, 50)),
+                "p95": float(np.percentile(latencies, 95)),
+                "max": float(latencies.max()),
+            },
+        }
@@ -0,0 +1,129 @@
+import math
+import os
+import threading
+
+import numpy as np
+
+HISTORY_RETENTION = 24 * 3600
+HISTORY_INTERVAL = 1.0
+NUMERIC_FIELDS = (
+    "lane1_count",
+    "lane2_count",
+    "lane3_count",
+    "lane4_count",
+    "active_lane",
+    "current_saturation",
+    "lane1_occupancy",
+    "lane2_occupancy",
+    "lane3_occupancy",
+    "lane4_occupancy",
+)
+PHASES = ("UNKNOWN", "SEARCHING", "MIN_GREEN", "ADAPTIVE_GREEN", "YELLOW")
+SAMPLE_DTYPE = np.dtype(
+    [("t", np.float64), ("values", np.float32, len(NUMERIC_FIELDS)), ("phase", np.uint8)]
+)
+
+
+def as_number(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
+
+
+class History:
+    # Fixed-size ring of samples, one slot per interval of wall-clock time,
+    # so memory is constant for the retention window and a slot is simply
+    # overwritten once it is older than that. With a path the ring lives in
+    # a memory-mapped .npy file and survives restarts.
+    def __init__(self, retention=HISTORY_RETENTION, interval=HISTORY_INTERVAL, path=None):
+        self.retention = retention
+        self.interval = interval
+        self.capacity = max(1, int(retention / interval))
+        self.path = path
+        self.lock = threading.Lock()
+        self.samples = self.open(path)
+
+    def open(self, path):
+        if path is None:
+            return np.zeros(self.capacity, dtype=SAMPLE_DTYPE)
+        if os.path.exists(path):
+            samples = np.lib.format.open_memmap(path, mode="r+")
+            if samples.dtype == SAMPLE_DTYPE and samples.shape == (self.capacity,):
+                return samples
+            print(f"History file {path} has a different layout, starting over")
+            del samples
+        return np.lib.format.open_memmap(path, mode="w+", dtype=SAMPLE_DTYPE, shape=(self.capacity,))
+
+    def record(self, now, traffic, controller):
+        slot = int(now // self.interval) % self.capacity
+        phase = controller.get("current_phase")
+        merged = {**controller, **traffic}
+        with self.lock:
+            sample = self.samples[slot]
+            sample["t"] = now
+            sample["values"] = [as_number(merged.get(field)) for field in NUMERIC_FIELDS]
+            sample["phase"] = PHASES.index(phase) if phase in PHASES else 0
+
+    def flush(self):
+        if isinstance(self.samples, np.memmap):
+            self.samples.flush()
+
+    def query(self, start, end, bucket, fields=NUMERIC_FIELDS):
+        # min/max/mean per bucket of `bucket` seconds in [start, end), plus
+        # the most common controller phase. Columnar, one list per statistic.
+        # Raises ValueError for a range or bucket that cannot be answered.
+        if not all(math.isfinite(v) for v in (start, end, bucket)) or bucket <= 0 or end <= start:
+            raise ValueError("start, end and bucket must be finite, with bucket > 0 and end > start")
+        n_buckets = int(np.ceil((end - start) / bucket))
+        if n_buckets > self.capacity:
+            raise ValueError(f"at most {self.capacity} buckets per query")
+        columns = [NUMERIC_FIELDS.index(field) for field in fields]
+        with self.lock:
+            t = self.samples["t"]
+            selected = np.nonzero((t >= start) & (t < end) & (t > 0))[0]
+            rows = self.samples[selected]
+
+        index = ((rows["t"] - start) // bucket).astype(np.int64)
+        order = np.argsort(index, kind="stable")
+        index = index[order]
+        values = rows["values"][order][:, columns]
+        phases = rows["phase"][order]
+
+        counts = np.bincount(index, minlength=n_buckets)
+        present = np.nonzero(counts)[0]
+        result = {
+            "bucket": bucket,
+            "t": (start + present * bucket).tolist(),
+            "samples": counts[present].tolist(),
+        }
+        if not len(present):
+            result.update({field: {"min": [], "max": [], "mean": []} for field in fields})
+            result["phase"] = []
+            return result
+
+        # Rows are sorted by bucket, so every bucket is one contiguous run.
+        bounds = np.concatenate([[0], np.cumsum(counts[present])[:-1]])
+        with np.errstate(invalid="ignore"):
+            minimum = np.fmin.reduceat(values, bounds, axis=0)
+            maximum = np.fmax.reduceat(values, bounds, axis=0)
+            valid = ~np.isnan(values)
+            mean = np.add.reduceat(np.where(valid, values, 0), bounds, axis=0) / np.add.reduceat(
+                valid, bounds, axis=0
+            )
+        for n, field in enumerate(fields):
+            result[field] = {
+                "min": [None if np.isnan(v) else float(v) for v in minimum[:, n]],
+                "max": [None if np.isnan(v) else float(v) for v in maximum[:, n]],
+                "mean": [None if np.isnan(v) else round(float(v), 3) for v in mean[:, n]],
+            }
+
+        phase_counts = np.zeros((n_buckets, len(PHASES)), dtype=np.int64)
+        np.add.at(phase_counts, (index, phases), 1)
+        result["phase"] = [PHASES[p] for p in phase_counts[present].argmax(axis=1)]
+        return result
+
+    def stats(self):
+        with self.lock:
+            filled = int(np.count_nonzero(self.samples["t"]))
+        return {"capacity": self.capacity, "filled": filled, "persistent": self.path is not None}
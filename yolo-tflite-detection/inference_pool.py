@@ -0,0 +1,295 @@
+import argparse
+import multiprocessing as mp
+import os
+import queue
+import threading
+import time
+from collections import deque
+from multiprocessing import shared_memory
+
+import cv2
+import numpy as np
+
+# A worker must load and warm up its model within this many seconds.
+READY_TIMEOUT = 120.0
+# A frame with no result after this long is given up on (its worker died or
+# hung), so the frames after it are not held back forever.
+RESULT_TIMEOUT = 10.0
+WORKER_CHECK_INTERVAL = 1.0
+
+
+def worker_main(model_cls, model_kwargs, shm_name, slot_shape, task_queue, result_queue):
+    shm = shared_memory.SharedMemory(name=shm_name)
+    slots = np.ndarray(slot_shape, dtype=np.uint8, buffer=shm.buf)
+    model = model_cls(**model_kwargs)
+    # Warm up before reporting ready, so the pool never takes a frame cold.
+    model.warmup(slot_shape[1:])
+    result_queue.put(("ready", os.getpid(), None, None))
+
+    try:
+        while True:
+            task = task_queue.get()
+            if task is None:
+                break
+            seq, slot = task
+            # Lets the pool tell which worker to replace if this frame hangs.
+            result_queue.put(("start", os.getpid(), seq, None))
+            start = time.perf_counter()
+            try:
+                results = model.detect(slots[slot])
+            except Exception as e:
+                print(f"Inference worker {os.getpid()} failed on frame {seq}: {e}")
+                results = []
+            result_queue.put((seq, slot, results, time.perf_counter() - start))
+    finally:
+        del slots
+        shm.close()
+
+
+class InferencePool:
+    # Frames travel through a ring of shared-memory slots; the queues only
+    # carry (sequence, slot) pairs and the small per-frame result lists.
+    # on_result(seq, results, timestamp, duration) gets results in sequence,
+    # with the time model.detect() took in the worker.
+    def __init__(self, model_cls, model_kwargs, frame_shape, workers, on_result, slots=None):
+        self.frame_shape = tuple(frame_shape)
+        self.workers = workers
+        self.on_result = on_result
+        self.num_slots = slots or workers * 2
+        slot_shape = (self.num_slots,) + self.frame_shape
+        self.slot_shape = slot_shape
+
+        self.shm = shared_memory.SharedMemory(create=True, size=int(np.prod(slot_shape)))
+        self.slots = np.ndarray(slot_shape, dtype=np.uint8, buffer=self.shm.buf)
+        self.free_slots = deque(range(self.num_slots))
+        self.slot_freed = threading.Condition()
+
+        self.next_seq = 0
+        self.next_emit = 0
+        self.pending = {}
+        self.timestamps = {}
+        # seq -> (slot, submit time) until its result is in or it is lost
+        self.in_flight = {}
+        # seq -> pid of the worker running it
+        self.owners = {}
+        self.submitted = 0
+        self.completed = 0
+        self.dropped = 0
+        self.lost = 0
+        self.restarts = 0
+        self.closing = False
+        self.started = time.perf_counter()
+
+        if "num_threads" not in model_kwargs:
+            model_kwargs = dict(model_kwargs, num_threads=max(1, (os.cpu_count() or 1) // workers))
+        self.model_cls = model_cls
+        self.model_kwargs = model_kwargs
+
+        self.ctx = mp.get_context("spawn")
+        self.task_queue = self.ctx.Queue()
+        self.result_queue = self.ctx.Queue()
+        self.processes = [self.start_worker() for _ in range(workers)]
+        try:
+            self.wait_ready()
+        except RuntimeError:
+            for process in self.processes:
+                process.terminate()
+            self.close()
+            raise
+        self.last_check = time.monotonic()
+
+        self.collector = threading.Thread(target=self.collect, daemon=True)
+        self.collector.start()
+
+    def start_worker(self):
+        process = self.ctx.Process(
+            target=worker_main,
+            args=(self.model_cls, self.model_kwargs, self.shm.name, self.slot_shape, self.task_queue,
+                  self.result_queue),
+            daemon=True,
+        )
+        process.start()
+        return process
+
+    def wait_ready(self):
+        ready = 0
+        deadline = time.monotonic() + READY_TIMEOUT
+        while ready < self.workers:
+            dead = [p.pid for p in self.processes if p.exitcode is not None]
+            if dead:
+                raise RuntimeError(f"Inference worker {dead[0]} exited while loading the model")
+            if time.monotonic() > deadline:
+                raise RuntimeError(f"Only {ready} of {self.workers} inference workers ready after {READY_TIMEOUT:.0f}s")
+            try:
+                item = self.result_queue.get(timeout=WORKER_CHECK_INTERVAL)
+            except queue.Empty:
+                continue
+            ready += item[0] == "ready"
+
+    def submit(self, frame, block=False, timestamp=None):
+        with self.slot_freed:
+            if block:
+                self.slot_freed.wait_for(lambda: self.free_slots)
+            elif not self.free_slots:
+                self.dropped += 1
+                return False
+            slot = self.free_slots.popleft()
+            seq = self.next_seq
+            self.next_seq += 1
+            self.timestamps[seq] = timestamp
+            self.in_flight[seq] = (slot, time.monotonic())
+
+        target = self.slots[slot]
+        if frame.shape == self.frame_shape:
+            target[:] = frame
+        else:
+            cv2.resize(frame, (self.frame_shape[1], self.frame_shape[0]), dst=target)
+        self.submitted += 1
+        self.task_queue.put((seq, slot))
+        return True
+
+    def collect(self):
+        while True:
+            try:
+                item = self.result_queue.get(timeout=WORKER_CHECK_INTERVAL)
+            except queue.Empty:
+                item = ()
+            if item is None:
+                break
+            if time.monotonic() - self.last_check >= WORKER_CHECK_INTERVAL:
+                self.check_workers()
+            if item and item[0] == "start":
+                with self.slot_freed:
+                    if item[2] in self.in_flight:
+                        self.owners[item[2]] = item[1]
+                continue
+            if not item or item[0] == "ready":
+                self.emit()
+                continue
+            seq, slot, results, duration = item
+            with self.slot_freed:
+                self.owners.pop(seq, None)
+                if self.in_flight.pop(seq, None) is None:
+                    # Given up on already; its slot was freed then.
+                    continue
+                self.free_slots.append(slot)
+                self.slot_freed.notify()
+            self.completed += 1
+            self.pending[seq] = (results, duration)
+            self.emit()
+
+    def emit(self):
+        # Workers finish out of order; only hand results on in sequence. A
+        # frame that is still missing after RESULT_TIMEOUT is skipped.
+        while True:
+            seq = self.next_emit
+            if seq in self.pending:
+                results, duration = self.pending.pop(seq)
+                self.on_result(seq, results, self.timestamps.pop(seq, None), duration)
+            else:
+                with self.slot_freed:
+                    entry = self.in_flight.get(seq)
+                    if entry is None or time.monotonic() - entry[1] < RESULT_TIMEOUT:
+                        return
+                    del self.in_flight[seq]
+                    owner = self.owners.pop(seq, None)
+                    self.free_slots.append(entry[0])
+                    self.slot_freed.notify()
+                self.timestamps.pop(seq, None)
+                self.lost += 1
+                print(f"Inference pool: no result for frame {seq} after {RESULT_TIMEOUT:.0f}s, skipping it")
+                if owner is not None:
+                    self.replace_hung_worker(owner, seq)
+            self.next_emit += 1
+
+    def check_workers(self):
+        # A worker that died is replaced; the frame it held is skipped by
+        # emit() once it times out.
+        self.last_check = time.monotonic()
+        for i, process in enumerate(self.processes):
+            if process.exitcode is not None and not self.closing:
+                print(f"Inference worker {process.pid} exited with code {process.exitcode}, restarting it")
+                self.processes[i] = self.start_worker()
+                self.restarts += 1
+
+    def replace_hung_worker(self, pid, seq):
+        # A worker still stuck on a frame that timed out would hold its
+        # share of the pool forever; it is killed and started afresh.
+        for i, process in enumerate(self.processes):
+            if process.pid == pid and process.exitcode is None and not self.closing:
+                print(f"Inference worker {pid} hung on frame {seq}, restarting it")
+                process.terminate()
+                process.join(timeout=5)
+                self.processes[i] = self.start_worker()
+                self.restarts += 1
+
+    def stats(self):
+        elapsed = time.perf_counter() - self.started
+        return {
+            "workers": self.workers,
+            "submitted": self.submitted,
+            "completed": self.completed,
+            "dropped": self.dropped,
+            "lost": self.lost,
+            "restarts": self.restarts,
+            "inferences_per_sec": self.completed / elapsed if elapsed > 0 else 0.0,
+        }
+
+    def close(self):
+        self.closing = True
+        for _ in self.processes:
+            self.task_queue.put(None)
+        for process in self.processes:
+            process.join(timeout=5)
+            if process.exitcode is None:
+                process.terminate()
+        self.result_queue.put(None)
+        if hasattr(self, "collector"):
+            self.collector.join(timeout=5)
+        del self.slots
+        self.shm.close()
+        self.shm.unlink()
+
+
+def main():
+    from server import CONF_THRESHOLD, IOU_THRESHOLD, MODEL_NAME, YOLO_TFLite
+
+    parser = argparse.ArgumentParser(description="Measure inference pool throughput")
+    parser.add_argument("video")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--frames", type=int, default=200)
+    parser.add_argument("--model", default=MODEL_NAME)
+    args = parser.parse_args()
+
+    cap = cv2.VideoCapture(args.video)
+    frames = []
+    while len(frames) < args.frames:
+        ret, frame = cap.read()
+        if not ret:
+            break
+        frames.append(frame)
+    cap.release()
+    if not frames:
+        print(f"Could not read frames from {args.video}")
+        return
+
+    model_kwargs = {"model_path": args.model, "conf_thres": CONF_THRESHOLD, "iou_thres": IOU_THRESHOLD}
+    for workers in args.workers:
+        done = threading.Event()
+
+        def on_result(seq, results, timestamp, duration):
+            if seq == len(frames) - 1:
+                done.set()
+
+        pool = InferencePool(YOLO_TFLite, model_kwargs, frames[0].shape, workers, on_result)
+        start = time.perf_counter()
+        for frame in frames:
+            pool.submit(frame, block=True)
+        done.wait()
+        elapsed = time.perf_counter() - start
+        pool.close()
+        print(f"{workers} workers: {len(frames) / elapsed:7.1f} frames/s")
+
+
+if __name__ == "__main__":
+    main()
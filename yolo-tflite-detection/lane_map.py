@@ -0,0 +1,129 @@
+import json
+
+import cv2
+import numpy as np
+
+GRID_STEP = 4
+# Occupancy is rasterized at this many pixels per cell; coarser than the
+# assignment grid since it only needs lane-level fractions.
+OCCUPANCY_STEP = 16
+
+
+class LaneMap:
+    # Lanes are polygons in the pixel space of a `size` (w, h) frame, each
+    # feeding one signal (several lanes may share one). They are rasterized
+    # once into a grid of signal ids, GRID_STEP pixels per cell, so a whole
+    # frame's detections are assigned with one array gather. Frames of
+    # another resolution are scaled onto the grid automatically.
+    def __init__(self, lanes, size, step=GRID_STEP):
+        self.lanes = lanes
+        self.size = tuple(size)
+        self.step = step
+        self.signals = max(lane.get("signal", n + 1) for n, lane in enumerate(lanes))
+        w, h = self.size
+        self.grid = np.full((-(-h // step), -(-w // step)), -1, dtype=np.int16)
+        # Later lanes win where polygons overlap.
+        for n, lane in enumerate(lanes):
+            points = np.round(np.array(lane["polygon"], dtype=np.float64) / step).astype(np.int32)
+            cv2.fillPoly(self.grid, [points], lane.get("signal", n + 1) - 1)
+        # The same map sampled every OCCUPANCY_STEP pixels, and the number of
+        # its cells each signal owns.
+        k = max(1, OCCUPANCY_STEP // step)
+        self.coarse = self.grid[k // 2::k, k // 2::k]
+        self.coarse_step = step * k
+        self.coarse_cells = np.bincount(self.coarse[self.coarse >= 0], minlength=self.signals)
+
+    @classmethod
+    def quadrants(cls, x_midpoint, y_midpoint, size, step=GRID_STEP):
+        # The original layout: lanes 1-4 are the four quadrants around the
+        # midpoint, top-left, top-right, bottom-left, bottom-right.
+        w, h = size
+        x, y = x_midpoint, y_midpoint
+        boxes = [(0, 0, x, y), (x, 0, w, y), (0, y, x, h), (x, y, w, h)]
+        lanes = [
+            {"name": f"lane{n + 1}", "polygon": [[x1, y1], [x2, y1], [x2, y2], [x1, y2]]}
+            for n, (x1, y1, x2, y2) in enumerate(boxes)
+        ]
+        return cls(lanes, size, step)
+
+    @classmethod
+    def load(cls, path, step=GRID_STEP):
+        # {"size": [w, h], "lanes": [{"name": ..., "signal": 1, "polygon": [[x, y], ...]}, ...]}
+        with open(path) as f:
+            config = json.load(f)
+        return cls(config["lanes"], config["size"], step)
+
+    def assign(self, boxes, frame_shape=None):
+        # Signal index (0-based, -1 for none) of each box's centre. Points
+        # outside the grid take the nearest edge cell.
+        boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+        cx = (boxes[:, 0] + boxes[:, 2]) / 2
+        cy = (boxes[:, 1] + boxes[:, 3]) / 2
+        if frame_shape is not None:
+            cx = cx * (self.size[0] / frame_shape[1])
+            cy = cy * (self.size[1] / frame_shape[0])
+        gx = np.clip((cx // self.step).astype(np.int64), 0, self.grid.shape[1] - 1)
+        gy = np.clip((cy // self.step).astype(np.int64), 0, self.grid.shape[0] - 1)
+        return self.grid[gy, gx]
+
+    def count(self, results, frame_shape=None):
+        if not results:
+            return [0] * self.signals
+        ids = self.assign([res["box"] for res in results], frame_shape)
+        return np.bincount(ids[ids >= 0], minlength=self.signals).tolist()
+
+    def occupancy(self, results, frame_shape=None):
+        # Fraction of each signal's lane area covered by at least one box.
+        # All boxes are rasterized onto the coarse grid at once: each adds +1
+        # at its top-left corner cell and -1/+1 at the others in a difference
+        # array, and two cumulative sums turn that into per-cell coverage.
+        if not results:
+            return [0.0] * self.signals
+        boxes = np.array([res["box"] for res in results], dtype=np.float64).reshape(-1, 4)
+        if frame_shape is not None:
+            boxes *= (self.size[0] / frame_shape[1], self.size[1] / frame_shape[0]) * 2
+        rows, cols = self.coarse.shape
+        x = np.clip(np.round(boxes[:, 0::2] / self.coarse_step).astype(np.int64), 0, cols)
+        y = np.clip(np.round(boxes[:, 1::2] / self.coarse_step).astype(np.int64), 0, rows)
+        diff = np.zeros((rows + 1, cols + 1), dtype=np.int32)
+        np.add.at(diff, (y[:, 0], x[:, 0]), 1)
+        np.add.at(diff, (y[:, 0], x[:, 1]), -1)
+        np.add.at(diff, (y[:, 1], x[:, 0]), -1)
+        np.add.at(diff, (y[:, 1], x[:, 1]), 1)
+        covered = diff.cumsum(axis=0).cumsum(axis=1)[:rows, :cols] > 0
+        lanes = self.coarse[covered]
+        hits = np.bincount(lanes[lanes >= 0], minlength=self.signals)
+        return (hits / np.maximum(self.coarse_cells, 1)).tolist()
+
+    def lane_of(self, box):
+        # Single-box lookup for LaneFlow; None outside every lane.
+        index = int(self.assign([box])[0])
+        return index if index >= 0 else None
+
+    def draw(self, frame, color=(255, 200, 0)):
+        sx = frame.shape[1] / self.size[0]
+        sy = frame.shape[0] / self.size[1]
+        for lane in self.lanes:
+            points = np.round(np.array(lane["polygon"], dtype=np.float64) * (sx, sy)).astype(np.int32)
+            cv2.polylines(frame, [points], True, color, 1)
+        return frame
+
+
+class OccupancyEMA:
+    # Exponential moving average of occupancy with a time constant of `tau`
+    # seconds, so the smoothing does not depend on the inference rate. tau 0
+    # passes values through.
+    def __init__(self, tau):
+        self.tau = tau
+        self.value = None
+        self.last = None
+
+    def update(self, occupancy, now):
+        occupancy = np.asarray(occupancy, dtype=np.float64)
+        if self.value is None or self.tau <= 0 or len(self.value) != len(occupancy):
+            self.value = occupancy
+        else:
+            alpha = 1 - np.exp(-max(now - self.last, 0.0) / self.tau)
+            self.value = self.value + alpha * (occupancy - self.value)
+        self.last = now
+        return self.value.tolist()
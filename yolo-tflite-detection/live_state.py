@@ -0,0 +1,153 @@
+import math
+import threading
+import time
+
+from history import PHASES
+
+# Controller posts are summarised in one log line per this many seconds
+# instead of one line per post.
+CONTROLLER_LOG_INTERVAL = 30
+MAX_LANES = 16
+MAX_PHASE_MS = 2 ** 32 - 1
+
+# active_lane uses the firmware's numbering, 1..lanes; 0 means no
+# controller has posted yet. Subtract 1 where an index is needed.
+DEFAULT_CONTROLLER = {
+    "active_lane": 0,
+    "current_phase": "UNKNOWN",
+    "phase_duration_ms": 0,
+    "current_saturation": 0.0,
+}
+
+
+def parse_controller(data, lanes=MAX_LANES):
+    # Validates an /esp_update body into the fixed controller schema. Unknown
+    # keys are dropped; a missing, mistyped or out-of-range field raises
+    # ValueError naming it.
+    if not isinstance(data, dict):
+        raise ValueError("body must be a JSON object")
+    lane = data.get("active_lane")
+    if isinstance(lane, bool) or not isinstance(lane, int) or not 1 <= lane <= lanes:
+        raise ValueError(f"active_lane must be an integer in 1..{lanes}")
+    phase = data.get("current_phase")
+    if phase not in PHASES:
+        raise ValueError(f"current_phase must be one of {', '.join(PHASES)}")
+    duration = data.get("phase_duration_ms")
+    if isinstance(duration, bool) or not isinstance(duration, int) or not 0 <= duration <= MAX_PHASE_MS:
+        raise ValueError("phase_duration_ms must be a non-negative integer")
+    saturation = data.get("current_saturation")
+    if isinstance(saturation, bool) or not isinstance(saturation, (int, float)) or not math.isfinite(saturation) \
+            or saturation < 0:
+        raise ValueError("current_saturation must be a non-negative number")
+    return {
+        "active_lane": lane,
+        "current_phase": phase,
+        "phase_duration_ms": duration,
+        "current_saturation": float(saturation),
+    }
+
+
+class Snapshot:
+    # One published view of the intersection. Never modified after it is
+    # built: writers make a new one and swap the reference, so a reader that
+    # took `state.current` sees counts and controller data that belong
+    # together, without taking a lock.
+    #   version        bumped when the counts change (the /traffic ETag)
+    #   counts         {"laneN_count": ...} plus tracker fields, if any
+    #   captured_at    wall time of the frame behind the counts, or None
+    #   controller     the last valid controller post (DEFAULT_CONTROLLER)
+    #   controller_at  wall time that post arrived, or None
+    #   controller_seq bumped on every accepted controller post
+    __slots__ = ("version", "counts", "captured_at", "controller", "controller_at", "controller_seq")
+
+    def __init__(self, version, counts, captured_at, controller, controller_at, controller_seq):
+        self.version = version
+        self.counts = counts
+        self.captured_at = captured_at
+        self.controller = controller
+        self.controller_at = controller_at
+        self.controller_seq = controller_seq
+
+    def replace(self, **changes):
+        fields = {name: getattr(self, name) for name in self.__slots__}
+        fields.update(changes)
+        return Snapshot(**fields)
+
+
+class LiveState:
+    # Holds the current Snapshot. Writers (the inference thread and the
+    # controller posts) serialise on a small lock among themselves; readers
+    # only load `current`, which is a single reference and always complete.
+    def __init__(self, lanes=4, name=None):
+        self.lanes = lanes
+        self.name = name
+        counts = {f"lane{n + 1}_count": 0 for n in range(lanes)}
+        self.current = Snapshot(0, counts, None, dict(DEFAULT_CONTROLLER), None, 0)
+        self.write_lock = threading.Lock()
+        self.accepted = 0
+        self.rejected = {}
+        self.last_log = time.monotonic()
+
+    def publish_counts(self, counts, captured_at=None):
+        # Returns True if the counts changed (and the version was bumped).
+        with self.write_lock:
+            current = self.current
+            changed = counts != current.counts
+            if not changed and captured_at is None:
+                return False
+            self.current = current.replace(
+                version=current.version + changed,
+                counts=dict(counts) if changed else current.counts,
+                captured_at=current.captured_at if captured_at is None else captured_at,
+            )
+        return changed
+
+    def update_controller(self, data, now=None):
+        # Validates and publishes a controller post; raises ValueError if it
+        # is rejected.
+        now = time.time() if now is None else now
+        try:
+            controller = parse_controller(data, max(self.lanes, 1))
+        except ValueError as e:
+            with self.write_lock:
+                reason = str(e).split(" ", 1)[0]
+                self.rejected[reason] = self.rejected.get(reason, 0) + 1
+            self.maybe_log()
+            raise
+        with self.write_lock:
+            current = self.current
+            self.current = current.replace(
+                controller=controller, controller_at=now, controller_seq=current.controller_seq + 1
+            )
+            self.accepted += 1
+        self.maybe_log()
+        return controller
+
+    def maybe_log(self):
+        if time.monotonic() - self.last_log < CONTROLLER_LOG_INTERVAL:
+            return
+        with self.write_lock:
+            elapsed = time.monotonic() - self.last_log
+            if elapsed < CONTROLLER_LOG_INTERVAL:
+                return
+            accepted, rejected = self.accepted, self.rejected
+            self.accepted, self.rejected, self.last_log = 0, {}, time.monotonic()
+            controller = self.current.controller
+        prefix = f"[{self.name}] " if self.name else ""
+        line = (f"{prefix}ESP32: {accepted} updates in {elapsed:.0f}s, lane {controller['active_lane']} "
+                f"{controller['current_phase']} sat {controller['current_saturation']:.2f}")
+        if rejected:
+            line += ", rejected " + ", ".join(f"{count}x {field}" for field, count in sorted(rejected.items()))
+        print(line)
+
+    def status(self, snapshot=None):
+        # The /system_status body, camera and controller from one snapshot.
+        snapshot = self.current if snapshot is None else snapshot
+        return {
+            "camera_data": snapshot.counts,
+            "controller_data": snapshot.controller,
+            "version": snapshot.version,
+            "captured_at": snapshot.captured_at,
+            "controller_updated_at": snapshot.controller_at,
+            "timestamp": time.time(),
+        }
@@ -0,0 +1,205 @@
+import argparse
+import asyncio
+import json
+import random
+import re
+import sys
+import time
+
+import numpy as np
+
+# What SmartTraffic.ino does: poll the counts every 500 ms and post its
+# status every second.
+POLL_INTERVAL = 0.5
+POST_INTERVAL = 1.0
+REQUEST_TIMEOUT = 5.0
+FPS_METRIC = re.compile(rb"^traffic_frames_inferred_total (\S+)$", re.M)
+
+
+class Connection:
+    # One HTTP/1.1 connection, reused for as long as the server keeps it open
+    # (the Flask development server closes it after every response).
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.reader = self.writer = None
+        self.opened = 0
+
+    async def request(self, method, path, body=b"", headers=None):
+        if self.writer is None:
+            self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+            self.opened += 1
+        lines = [f"{method} {path} HTTP/1.1", f"Host: {self.host}:{self.port}", f"Content-Length: {len(body)}"]
+        lines += [f"{name}: {value}" for name, value in (headers or {}).items()]
+        self.writer.write(("\r\n".join(lines) + "\r\n\r\n").encode() + body)
+        await self.writer.drain()
+
+        head = await self.reader.readuntil(b"\r\n\r\n")
+        status_line, *header_lines = head.decode("latin-1").split("\r\n")
+        status = int(status_line.split(" ", 2)[1])
+        response_headers = {}
+        for line in header_lines:
+            if line:
+                name, _, value = line.partition(":")
+                response_headers[name.strip().lower()] = value.strip()
+        length = int(response_headers.get("content-length", 0))
+        payload = await self.reader.readexactly(length) if length else b""
+        if response_headers.get("connection", "").lower() == "close" or status_line.startswith("HTTP/1.0"):
+            self.close()
+        return status, response_headers, payload
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = self.writer = None
+
+
+class Stats:
+    def __init__(self):
+        self.latencies = {}
+        self.errors = {}
+        self.statuses = {}
+
+    def record(self, name, seconds, status):
+        self.latencies.setdefault(name, []).append(seconds)
+        key = (name, status)
+        self.statuses[key] = self.statuses.get(key, 0) + 1
+
+    def error(self, name):
+        self.errors[name] = self.errors.get(name, 0) + 1
+
+    def report(self, duration):
+        report = {}
+        for name in sorted(set(self.latencies) | set(self.errors)):
+            ms = np.array(self.latencies.get(name, [0.0])) * 1000
+            report[name] = {
+                "requests": len(self.latencies.get(name, [])),
+                "errors": self.errors.get(name, 0),
+                "per_second": round(len(self.latencies.get(name, [])) / duration, 1),
+                "statuses": {str(status): count for (n, status), count in sorted(self.statuses.items()) if n == name},
+                "p50_ms": round(float(np.percentile(ms, 50)), 2),
+                "p95_ms": round(float(np.percentile(ms, 95)), 2),
+                "p99_ms": round(float(np.percentile(ms, 99)), 2),
+                "max_ms": round(float(ms.max()), 2),
+            }
+        return report
+
+
+async def timed(stats, name, conn, method, path, body=b"", headers=None):
+    start = time.perf_counter()
+    try:
+        response = await asyncio.wait_for(conn.request(method, path, body, headers), REQUEST_TIMEOUT)
+    except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, ValueError):
+        conn.close()
+        stats.error(name)
+        return None
+    stats.record(name, time.perf_counter() - start, response[0])
+    return response
+
+
+async def controller(number, host, port, stats, stop_at, connections):
+    conn = Connection(host, port)
+    connections.append(conn)
+    loop = asyncio.get_running_loop()
+    etag = None
+    # Controllers boot at random moments, not in lockstep.
+    next_poll = loop.time() + random.uniform(0, POLL_INTERVAL)
+    next_post = loop.time() + random.uniform(0, POST_INTERVAL)
+    while loop.time() < stop_at:
+        await asyncio.sleep(max(0.0, min(next_poll, next_post) - loop.time()))
+        now = loop.time()
+        if now >= next_poll:
+            next_poll += POLL_INTERVAL
+            response = await timed(stats, "GET /traffic", conn, "GET", "/traffic",
+                                   headers={"If-None-Match": etag} if etag else None)
+            if response is not None and response[0] == 200:
+                etag = response[1].get("etag")
+        if now >= next_post:
+            next_post += POST_INTERVAL
+            body = json.dumps({
+                "active_lane": number % 4 + 1,
+                "current_phase": "ADAPTIVE_GREEN",
+                "phase_duration_ms": int(now * 1000) % 30000,
+                "current_saturation": round(random.random(), 2),
+            }).encode()
+            await timed(stats, "POST /esp_update", conn, "POST", "/esp_update", body,
+                        {"Content-Type": "application/json"})
+    conn.close()
+
+
+async def inferred_frames(host, port):
+    conn = Connection(host, port)
+    try:
+        status, _, payload = await asyncio.wait_for(conn.request("GET", "/metrics"), REQUEST_TIMEOUT)
+    finally:
+        conn.close()
+    match = FPS_METRIC.search(payload)
+    if status != 200 or match is None:
+        raise SystemExit("No traffic_frames_inferred_total in /metrics; is the camera server running?")
+    return float(match.group(1)), time.perf_counter()
+
+
+async def run(args):
+    # Inference FPS with no load, then while the controllers run. Progress
+    # goes to stderr when the report itself is written to stdout.
+    log = sys.stderr if args.json == "-" else sys.stdout
+    frames, start = await inferred_frames(args.host, args.port)
+    await asyncio.sleep(args.baseline)
+    frames_after, end = await inferred_frames(args.host, args.port)
+    baseline_fps = (frames_after - frames) / (end - start)
+    print(f"Baseline: {baseline_fps:.1f} inferences/s over {args.baseline:.0f}s", file=log)
+
+    stats = Stats()
+    connections = []
+    loop = asyncio.get_running_loop()
+    stop_at = loop.time() + args.duration
+    print(f"Running {args.controllers} controllers for {args.duration:.0f}s...", file=log)
+    tasks = [asyncio.create_task(controller(n, args.host, args.port, stats, stop_at, connections))
+             for n in range(args.controllers)]
+    # Let every controller connect before measuring FPS under load.
+    await asyncio.sleep(min(2.0, args.duration / 4))
+    frames, start = await inferred_frames(args.host, args.port)
+    await asyncio.gather(*tasks)
+    frames_after, end = await inferred_frames(args.host, args.port)
+    load_fps = (frames_after - frames) / (end - start)
+
+    report = {
+        "controllers": args.controllers,
+        "duration_s": args.duration,
+        "connections_opened": sum(conn.opened for conn in connections),
+        "baseline_fps": round(baseline_fps, 2),
+        "load_fps": round(load_fps, 2),
+        "fps_drop_pct": round(100 * (1 - load_fps / baseline_fps), 1) if baseline_fps else None,
+        "endpoints": stats.report(args.duration),
+    }
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate many ESP32 controllers against the camera server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5000)
+    parser.add_argument("-n", "--controllers", type=int, default=100)
+    parser.add_argument("--duration", type=float, default=30.0, help="seconds of load")
+    parser.add_argument("--baseline", type=float, default=10.0, help="seconds to measure FPS without load")
+    parser.add_argument("--json", help="write the report to this file ('-' for stdout)")
+    args = parser.parse_args()
+
+    report = asyncio.run(run(args))
+    if args.json == "-":
+        json.dump(report, sys.stdout, indent=2)
+        print()
+        return
+    print(f"Inference: {report['baseline_fps']:.1f} -> {report['load_fps']:.1f} FPS under load "
+          f"({report['fps_drop_pct']}% drop), {report['connections_opened']} connections opened")
+    print(f"{'endpoint':>18} {'req/s':>7} {'errors':>6} {'p50':>8} {'p95':>8} {'p99':>8} {'max':>8}  (ms)")
+    for name, stats in report["endpoints"].items():
+        print(f"{name:>18} {stats['per_second']:7.1f} {stats['errors']:6d} {stats['p50_ms']:8.2f} "
+              f"{stats['p95_ms']:8.2f} {stats['p99_ms']:8.2f} {stats['max_ms']:8.2f}")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+import time
+
+import cv2
+
+MOTION_WIDTH = 160
+MOTION_THRESHOLD = 4.0
+MAX_STALENESS = 2.0
+INFERENCE_BUDGET = 0.5
+
+
+class MotionGate:
+    # Decides per frame whether a full model.detect() is worth running by
+    # comparing a small grayscale copy of the frame against the last frame
+    # that was actually inferred, one score per lane quadrant.
+    def __init__(
+        self,
+        split=None,
+        top=0,
+        threshold=MOTION_THRESHOLD,
+        max_staleness=MAX_STALENESS,
+        budget=INFERENCE_BUDGET,
+        width=MOTION_WIDTH,
+    ):
+        self.split = split
+        self.top = top
+        self.threshold = threshold
+        self.max_staleness = max_staleness
+        self.budget = budget
+        self.width = width
+
+        self.reference = None
+        self.candidate = None
+        self.slices = None
+        self.slices_shape = None
+        self.last_inference = 0.0
+        self.inference_time = 0.0
+        self.timed = 0
+
+        self.runs = 0
+        self.skipped = 0
+        self.reasons = {"first": 0, "motion": 0, "stale": 0, "budget": 0, "static": 0}
+        self.last_scores = []
+
+    def downsample(self, frame):
+        h, w = frame.shape[:2]
+        small_h = max(1, int(round(h * self.width / w)))
+        small = cv2.resize(frame, (self.width, small_h), interpolation=cv2.INTER_AREA)
+        if small.ndim == 3:
+            small = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+        return small
+
+    def region_slices(self, frame_shape, small_shape):
+        if self.slices_shape != (frame_shape, small_shape):
+            h, w = frame_shape[:2]
+            scale_y, scale_x = small_shape[0] / h, small_shape[1] / w
+            x_mid, y_mid = self.split if self.split else (w / 2, h / 2)
+            top = min(int(self.top * scale_y), small_shape[0] - 1)
+            cx = min(max(int(x_mid * scale_x), 1), small_shape[1] - 1)
+            cy = min(max(int(y_mid * scale_y), top + 1), small_shape[0] - 1)
+            self.slices = [
+                (slice(top, cy), slice(0, cx)),
+                (slice(top, cy), slice(cx, None)),
+                (slice(cy, None), slice(0, cx)),
+                (slice(cy, None), slice(cx, None)),
+            ]
+            self.slices_shape = (frame_shape, small_shape)
+        return self.slices
+
+    def decide(self, frame, now):
+        small = self.downsample(frame)
+        self.candidate = small
+        if self.reference is None or self.reference.shape != small.shape:
+            return "first"
+
+        elapsed = now - self.last_inference
+        if elapsed < self.inference_time / self.budget:
+            return "budget"
+        if elapsed >= self.max_staleness:
+            return "stale"
+
+        diff = cv2.absdiff(small, self.reference)
+        self.last_scores = [float(diff[rows, cols].mean()) for rows, cols in self.region_slices(frame.shape, small.shape)]
+        if max(self.last_scores) >= self.threshold:
+            return "motion"
+        return "static"
+
+    def should_infer(self, frame, now=None):
+        now = time.monotonic() if now is None else now
+        reason = self.decide(frame, now)
+        self.reasons[reason] += 1
+        if reason in ("budget", "static"):
+            self.skipped += 1
+            return False
+        return True
+
+    def record(self, duration=None, now=None):
+        # Called once the frame passed by should_infer() has been inferred,
+        # or only handed on (the inference pool): its duration then follows
+        # through record_duration() when the result is in.
+        self.reference = self.candidate
+        self.last_inference = time.monotonic() if now is None else now
+        self.runs += 1
+        if duration is not None:
+            self.record_duration(duration)
+
+    def record_duration(self, duration):
+        self.inference_time = duration if self.timed == 0 else 0.8 * self.inference_time + 0.2 * duration
+        self.timed += 1
+
+    def stats(self):
+        total = self.runs + self.skipped
+        return {
+            "inferences_run": self.runs,
+            "inferences_skipped": self.skipped,
+            "skip_ratio": self.skipped / total if total else 0.0,
+            "reasons": dict(self.reasons),
+            "last_motion_scores": self.last_scores,
+            "avg_inference_ms": self.inference_time * 1000,
+        }
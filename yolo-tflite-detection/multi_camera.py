@@ -0,0 +1,284 @@
+import argparse
+import json
+import os
+import threading
+import time
+
+import cv2
+from flask import jsonify, request
+
+from lane_map import LaneMap, OccupancyEMA
+from live_state import LiveState
+from server import (
+    CONF_THRESHOLD,
+    IOU_THRESHOLD,
+    MODEL_NAME,
+    SKY_LINE,
+    FRAME_SIZE,
+    X_MIDPOINT,
+    Y_MIDPOINT,
+    YOLO_TFLite,
+    app,
+    count_lanes,
+    lane_occupancy,
+    notify_traffic,
+    run_server,
+    stream_resolver,
+    traffic_changed,
+    traffic_response,
+    traffic_stream,
+)
+
+RECONNECT_DELAY = 2
+# /traffic/stream is matched before /traffic/<camera_id>.
+RESERVED_IDS = {"stream"}
+# Routes of the single-camera server and their per-camera form here.
+SINGLE_CAMERA_ROUTES = {
+    "/traffic": "/traffic/<camera_id>",
+    "/traffic/stream": "/traffic/<camera_id>/stream",
+    "/esp_update": "/esp_update/<camera_id>",
+    "/system_status": "/system_status/<camera_id>",
+}
+
+cameras = {}
+
+
+class Camera:
+    def __init__(self, config):
+        self.id = str(config["id"])
+        if self.id in RESERVED_IDS:
+            raise ValueError(f"Camera id '{self.id}' is reserved; /traffic/{self.id} is another route")
+        self.source = config.get("source")
+        self.page_url = config.get("page_url")
+        self.sky_line = config.get("sky_line", SKY_LINE)
+        if config.get("lanes"):
+            self.lane_map = LaneMap.load(config["lanes"])
+        else:
+            self.lane_map = LaneMap.quadrants(
+                config.get("x_midpoint", X_MIDPOINT),
+                config.get("y_midpoint", Y_MIDPOINT),
+                config.get("size", FRAME_SIZE),
+            )
+        if not self.source and not self.page_url:
+            raise ValueError(f"Camera {self.id} needs a 'source' or a 'page_url'")
+
+        self.state = LiveState(self.lane_map.signals, name=self.id)
+        smoothing = config.get("occupancy_smoothing", 0)
+        self.occupancy_ema = OccupancyEMA(smoothing) if smoothing > 0 else None
+        self.frame = None
+        self.captured_at = None
+        self.frame_lock = threading.Lock()
+
+    def open_capture(self, attempt=0):
+        source = self.source
+        if not source:
+            source = stream_resolver.get(self.page_url, force=attempt > 0)
+            if not source:
+                return None
+        cap = cv2.VideoCapture(source)
+        if not cap.isOpened():
+            return None
+        cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+        return cap
+
+    def capture_loop(self):
+        is_file = bool(self.source) and os.path.isfile(self.source)
+        cap = None
+        failed_opens = 0
+        while True:
+            if cap is None:
+                cap = self.open_capture(failed_opens)
+                if cap is None:
+                    print(f"[{self.id}] Source not available, retrying...")
+                    failed_opens += 1
+                    time.sleep(RECONNECT_DELAY)
+                    continue
+                failed_opens = 0
+                fps = cap.get(cv2.CAP_PROP_FPS)
+                frame_interval = 1 / fps if 0 < fps <= 60 else 1 / 30
+
+            start = time.time()
+            ret, frame = cap.read()
+            if not ret:
+                if is_file:
+                    cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+                    continue
+                print(f"[{self.id}] Connection lost, reconnecting...")
+                cap.release()
+                cap = None
+                continue
+            # Wall time the frame came off the stream, as in FrameSource; it
+            # travels with the frame so the published age includes decode and
+            # scheduler queueing.
+            captured_at = time.time()
+
+            # Only the newest frame matters; older ones are simply replaced.
+            with self.frame_lock:
+                self.frame = frame
+                self.captured_at = captured_at
+
+            if is_file:
+                sleep_time = frame_interval - (time.time() - start)
+                if sleep_time > 0:
+                    time.sleep(sleep_time)
+
+    def take_frame(self):
+        # (frame, captured_at); frame is None if no new frame is waiting.
+        with self.frame_lock:
+            frame, self.frame = self.frame, None
+            return frame, self.captured_at
+
+    @property
+    def ready(self):
+        # Counts from a real frame have been published.
+        return self.state.current.captured_at is not None
+
+    def publish(self, results, captured_at):
+        counts = count_lanes(results, self.lane_map)
+        state = {f"lane{n + 1}_count": count for n, count in enumerate(counts)}
+        state.update(lane_occupancy(results, time.monotonic(), self.lane_map, self.occupancy_ema))
+        first = not self.ready
+        if self.state.publish_counts(state, captured_at) or first:
+            with traffic_changed:
+                notify_traffic()
+
+
+class InferenceScheduler:
+    # A fixed set of interpreters serves every camera. Each interpreter thread
+    # takes the next camera (round-robin) that has a fresh frame waiting.
+    def __init__(self, camera_list, model_path, interpreters):
+        self.cameras = camera_list
+        self.cursor = 0
+        self.lock = threading.Lock()
+        num_threads = max(1, (os.cpu_count() or 1) // interpreters)
+        self.models = [
+            YOLO_TFLite(model_path, conf_thres=CONF_THRESHOLD, iou_thres=IOU_THRESHOLD, num_threads=num_threads)
+            for _ in range(interpreters)
+        ]
+        for model in self.models:
+            model.warmup()
+
+    def next_job(self):
+        with self.lock:
+            for offset in range(len(self.cameras)):
+                index = (self.cursor + offset) % len(self.cameras)
+                frame, captured_at = self.cameras[index].take_frame()
+                if frame is not None:
+                    self.cursor = (index + 1) % len(self.cameras)
+                    return self.cameras[index], frame, captured_at
+        return None
+
+    def worker(self, model):
+        while True:
+            job = self.next_job()
+            if job is None:
+                time.sleep(0.01)
+                continue
+            camera, frame, captured_at = job
+            try:
+                results = model.detect(frame, sky_line=camera.sky_line)
+            except Exception as e:
+                # One bad frame must not take this interpreter away from
+                # every camera.
+                print(f"[{camera.id}] Inference failed: {e}")
+                continue
+            camera.publish(results, captured_at)
+
+    def start(self):
+        for model in self.models:
+            threading.Thread(target=self.worker, args=(model,), daemon=True).start()
+
+
+def get_camera(camera_id):
+    camera = cameras.get(camera_id)
+    if camera is None:
+        return None, (jsonify({"status": "error", "message": f"unknown camera '{camera_id}'"}), 404)
+    return camera, None
+
+
+@app.route("/cameras", methods=["GET"])
+def list_cameras():
+    return jsonify(sorted(cameras))
+
+
+def single_camera_route():
+    # The single-camera routes would serve a state nothing publishes to.
+    if request.path in SINGLE_CAMERA_ROUTES:
+        message = f"serving {len(cameras)} cameras; use {SINGLE_CAMERA_ROUTES[request.path]}"
+        return jsonify({"status": "error", "message": message}), 404
+    return None
+
+
+@app.route("/traffic/<camera_id>", methods=["GET"])
+def get_camera_traffic(camera_id):
+    camera, error = get_camera(camera_id)
+    if error:
+        return error
+    return traffic_response(camera.state, camera.ready)
+
+
+@app.route("/traffic/<camera_id>/stream", methods=["GET"])
+def stream_camera_traffic(camera_id):
+    camera, error = get_camera(camera_id)
+    if error:
+        return error
+    return traffic_stream(camera.state, lambda: camera.ready)
+
+
+@app.route("/esp_update/<camera_id>", methods=["POST"])
+def update_camera_esp_status(camera_id):
+    camera, error = get_camera(camera_id)
+    if error:
+        return error
+    try:
+        camera.state.update_controller(request.get_json(silent=True))
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    return jsonify({"status": "success"}), 200
+
+
+@app.route("/system_status/<camera_id>", methods=["GET"])
+def get_camera_status(camera_id):
+    camera, error = get_camera(camera_id)
+    if error:
+        return error
+    return jsonify(camera.state.status())
+
+
+def load_config(path):
+    with open(path) as f:
+        config = json.load(f)
+    camera_list = [Camera(entry) for entry in config["cameras"]]
+    ids = [camera.id for camera in camera_list]
+    if len(set(ids)) != len(ids):
+        raise ValueError("Camera ids must be unique")
+    return config, camera_list
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve many intersections from one process")
+    parser.add_argument("config", help="JSON camera config (see cameras.example.json)")
+    args = parser.parse_args()
+
+    config, camera_list = load_config(args.config)
+    cameras.update({camera.id: camera for camera in camera_list})
+    app.before_request(single_camera_route)
+
+    # Streams are looked up and opened while the interpreters load.
+    for camera in camera_list:
+        threading.Thread(target=camera.capture_loop, daemon=True).start()
+
+    interpreters = config.get("interpreters", 1)
+    scheduler = InferenceScheduler(camera_list, config.get("model", MODEL_NAME), interpreters)
+    print(f"Loaded {len(camera_list)} cameras, {interpreters} interpreters")
+
+    threading.Thread(target=run_server, daemon=True).start()
+    print("Flask Server on port 5000")
+    scheduler.start()
+
+    while True:
+        time.sleep(1)
+
+
+if __name__ == "__main__":
+    main()
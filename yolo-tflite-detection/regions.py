@@ -0,0 +1,159 @@
+import time
+
+import numpy as np
+
+TILE_OVERLAP = 0.2
+# Boxes this close to a tile edge that another tile overlaps are cut by it.
+EDGE_MARGIN = 2
+# A cut box is dropped when a box from another tile, clear of its edges,
+# covers at least this much of it. Cut boxes from different tiles that
+# overlap this much (of the smaller one) are parts of one vehicle wider
+# than the overlap, and are joined.
+SEAM_COVER = 0.5
+
+
+def parse_region(spec):
+    # "x1,y1,x2,y2" or "x1,y1,x2,y2:COLSxROWS", in stream pixels.
+    box, _, grid = spec.partition(":")
+    x1, y1, x2, y2 = (int(v) for v in box.split(","))
+    cols, rows = (int(v) for v in grid.lower().split("x")) if grid else (1, 1)
+    if x2 <= x1 or y2 <= y1 or cols < 1 or rows < 1:
+        raise ValueError(f"Bad region '{spec}'")
+    return {"box": [x1, y1, x2, y2], "tiles": [cols, rows]}
+
+
+def coverage(a, b):
+    # Fraction of each xywh box in a covered by each in b, (len(a), len(b)).
+    ix = np.minimum(a[:, None, 0] + a[:, None, 2], b[None, :, 0] + b[None, :, 2]) \
+        - np.maximum(a[:, None, 0], b[None, :, 0])
+    iy = np.minimum(a[:, None, 1] + a[:, None, 3], b[None, :, 1] + b[None, :, 3]) \
+        - np.maximum(a[:, None, 1], b[None, :, 1])
+    inter = np.clip(ix, 0, None) * np.clip(iy, 0, None)
+    return inter / np.maximum(a[:, 2] * a[:, 3], 1)[:, None]
+
+
+def join_cut_boxes(boxes, confidences, class_ids, tile, cut):
+    # Resolves boxes cut by a tile edge: dropped if another tile saw the
+    # vehicle whole, otherwise joined with the other cut parts of it into
+    # their bounding box (with the best confidence of the parts).
+    if not cut.any():
+        return boxes, confidences, class_ids
+    cut_idx = np.flatnonzero(cut)
+    whole_idx = np.flatnonzero(~cut)
+    if len(whole_idx):
+        covered = coverage(boxes[cut_idx], boxes[whole_idx]) >= SEAM_COVER
+        covered &= tile[cut_idx][:, None] != tile[whole_idx][None, :]
+        cut_idx = cut_idx[~covered.any(axis=1)]
+
+    parts = boxes[cut_idx]
+    c = coverage(parts, parts)
+    linked = (np.maximum(c, c.T) >= SEAM_COVER) & (tile[cut_idx][:, None] != tile[cut_idx][None, :])
+    group = np.arange(len(cut_idx))
+    for i, j in zip(*np.nonzero(np.triu(linked))):
+        group[group == group[j]] = group[i]
+
+    joined, joined_conf, joined_class = [], [], []
+    for g in np.unique(group):
+        members = cut_idx[group == g]
+        x1, y1 = boxes[members, :2].min(axis=0)
+        x2, y2 = (boxes[members, :2] + boxes[members, 2:]).max(axis=0)
+        best = members[np.argmax(confidences[members])]
+        joined.append([x1, y1, x2 - x1, y2 - y1])
+        joined_conf.append(confidences[best])
+        joined_class.append(class_ids[best])
+    boxes = np.concatenate([boxes[whole_idx], np.array(joined, dtype=boxes.dtype).reshape(-1, 4)])
+    confidences = np.concatenate([confidences[whole_idx], joined_conf])
+    class_ids = np.concatenate([class_ids[whole_idx], np.array(joined_class, dtype=class_ids.dtype)])
+    return boxes, confidences, class_ids
+
+
+def split_span(start, end, count, overlap):
+    if count == 1:
+        return [(start, end)]
+    size = (end - start) / (count - (count - 1) * overlap)
+    step = size * (1 - overlap)
+    spans = [(int(round(start + i * step)), int(round(start + i * step + size))) for i in range(count)]
+    spans[-1] = (spans[-1][0], end)
+    return spans
+
+
+class RegionDetector:
+    # Runs the model on each configured region (optionally split into
+    # overlapping tiles) instead of on the whole frame, so the model input
+    # is spent on the road. Boxes are shifted back to frame coordinates and
+    # merged with one NMS across all tiles. Exposes the same detect() as
+    # YOLO_TFLite, so it can stand in for it (also in the inference pool).
+    def __init__(self, regions, model=None, model_cls=None, scale=1.0, overlap=TILE_OVERLAP, **model_kwargs):
+        self.model = model if model is not None else model_cls(**model_kwargs)
+        self.regions = regions
+        self.scale = scale
+        self.overlap = overlap
+        self.tile_cache = {}
+
+    def tiles(self, shape):
+        # (x1, y1, x2, y2, inner_edges) per tile, clipped to the frame;
+        # inner_edges flags the left/top/right/bottom sides shared with
+        # another tile.
+        tiles = self.tile_cache.get(shape)
+        if tiles is None:
+            h, w = shape
+            tiles = []
+            for region in self.regions:
+                x1, y1, x2, y2 = (int(round(v * self.scale)) for v in region["box"])
+                x1, x2 = max(0, x1), min(w, x2)
+                y1, y2 = max(0, y1), min(h, y2)
+                if x2 <= x1 or y2 <= y1:
+                    continue
+                cols, rows = region["tiles"]
+                for row, (ty1, ty2) in enumerate(split_span(y1, y2, rows, self.overlap)):
+                    for col, (tx1, tx2) in enumerate(split_span(x1, x2, cols, self.overlap)):
+                        inner = (col > 0, row > 0, col < cols - 1, row < rows - 1)
+                        tiles.append((tx1, ty1, tx2, ty2, inner))
+            self.tile_cache[shape] = tiles
+        return tiles
+
+    def warmup(self, shape):
+        start = time.perf_counter()
+        self.detect(np.zeros(shape, dtype=np.uint8))
+        return time.perf_counter() - start
+
+    def detect(self, image, sky_line=None):
+        model = self.model
+        sky_line = model.sky_line if sky_line is None else sky_line
+        all_boxes, all_confidences, all_class_ids, all_tiles, all_cut = [], [], [], [], []
+        for index, (x1, y1, x2, y2, inner) in enumerate(self.tiles(image.shape[:2])):
+            output_data, ratio, pad_w, pad_h = model.run(image[y1:y2, x1:x2])
+            # The sky line is in frame coordinates; it is applied below.
+            boxes, confidences, class_ids = model.decode(output_data, ratio, pad_w, pad_h, sky_line=-np.inf)
+            # A view of the output tensor; it must be gone before the next
+            # tile's run() invokes the interpreter.
+            del output_data
+            if not boxes:
+                continue
+            boxes = np.array(boxes, dtype=np.int64)
+            # Boxes touching an edge shared with another tile may be only
+            # part of a vehicle; they are resolved across tiles below.
+            cut = np.zeros(len(boxes), dtype=bool)
+            if inner[0]:
+                cut |= boxes[:, 0] <= EDGE_MARGIN
+            if inner[1]:
+                cut |= boxes[:, 1] <= EDGE_MARGIN
+            if inner[2]:
+                cut |= boxes[:, 0] + boxes[:, 2] >= (x2 - x1) - EDGE_MARGIN
+            if inner[3]:
+                cut |= boxes[:, 1] + boxes[:, 3] >= (y2 - y1) - EDGE_MARGIN
+            boxes[:, 0] += x1
+            boxes[:, 1] += y1
+            all_boxes.append(boxes)
+            all_confidences.append(np.array(confidences))
+            all_class_ids.append(np.array(class_ids))
+            all_tiles.append(np.full(len(boxes), index))
+            all_cut.append(cut)
+
+        if not all_boxes:
+            return []
+        boxes, confidences, class_ids = join_cut_boxes(
+            np.concatenate(all_boxes), np.concatenate(all_confidences), np.concatenate(all_class_ids),
+            np.concatenate(all_tiles), np.concatenate(all_cut))
+        below_sky = boxes[:, 1] >= sky_line
+        return model.nms(boxes[below_sky].tolist(), confidences[below_sky].tolist(), class_ids[below_sky].tolist())
@@ -0,0 +1,156 @@
+import argparse
+import csv
+import os
+import time
+
+import cv2
+import numpy as np
+
+from bench_pipeline import StubInterpreter
+from detection_cache import RECORD_CONF, DetectionCache, cache_key
+from lane_map import LaneMap
+from server import CONF_THRESHOLD, FRAME_SIZE, IOU_THRESHOLD, MODEL_NAME, SKY_LINE, X_MIDPOINT, Y_MIDPOINT, YOLO_TFLite
+from tracker import LaneFlow, Tracker
+
+VIDEO_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "intersection.mp4")
+# Newly inferred frames are written out this often, so an interrupted
+# recording resumes where it stopped.
+SAVE_EVERY = 500
+
+
+def open_video(path):
+    cap = cv2.VideoCapture(path)
+    if not cap.isOpened():
+        raise SystemExit(f"Could not open {path}")
+    fps = cap.get(cv2.CAP_PROP_FPS)
+    if fps <= 0 or fps > 60:
+        fps = 30
+    return cap, fps
+
+
+def video_frames(cap, fps):
+    index = 0
+    while True:
+        ret, image = cap.read()
+        if not ret:
+            break
+        yield index, index / fps, image
+        index += 1
+
+
+def cached_frames(cache):
+    # Replays straight from the cache without decoding the video.
+    for index in cache.frames():
+        yield index, cache.get(index)[0], None
+
+
+def annotate(frame, results, lanes, counts):
+    for res in results:
+        x1, y1, x2, y2 = map(int, res['box'])
+        cv2.rectangle(frame, (x1, y1), (x2, y2), (0, 255, 0), 2)
+        cv2.putText(frame, f"{int(res['conf']*100)}%", (x1, y1 - 10), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 255, 0), 2)
+    lanes.draw(frame)
+    text = " ".join(f"L{n + 1}:{count}" for n, count in enumerate(counts))
+    cv2.putText(frame, text, (50, 90), cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 255, 0), 2)
+    return frame
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Count lanes from cached detections, inferring only uncached frames")
+    parser.add_argument("video", nargs="?", default=VIDEO_PATH)
+    parser.add_argument("--cache", help="detection cache file (default: <video>.detections.npz)")
+    parser.add_argument("--model", default=MODEL_NAME)
+    parser.add_argument("--stub", action="store_true", help="use the benchmark's synthetic interpreter")
+    parser.add_argument("--threads", type=int, help="interpreter threads (default: autotune)")
+    parser.add_argument("--record-conf", type=float, default=RECORD_CONF,
+                        help="lowest confidence kept when recording")
+    parser.add_argument("--conf", type=float, default=CONF_THRESHOLD)
+    parser.add_argument("--iou", type=float, default=IOU_THRESHOLD)
+    parser.add_argument("--sky-line", type=float, default=SKY_LINE)
+    parser.add_argument("--lanes", help="lane polygons JSON (default: quadrants)")
+    parser.add_argument("--track", action="store_true", help="count confirmed tracks, report flow and queues")
+    parser.add_argument("--max-frames", type=int)
+    parser.add_argument("--csv", help="write per-frame lane counts here")
+    parser.add_argument("--annotate", help="write an annotated video here (decodes the video)")
+    args = parser.parse_args()
+
+    if args.conf < args.record_conf:
+        parser.error("--conf must not be below --record-conf")
+    cache_path = args.cache or os.path.splitext(args.video)[0] + ".detections.npz"
+    key = cache_key(None if args.stub else args.model, args.video, args.record_conf)
+    cache = DetectionCache.open(cache_path, key, args.record_conf)
+    print(f"{cache_path}: {len(cache)} frames cached" + (" (complete)" if cache.complete else ""))
+
+    lanes = LaneMap.load(args.lanes) if args.lanes else LaneMap.quadrants(X_MIDPOINT, Y_MIDPOINT, FRAME_SIZE)
+    tracker = Tracker() if args.track else None
+    lane_flow = LaneFlow(lanes.lane_of, lanes=lanes.signals) if args.track else None
+
+    model = None
+    writer = None
+    cap = None
+    rows = []
+    totals = np.zeros(lanes.signals)
+    processed = inferred = 0
+    if args.annotate or not cache.complete:
+        cap, fps = open_video(args.video)
+        frames = video_frames(cap, fps)
+    else:
+        frames = cached_frames(cache)
+    if args.annotate:
+        width, height = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)), int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        writer = cv2.VideoWriter(args.annotate, cv2.VideoWriter_fourcc(*"mp4v"), fps, (width, height))
+
+    start = time.perf_counter()
+    for index, t, image in frames:
+        if args.max_frames and processed >= args.max_frames:
+            break
+        results = cache.results(index, args.conf, args.iou, args.sky_line)
+        if results is None:
+            if model is None:
+                model = YOLO_TFLite(args.model, conf_thres=args.record_conf, iou_thres=args.iou,
+                                    num_threads=args.threads, interpreter=StubInterpreter() if args.stub else None)
+            # Everything the model saw above the recording threshold, with
+            # no sky line, so later replays can move either.
+            cache.add(index, t, *model.decode(*model.run(image), sky_line=-np.inf), shape=image.shape)
+            inferred += 1
+            if inferred % SAVE_EVERY == 0:
+                cache.save()
+            results = cache.results(index, args.conf, args.iou, args.sky_line)
+
+        if tracker is not None:
+            results = tracker.update(results, t)
+        counts = lanes.count(results, image.shape if image is not None else cache.shape)
+        row = {"frame": index, "t": round(t, 3)}
+        row.update({f"lane{n + 1}_count": count for n, count in enumerate(counts)})
+        if lane_flow is not None:
+            row.update(lane_flow.update(results, t))
+        rows.append(row)
+        totals += counts
+        processed += 1
+        if writer is not None:
+            writer.write(annotate(image, results, lanes, counts))
+    else:
+        if cap is not None:
+            # The whole video was read, so the cache now knows its length.
+            cache.mark_complete(processed)
+    elapsed = time.perf_counter() - start
+    cache.save()
+    if cap is not None:
+        cap.release()
+    if writer is not None:
+        writer.release()
+
+    print(f"{processed} frames in {elapsed:.2f}s ({processed / max(elapsed, 1e-9):.0f} FPS), "
+          f"{inferred} inferred, {processed - inferred} from the cache")
+    if processed:
+        means = " ".join(f"L{n + 1}:{v:.2f}" for n, v in enumerate(totals / processed))
+        print(f"Mean vehicles per frame: {means}")
+    if args.csv and rows:
+        with open(args.csv, "w", newline="") as f:
+            out = csv.DictWriter(f, fieldnames=list(rows[0]))
+            out.writeheader()
+            out.writerows(rows)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,56 +1,182 @@
+import time
+STARTED_AT = time.perf_counter()
+import argparse
+import importlib
+import json
+import os
+import sys
 import cv2
 import threading
 import numpy as np
-import tensorflow.lite as tflite 
-from flask import Flask, jsonify, request
-from playwright.sync_api import sync_playwright
-import time
+from flask import Flask, Response, jsonify, request
+import async_http
+from frame_source import FrameSource
+from lane_map import LaneMap, OccupancyEMA
+from history import HISTORY_INTERVAL, NUMERIC_FIELDS, History
+from live_state import LiveState
+from metrics import Registry
+from stream_resolver import StreamResolver
+from inference_pool import InferencePool
+from motion_gate import MotionGate
+from regions import RegionDetector, parse_region
+from tracker import MAX_AGE, LaneFlow, Tracker, gated_max_age
 
 app = Flask(__name__)
 
+# The interpreter module is imported on first use. The standalone runtimes
+# (LiteRT, then tflite_runtime) load in a fraction of the time of full
+# TensorFlow, which is only the fallback.
+TFLITE_MODULES = ("ai_edge_litert.interpreter", "tflite_runtime.interpreter", "tensorflow.lite")
+tflite = None
+
+# Seconds from the start of this module to each startup step; served by /ready.
+startup = {"imports": round(time.perf_counter() - STARTED_AT, 3)}
+
 MODEL_NAME = 'detect_traffic_s_float32.tflite'
 CONF_THRESHOLD = 0.4               
 IOU_THRESHOLD = 0.45                
 
 PAGE_URL = "https://tv.kayseri.bel.tr/osman-kavuncu-bulvari" 
 
+INFERENCE_WORKERS = 0
+
 SKY_LINE = 200
 Y_MIDPOINT = 300
 X_MIDPOINT = 1105
+# Resolution the lane geometry is given in.
+FRAME_SIZE = (1920, 1080)
 
-traffic_state = {
-    "lane1_count": 0, "lane2_count": 0, 
-    "lane3_count": 0, "lane4_count": 0
-}
-
-esp32_state = {
-    "active_lane": 0,
-    "current_phase": "UNKNOWN",
-    "phase_duration_ms": 0,
-    "current_saturation": 0.0
-}
+# Counts and controller data, published as immutable snapshots. Its version
+# is bumped whenever the counts change; with BOOT_ID it is the /traffic ETag.
+live_state = LiveState()
+# The version restarts at 0 with the process, so the ETag also names the
+# process: a tag kept across a restart never matches the new counts.
+BOOT_ID = f"{time.time_ns():x}"
 
 detection_results = []
-detection_frame = None
 results_lock = threading.Lock()
+# Notified on every new version, to wake /traffic/stream clients.
+traffic_changed = threading.Condition()
+SSE_KEEPALIVE = 15
+# Set when serving with --http async; its streams are woken on every change.
+async_server = None
+history = None
+HISTORY_FLUSH_INTERVAL = 60
+inference_count = 0
+frame_source = None
+stream_resolver = StreamResolver()
+
+FPS_REPORT_INTERVAL = 10
+SNAPSHOT_QUALITY = 80
+
+metrics = Registry()
+inference_seconds = metrics.histogram("traffic_inference_seconds", "Time spent in model.detect()")
+frame_wait_seconds = metrics.histogram("traffic_frame_wait_seconds",
+                                       "Time from decode until the frame is handed to inference")
+frames_decoded = metrics.counter("traffic_frames_decoded_total", "Frames decoded from the stream")
+frames_inferred = metrics.counter("traffic_frames_inferred_total", "Frames run through the model")
+frames_skipped = metrics.counter("traffic_frames_skipped_total", "Frames skipped by the motion gate")
+frames_dropped = metrics.counter("traffic_frames_dropped_total", "Decoded frames never inferred", ["reason"])
+stream_reconnects = metrics.counter("traffic_stream_reconnects_total", "Times the stream was lost and reopened")
+esp_updates = metrics.counter("traffic_esp_updates_total", "Status updates received from the ESP32")
+esp_last_seen = metrics.gauge("traffic_esp_last_seen_timestamp_seconds", "Unix time of the last ESP32 update")
+http_requests = metrics.counter("traffic_http_requests_total", "HTTP requests served", ["endpoint", "status"])
+
+WARMUP_RUNS = 5
+
+def load_tflite():
+    global tflite
+    if tflite is None:
+        for name in TFLITE_MODULES:
+            try:
+                tflite = importlib.import_module(name)
+            except ImportError:
+                continue
+            print(f"TFLite runtime: {name}")
+            break
+    return tflite
+
+def mark_startup(step):
+    if step not in startup:
+        startup[step] = round(time.perf_counter() - STARTED_AT, 3)
+
+def thread_candidates():
+    cpus = os.cpu_count() or 1
+    return sorted({n for n in (1, 2, 4, cpus) if n <= cpus})
+
+def autotune_threads(model_path, runs=WARMUP_RUNS):
+    # Build one interpreter per candidate thread count and keep the one with
+    # the fastest warm invoke().
+    best = None
+    for num_threads in thread_candidates():
+        interpreter = tflite.Interpreter(model_path=model_path, num_threads=num_threads)
+        interpreter.allocate_tensors()
+        interpreter.invoke()
+        start = time.perf_counter()
+        for _ in range(runs):
+            interpreter.invoke()
+        elapsed = (time.perf_counter() - start) / runs
+        print(f"  {num_threads} threads: {elapsed * 1000:.1f} ms/invoke")
+        if best is None or elapsed < best[1]:
+            best = (num_threads, elapsed, interpreter)
+    return best[0], best[2]
 
 class YOLO_TFLite:
-    def __init__(self, model_path, conf_thres=0.5, iou_thres=0.45):
+    def __init__(self, model_path, conf_thres=0.5, iou_thres=0.45, zero_copy=True, num_threads=None, sky_line=SKY_LINE,
+                 interpreter=None):
         self.conf_thres = conf_thres
+        self.sky_line = sky_line
         self.iou_thres = iou_thres
-        try:
-            delegate = tflite.load_delegate('libmetal_delegate.dylib')
-            self.interpreter = tflite.Interpreter(model_path=model_path, experimental_delegates=[delegate])
-            print("GPU (Metal) delegate loaded!")
-        except:
-            self.interpreter = tflite.Interpreter(model_path=model_path, num_threads=4)
-            print("Using CPU with 4 threads")
+        self.conf_logit = np.log(conf_thres / (1 - conf_thres))
+        # An interpreter can be passed in (e.g. a stub for benchmarks).
+        self.interpreter = interpreter
+        if self.interpreter is None and load_tflite() is None:
+            raise ImportError("No TFLite runtime installed (ai-edge-litert, tflite-runtime or tensorflow)")
+        if self.interpreter is None and sys.platform == 'darwin':
+            try:
+                delegate = tflite.load_delegate('libmetal_delegate.dylib')
+                self.interpreter = tflite.Interpreter(model_path=model_path, experimental_delegates=[delegate])
+                print("GPU (Metal) delegate loaded!")
+            except (ValueError, OSError):
+                pass
+        if self.interpreter is None:
+            # The default op resolver already routes supported ops (float32,
+            # float16 and int8) through XNNPACK on CPU.
+            if num_threads is None:
+                print("Tuning interpreter threads...")
+                num_threads, self.interpreter = autotune_threads(model_path)
+            else:
+                self.interpreter = tflite.Interpreter(model_path=model_path, num_threads=num_threads)
+            print(f"Using CPU (XNNPACK) with {num_threads} threads")
+        self.num_threads = num_threads
         self.interpreter.allocate_tensors()
         self.input_details = self.interpreter.get_input_details()[0]
         self.output_details = self.interpreter.get_output_details()[0]
         self.input_shape = self.input_details['shape'] 
         self.input_h = self.input_shape[1]
         self.input_w = self.input_shape[2]
+        self.zero_copy = zero_copy
+        self.input_tensor = self.interpreter.tensor(self.input_details['index'])
+        self.output_tensor = self.interpreter.tensor(self.output_details['index'])
+        self.letterbox_cache = {}
+        self.canvas = np.full((self.input_h, self.input_w, 3), 114, dtype=np.uint8)
+        self.rgb_canvas = np.empty_like(self.canvas)
+        self.canvas_shape = None
+
+        # Map every 8-bit pixel value to its model input value once, folding
+        # the /255 scaling and any input quantization into one table.
+        self.input_dtype = self.input_details['dtype']
+        levels = np.arange(256, dtype=np.float32) / 255.0
+        if np.issubdtype(self.input_dtype, np.integer):
+            in_scale, in_zero = self.input_details['quantization']
+            info = np.iinfo(self.input_dtype)
+            levels = np.clip(np.round(levels / in_scale + in_zero), info.min, info.max)
+        self.input_lut = levels.astype(self.input_dtype)
+
+        self.output_quantized = np.issubdtype(self.output_details['dtype'], np.integer)
+        out_scale, out_zero = self.output_details['quantization']
+        self.output_scale = np.float32(out_scale)
+        self.output_zero = np.float32(out_zero)
     
     def sigmoid(self, x):
         return 1 / (1 + np.exp(-np.clip(x, -500, 500)))
@@ -69,206 +195,641 @@ class YOLO_TFLite:
         img = cv2.copyMakeBorder(img, top, bottom, left, right, cv2.BORDER_CONSTANT, value=color)
         return img, (r, r), (dw, dh)
 
-    def detect(self, image):
+    def letterbox_geometry(self, shape):
+        geometry = self.letterbox_cache.get(shape)
+        if geometry is None:
+            r = min(self.input_h / shape[0], self.input_w / shape[1])
+            new_unpad = int(round(shape[1] * r)), int(round(shape[0] * r))
+            dw = (self.input_w - new_unpad[0]) / 2
+            dh = (self.input_h - new_unpad[1]) / 2
+            top, left = int(round(dh - 0.1)), int(round(dw - 0.1))
+            geometry = (r, new_unpad, dw, dh, top, left)
+            self.letterbox_cache[shape] = geometry
+        return geometry
+
+    def preprocess(self, image):
         img_rgb = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
         img_resized, ratio, (pad_w, pad_h) = self.letterbox(img_rgb, (self.input_w, self.input_h))
-        input_data = (img_resized / 255.0).astype(np.float32)
+        input_data = self.input_lut[img_resized]
         input_data = np.expand_dims(input_data, axis=0)
-        self.interpreter.set_tensor(self.input_details['index'], input_data)
+        return input_data, ratio, (pad_w, pad_h)
+
+    def preprocess_into(self, image, out):
+        # Letterbox into the persistent canvas, then write the RGB input
+        # values straight into `out` (normally the interpreter's input view).
+        shape = image.shape[:2]
+        r, new_unpad, dw, dh, top, left = self.letterbox_geometry(shape)
+        if self.canvas_shape != shape:
+            self.canvas[:] = 114
+            self.canvas_shape = shape
+        region = self.canvas[top:top + new_unpad[1], left:left + new_unpad[0]]
+        if shape[::-1] != new_unpad:
+            cv2.resize(image, new_unpad, dst=region, interpolation=cv2.INTER_LINEAR)
+        else:
+            region[:] = image
+        cv2.cvtColor(self.canvas, cv2.COLOR_BGR2RGB, dst=self.rgb_canvas)
+        cv2.LUT(self.rgb_canvas, self.input_lut, dst=out)
+        return (r, r), (dw, dh)
+
+    def detect(self, image, sky_line=None):
+        return self.postprocess(*self.run(image), sky_line)
+
+    def warmup(self, shape=(FRAME_SIZE[1], FRAME_SIZE[0], 3)):
+        # One inference on a blank frame, so the interpreter's one-time setup
+        # and the letterbox geometry are paid before live frames arrive.
+        start = time.perf_counter()
+        self.detect(np.zeros(shape, dtype=np.uint8))
+        return time.perf_counter() - start
+
+    def run(self, image):
+        # Letterbox, invoke, and return the raw output with its geometry.
+        if self.zero_copy:
+            ratio, (pad_w, pad_h) = self.preprocess_into(image, self.input_tensor()[0])
+        else:
+            input_data, ratio, (pad_w, pad_h) = self.preprocess(image)
+            self.interpreter.set_tensor(self.input_details['index'], input_data)
         self.interpreter.invoke()
-        output_data = self.interpreter.get_tensor(self.output_details['index'])[0]
+        return self.read_output(), ratio, pad_w, pad_h
+
+    def set_batch_size(self, batch):
+        # Resizes the input to `batch` frames for offline runs. Returns the
+        # batch size in effect: 1 if the model cannot take batches.
+        index = self.input_details['index']
+        if batch > 1:
+            try:
+                self.interpreter.resize_tensor_input(index, [batch, self.input_h, self.input_w, 3])
+                self.interpreter.allocate_tensors()
+                if self.interpreter.tensor(self.output_details['index'])().shape[0] != batch:
+                    raise ValueError("output is not batched")
+            except (AttributeError, RuntimeError, ValueError) as e:
+                print(f"Model does not take a batch of {batch} ({e}); running one frame at a time")
+                batch = 1
+        if batch == 1 and hasattr(self.interpreter, 'resize_tensor_input'):
+            self.interpreter.resize_tensor_input(index, [1, self.input_h, self.input_w, 3])
+            self.interpreter.allocate_tensors()
+        self.input_tensor = self.interpreter.tensor(index)
+        self.output_tensor = self.interpreter.tensor(self.output_details['index'])
+        return batch
+
+    def read_output(self, index=0):
+        # `index` picks one frame's output from a batch.
+        if self.zero_copy:
+            output_data = self.output_tensor()[index]
+        else:
+            output_data = self.interpreter.get_tensor(self.output_details['index'])[index]
+        if self.output_quantized:
+            output_data = (output_data.astype(np.float32) - self.output_zero) * self.output_scale
         if output_data.shape[0] < output_data.shape[1]: 
             output_data = output_data.transpose()
-        return self.postprocess(output_data, ratio, pad_w, pad_h)
+        return output_data
+
+    def postprocess(self, output_data, ratio, pad_w, pad_h, sky_line=None):
+        return self.nms(*self.decode(output_data, ratio, pad_w, pad_h, sky_line))
 
-    def postprocess(self, output_data, ratio, pad_w, pad_h):
-        boxes, confidences, class_ids = [], [], []
+    def decode(self, output_data, ratio, pad_w, pad_h, sky_line=None):
+        # Candidate boxes as [x, y, w, h] lists with their confidences and
+        # class ids.
+        if sky_line is None:
+            sky_line = self.sky_line
         sample_val = np.max(output_data[:, 0])
         is_normalized = sample_val < 2.0
         norm_w = self.input_w if is_normalized else 1
         norm_h = self.input_h if is_normalized else 1
 
-        for row in output_data:
-            classes_scores = row[4:] 
-            max_raw_score = np.amax(classes_scores)
-            score_prob = self.sigmoid(max_raw_score)
-            if score_prob > self.conf_thres:
-                class_id = np.argmax(classes_scores)
-                x1, y1, x2, y2 = row[0] * norm_w, row[1] * norm_h, row[2] * norm_w, row[3] * norm_h
-                x1 = (x1 - pad_w) / ratio[0]
-                y1 = (y1 - pad_h) / ratio[1]
-                x2 = (x2 - pad_w) / ratio[0]
-                y2 = (y2 - pad_h) / ratio[1]
-                left, top = int(x1), int(y1)
-                width, height = int(x2 - x1), int(y2 - y1)
-                if top < SKY_LINE:
-                    continue
-                boxes.append([left, top, width, height])
-                confidences.append(float(score_prob))
-                class_ids.append(class_id)
+        # Threshold the raw class scores in logit space so the sigmoid only
+        # runs on the handful of rows that survive.
+        max_raw_scores = output_data[:, 4:].max(axis=1)
+        keep = max_raw_scores > self.conf_logit
+        if not keep.any():
+            return [], [], []
 
+        scale = np.array([norm_w, norm_h, norm_w, norm_h], dtype=np.float64)
+        xyxy = output_data[keep, :4] * scale
+        xyxy[:, [0, 2]] = (xyxy[:, [0, 2]] - pad_w) / ratio[0]
+        xyxy[:, [1, 3]] = (xyxy[:, [1, 3]] - pad_h) / ratio[1]
+        boxes = np.empty((len(xyxy), 4), dtype=np.int64)
+        boxes[:, 0] = xyxy[:, 0]
+        boxes[:, 1] = xyxy[:, 1]
+        boxes[:, 2] = xyxy[:, 2] - xyxy[:, 0]
+        boxes[:, 3] = xyxy[:, 3] - xyxy[:, 1]
+
+        below_sky = boxes[:, 1] >= sky_line
+        boxes = boxes[below_sky]
+        confidences = self.sigmoid(max_raw_scores[keep][below_sky])
+        class_ids = output_data[keep, 4:][below_sky].argmax(axis=1)
+        return boxes.tolist(), confidences.tolist(), class_ids.tolist()
+
+    def nms(self, boxes, confidences, class_ids=None):
+        if len(boxes) == 0:
+            return []
         indices = cv2.dnn.NMSBoxes(boxes, confidences, self.conf_thres, self.iou_thres)
         results = []
         if len(indices) > 0:
-            for i in indices.flatten():
+            for i in np.asarray(indices).flatten():
                 x, y, w, h = boxes[i]
-                results.append({"box": [x, y, x + w, y + h], "conf": confidences[i]})
+                class_id = class_ids[i] if class_ids is not None else 0
+                results.append({"box": [x, y, x + w, y + h], "conf": confidences[i], "class_id": class_id})
         return results
 
-def get_fresh_stream_url():
-    print("Getting stream URL...")
-    with sync_playwright() as p:
-        browser = p.chromium.launch(headless=True)
-        page = browser.new_page()
-        found_url = []
-        def handle_request(request):
-            if ".m3u8" in request.url and "playlist" in request.url:
-                found_url.append(request.url)
-        page.on("request", handle_request)
-        try:
-            page.goto(PAGE_URL, timeout=60000)
-            page.wait_for_timeout(5000) 
-        except: pass
-        browser.close()
-        return found_url[0] if found_url else None
+motion_gate = None
+tracker = None
+lane_flow = None
+occupancy_ema = None
+# Occupancy is published to 1%, so /traffic's ETag does not change on noise.
+OCCUPANCY_DECIMALS = 2
+
+lane_map = LaneMap.quadrants(X_MIDPOINT, Y_MIDPOINT, FRAME_SIZE)
+
+def count_lanes(results, lanes=None):
+    return tuple((lanes or lane_map).count(results))
+
+def lane_occupancy(results, now, lanes=None, ema=None):
+    # {"laneN_occupancy": fraction of the lane covered by boxes}, smoothed
+    # if an OccupancyEMA is given.
+    occupancy = (lanes or lane_map).occupancy(results)
+    if ema is not None:
+        occupancy = ema.update(occupancy, now)
+    return {f"lane{n + 1}_occupancy": round(value, OCCUPANCY_DECIMALS) for n, value in enumerate(occupancy)}
+
+def scale_results(results, factor):
+    if factor == 1:
+        return results
+    return [dict(res, box=[int(v * factor) for v in res['box']]) for res in results]
 
-inference_frame = None
-inference_lock = threading.Lock()
+def notify_traffic():
+    # Called with traffic_changed held.
+    traffic_changed.notify_all()
+    if async_server is not None:
+        async_server.notify()
 
-def inference_thread(model):
-    global detection_results, detection_frame, inference_frame
+def update_traffic_state(results, now, captured_at=None):
+    counts = count_lanes(results)
+    state = {f"lane{n + 1}_count": count for n, count in enumerate(counts)}
+    state.update(lane_occupancy(results, now, ema=occupancy_ema))
+    if lane_flow is not None:
+        state.update(lane_flow.update(results, now))
+    changed = live_state.publish_counts(state, captured_at)
+    first = captured_at is not None and "ready" not in startup
+    if changed or first:
+        with traffic_changed:
+            if first:
+                # The first counts from a real frame; /traffic stops answering 503.
+                mark_startup("ready")
+                print("Ready: " + ", ".join(f"{step} {t:.2f}s" for step, t in startup.items()))
+            notify_traffic()
+    if captured_at is not None:
+        frame_source.record_latency(captured_at)
+    return counts
+
+def publish_results(results, now=None, captured_at=None):
+    global detection_results, inference_count
+    now = time.monotonic() if now is None else now
+    results = scale_results(results, 1 / frame_source.scale)
+    if tracker is not None:
+        results = tracker.update(results, now)
+    update_traffic_state(results, now, captured_at)
+    with results_lock:
+        detection_results = results
+    inference_count += 1
+    frames_inferred.inc()
+
+def on_pool_result(seq, results, captured_at, duration):
+    # Runs on the pool's collector thread, in frame order.
+    inference_seconds.observe(duration)
+    if motion_gate is not None:
+        motion_gate.record_duration(duration)
+    publish_results(results, captured_at=captured_at)
+
+def draw_overlay(frame, results):
+    for res in results:
+        x1, y1, x2, y2 = map(int, res['box'])
+        cv2.rectangle(frame, (x1, y1), (x2, y2), (0, 255, 0), 2)
+        cv2.putText(frame, f"{int(res['conf']*100)}%", (x1, y1 - 10), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 255, 0), 2)
     
+    lane_map.draw(frame)
+    published = live_state.current.counts
+    counts = " ".join(f"L{n}:{published.get(f'lane{n}_count', 0)}" for n in range(1, lane_map.signals + 1))
+    cv2.putText(frame, counts, (50, 90), cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 255, 0), 2)
+    return frame
+
+def inference_thread(model, source):
+    global detection_results, inference_count
+    
+    last_seq = -1
     while True:
-        with inference_lock:
-            if inference_frame is None:
-                time.sleep(0.05)
-                continue
-            frame = inference_frame.copy()
-            inference_frame = None
-        
-        results = model.detect(frame)
-        
-        l1, l2, l3, l4 = 0, 0, 0, 0
-        for res in results:
-            x1, y1, x2, y2 = res['box']
-            cx, cy = (x1 + x2) // 2, (y1 + y2) // 2
-            if cy < Y_MIDPOINT: 
-                if cx < X_MIDPOINT: l1 += 1
-                else: l2 += 1
-            else: 
-                if cx < X_MIDPOINT: l3 += 1
-                else: l4 += 1
+        packet = source.read(last_seq, timeout=1.0)
+        if packet is None:
+            continue
+        mark_startup("first_frame")
+        if last_seq >= 0 and packet.seq > last_seq + 1:
+            frames_dropped.inc(packet.seq - last_seq - 1, reason="superseded")
+        last_seq = packet.seq
         
-        traffic_state.update({"lane1_count": l1, "lane2_count": l2, "lane3_count": l3, "lane4_count": l4})
+        now = time.monotonic()
+        try:
+            if motion_gate is not None and not motion_gate.should_infer(packet.image, now):
+                frames_skipped.inc()
+                # Between inferences the tracker carries the vehicles forward.
+                if tracker is not None:
+                    predicted = tracker.predict(now)
+                    update_traffic_state(predicted, now)
+                    with results_lock:
+                        detection_results = predicted
+                continue
+            frame_wait_seconds.observe(time.time() - packet.timestamp)
+            results = model.detect(packet.image, sky_line=SKY_LINE * source.scale)
+        finally:
+            source.release(packet)
         
-        for res in results:
-            x1, y1, x2, y2 = map(int, res['box'])
-            cv2.rectangle(frame, (x1, y1), (x2, y2), (0, 255, 0), 2)
-            cv2.putText(frame, f"{int(res['conf']*100)}%", (x1, y1 - 10), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 255, 0), 2)
+        duration = time.monotonic() - now
+        inference_seconds.observe(duration)
+        if motion_gate is not None:
+            motion_gate.record(duration)
+        results = scale_results(results, 1 / source.scale)
+        if tracker is not None:
+            results = tracker.update(results, now)
         
-        cv2.putText(frame, f"L1:{l1} L2:{l2} L3:{l3} L4:{l4}", (50, 90), cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 255, 0), 2)
+        update_traffic_state(results, now, packet.timestamp)
         
         with results_lock:
             detection_results = results
-            detection_frame = frame
+        inference_count += 1
+        frames_inferred.inc()
+
+def traffic_snapshot(state=None):
+    snapshot = (live_state if state is None else state).current
+    state = dict(snapshot.counts)
+    if snapshot.captured_at is not None:
+        # How old the frame behind these counts is, as seen by the client.
+        state["frame_age_ms"] = int((time.time() - snapshot.captured_at) * 1000)
+    return state, snapshot.version
+
+def traffic_etag(version):
+    return f"{BOOT_ID}-{version}"
+
+def traffic_response(state, ready):
+    # /traffic for one LiveState; multi_camera.py serves each camera with it.
+    if not ready:
+        # Zero counts from a model that has not seen a frame yet would read
+        # as an empty intersection.
+        return jsonify({"status": "starting"}), 503, {"Retry-After": "1"}
+    counts, version = traffic_snapshot(state)
+    # The ETag follows the counts only, so clients get 304 until a count
+    # changes even though frame_age_ms keeps growing.
+    response = jsonify(counts)
+    response.set_etag(traffic_etag(version))
+    return response.make_conditional(request)
+
+def traffic_stream(state, ready):
+    # Server-Sent Events: one event per change of the counts, pushed as soon
+    # as they are published. `ready` is called on every wake-up.
+    def events():
+        sent = None
+        while True:
+            with traffic_changed:
+                traffic_changed.wait_for(lambda: ready() and state.current.version != sent, SSE_KEEPALIVE)
+                changed = ready() and state.current.version != sent
+            if changed:
+                counts, sent = traffic_snapshot(state)
+                yield f"id: {sent}\ndata: {json.dumps(counts)}\n\n"
+            else:
+                yield ": keepalive\n\n"
+    return Response(events(), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
 @app.route('/traffic', methods=['GET'])
 def get_traffic_data():
-    return jsonify(traffic_state)
+    return traffic_response(live_state, "ready" in startup)
+
+@app.route('/traffic/stream', methods=['GET'])
+def stream_traffic_data():
+    return traffic_stream(live_state, lambda: "ready" in startup)
+
+def apply_esp_update(data):
+    # Raises ValueError if the post does not fit the controller schema.
+    live_state.update_controller(data)
+    esp_updates.inc()
+    esp_last_seen.set(time.time())
 
 @app.route('/esp_update', methods=['POST'])
 def update_esp_status():
-    global esp32_state
     try:
-        data = request.json
-        # Store whatever the ESP32 sends us
-        esp32_state = data
-        print(f"ESP32 Update: {data}") # debugging
-        return jsonify({"status": "success"}), 200
-    except Exception as e:
-        print(f"Error processing ESP update: {e}")
-        return jsonify({"status": "error"}), 400
+        apply_esp_update(request.get_json(silent=True))
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    return jsonify({"status": "success"}), 200
+
+def system_status():
+    # Camera counts and controller data from the same snapshot.
+    return live_state.status()
 
 @app.route('/system_status', methods=['GET'])
 def get_full_status():
-    full_status = {
-        "camera_data": traffic_state,
-        "controller_data": esp32_state,
-        "timestamp": time.time()
-    }
-    return jsonify(full_status)
+    return jsonify(system_status())
+
+def history_thread(store):
+    # Samples the published state once per interval, changed or not.
+    last_flush = time.monotonic()
+    while True:
+        snapshot = live_state.current
+        store.record(time.time(), snapshot.counts, snapshot.controller)
+        if time.monotonic() - last_flush >= HISTORY_FLUSH_INTERVAL:
+            store.flush()
+            last_flush = time.monotonic()
+        time.sleep(store.interval)
+
+@app.route('/history', methods=['GET'])
+def get_history():
+    if history is None:
+        return jsonify({"status": "error", "message": "history is disabled"}), 404
+    try:
+        window = float(request.args.get("window", 3600))
+        bucket = float(request.args.get("bucket", 60))
+        end = float(request.args.get("end", time.time()))
+    except ValueError:
+        return jsonify({"status": "error", "message": "window, bucket and end must be numbers"}), 400
+    fields = request.args.get("fields")
+    fields = fields.split(",") if fields else list(NUMERIC_FIELDS)
+    unknown = [field for field in fields if field not in NUMERIC_FIELDS]
+    if unknown:
+        return jsonify({"status": "error", "message": f"unknown fields: {', '.join(unknown)}"}), 400
+    if not window > 0:
+        # Also catches nan.
+        return jsonify({"status": "error", "message": "window must be positive"}), 400
+    try:
+        return jsonify(history.query(end - window, end, bucket, fields))
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+
+@app.route('/ready', methods=['GET'])
+def get_ready():
+    # 200 once the model is warm and the first counts are published; the body
+    # has the time each startup step finished, in seconds since launch.
+    ready = "ready" in startup
+    return jsonify(dict(startup, ready=ready)), 200 if ready else 503
+
+@app.route('/inference_stats', methods=['GET'])
+def get_inference_stats():
+    stats = {"motion_gate": motion_gate.stats() if motion_gate is not None else None}
+    if frame_source is not None:
+        stats["frame_source"] = frame_source.stats()
+    stats["stream_resolver"] = stream_resolver.stats()
+    if async_server is not None:
+        stats["http"] = async_server.stats()
+    if history is not None:
+        stats["history"] = history.stats()
+    return jsonify(stats)
+
+@app.route('/snapshot.jpg', methods=['GET'])
+def get_snapshot():
+    # The overlay is only drawn when somebody actually asks for a picture.
+    packet = frame_source.read(timeout=1.0) if frame_source is not None else None
+    if packet is None:
+        return jsonify({"status": "error", "message": "no frame yet"}), 503
+    try:
+        frame = packet.image.copy()
+    finally:
+        frame_source.release(packet)
+    with results_lock:
+        results = list(detection_results)
+    annotated = draw_overlay(frame, scale_results(results, frame_source.scale))
+    ok, buffer = cv2.imencode(".jpg", annotated, [int(cv2.IMWRITE_JPEG_QUALITY), SNAPSHOT_QUALITY])
+    if not ok:
+        return jsonify({"status": "error"}), 500
+    return Response(buffer.tobytes(), mimetype="image/jpeg")
+
+@app.after_request
+def count_request(response):
+    endpoint = request.url_rule.rule if request.url_rule is not None else "unmatched"
+    http_requests.inc(endpoint=endpoint, status=response.status_code)
+    return response
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    # Totals kept by other components are copied in at scrape time.
+    if frame_source is not None:
+        frames_decoded.set_total(frame_source.frames_decoded)
+        frames_dropped.set_total(frame_source.frames_dropped, reason="ring_full")
+        stream_reconnects.set_total(frame_source.reconnects)
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
 
 def run_server():
+    mark_startup("http")
     app.run(host='0.0.0.0', port=5000, debug=False, use_reloader=False, threaded=True)
 
+# Handlers for --http async. The endpoints controllers hit run on the event
+# loop and only read published state; everything else goes through Flask.
+def json_response(data, status=200, headers=None):
+    return async_http.Response(json.dumps(data, separators=(",", ":")).encode(), status, headers)
+
+def async_traffic(req):
+    if "ready" not in startup:
+        return json_response({"status": "starting"}, 503, {"Retry-After": "1"})
+    state, version = traffic_snapshot()
+    etag = f'"{traffic_etag(version)}"'
+    sent = [tag.strip().removeprefix("W/") for tag in req.headers.get("if-none-match", "").split(",")]
+    if etag in sent:
+        return async_http.Response(b"", 304, {"ETag": etag}, content_type=None)
+    return json_response(state, headers={"ETag": etag})
+
+def async_traffic_stream(req):
+    async def events():
+        sent = None
+        while True:
+            if "ready" in startup and live_state.current.version != sent:
+                state, sent = traffic_snapshot()
+                yield f"id: {sent}\ndata: {json.dumps(state)}\n\n".encode()
+            elif not await async_server.wait_changed(SSE_KEEPALIVE):
+                yield b": keepalive\n\n"
+    return async_http.Response(events(), content_type="text/event-stream",
+                               headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+def async_esp_update(req):
+    try:
+        apply_esp_update(json.loads(req.body))
+    except ValueError as e:
+        return json_response({"status": "error", "message": str(e)}, 400)
+    return json_response({"status": "success"})
+
+def async_system_status(req):
+    return json_response(system_status())
+
+def async_ready(req):
+    ready = "ready" in startup
+    return json_response(dict(startup, ready=ready), 200 if ready else 503)
+
+def count_async_request(req, response):
+    http_requests.inc(endpoint=req.path, status=response.status)
+
+def start_async_server():
+    global async_server
+    server = async_http.AsyncHTTPServer(port=5000, wsgi_app=app, on_response=count_async_request)
+    server.route("GET", "/traffic", async_traffic)
+    server.route("GET", "/traffic/stream", async_traffic_stream)
+    server.route("POST", "/esp_update", async_esp_update)
+    server.route("GET", "/system_status", async_system_status)
+    server.route("GET", "/ready", async_ready)
+    server.start()
+    async_server = server
+    mark_startup("http")
+
+def open_stream(attempt=0):
+    # The first attempt after a drop reuses the cached playlist URL; only if
+    # that fails is the page loaded again.
+    m3u8_link = stream_resolver.get(PAGE_URL, force=attempt > 0)
+    if not m3u8_link:
+        print("Stream URL not found!")
+        return None
+    print(f"Stream URL: {m3u8_link}")
+    return cv2.VideoCapture(m3u8_link)
+
 def main():
-    global inference_frame
+    global frame_source, motion_gate, tracker, lane_flow, history, lane_map, live_state, occupancy_ema
     
-    server_thread = threading.Thread(target=run_server, daemon=True)
-    server_thread.start()
-    print("Flask Server on port 5000")
-
-    model = YOLO_TFLite(MODEL_NAME, conf_thres=CONF_THRESHOLD)
-    print("Model loaded")
+    parser = argparse.ArgumentParser(description="Smart traffic light camera server")
+    parser.add_argument("--workers", type=int, default=INFERENCE_WORKERS,
+                        help="inference worker processes (0 runs inference in a thread)")
+    parser.add_argument("--motion-gate", action="store_true",
+                        help="skip inference while the lanes are static")
+    parser.add_argument("--track", action="store_true",
+                        help="track vehicles and publish flow and queue length per lane")
+    parser.add_argument("--occupancy-smoothing", type=float, default=0.0, metavar="SECONDS",
+                        help="EMA time constant for laneN_occupancy (0 publishes raw values)")
+    parser.add_argument("--headless", action="store_true",
+                        help="no display window; frames are only drawn for /snapshot.jpg")
+    parser.add_argument("--decode-scale", type=float, default=1.0,
+                        help="decode frames at this fraction of the stream resolution")
+    parser.add_argument("--lanes", help="JSON lane polygons (default: quadrants around X/Y_MIDPOINT)")
+    parser.add_argument("--roi", action="append", type=parse_region, metavar="X1,Y1,X2,Y2[:COLSxROWS]",
+                        help="only infer on this part of the frame, optionally tiled (repeatable)")
+    parser.add_argument("--history-hours", type=float, default=24,
+                        help="how long /history keeps samples (0 disables it)")
+    parser.add_argument("--history-file",
+                        help="memory-mapped file that keeps the history across restarts")
+    parser.add_argument("--http", choices=("flask", "async"), default="flask",
+                        help="'async' serves keep-alive connections from one asyncio loop")
+    args = parser.parse_args()
     
-    detector = threading.Thread(target=inference_thread, args=(model,), daemon=True)
-    detector.start()
+    frame_source = FrameSource(open_stream, scale=args.decode_scale)
     
-    m3u8_link = get_fresh_stream_url()
-    if not m3u8_link:
-        print("Stream URL not found!")
-        return
+    if args.lanes:
+        lane_map = LaneMap.load(args.lanes)
+        print(f"Loaded {len(lane_map.lanes)} lanes for {lane_map.signals} signals")
+        live_state = LiveState(lane_map.signals)
     
-    print(f"Stream URL: {m3u8_link}")
+    if args.motion_gate:
+        motion_gate = MotionGate(split=(X_MIDPOINT * args.decode_scale, Y_MIDPOINT * args.decode_scale),
+                                 top=SKY_LINE * args.decode_scale)
+    
+    if args.track:
+        tracker = Tracker(max_age=gated_max_age(motion_gate.max_staleness) if motion_gate is not None else MAX_AGE)
+        lane_flow = LaneFlow(lane_map.lane_of, lanes=lane_map.signals)
+    
+    if args.occupancy_smoothing > 0:
+        occupancy_ema = OccupancyEMA(args.occupancy_smoothing)
     
-    cap = cv2.VideoCapture(m3u8_link)
-    cap.set(cv2.CAP_PROP_BUFFERSIZE, 3)
+    if args.history_hours > 0:
+        history = History(retention=args.history_hours * 3600, interval=HISTORY_INTERVAL, path=args.history_file)
+        threading.Thread(target=history_thread, args=(history,), daemon=True).start()
     
-    fps = cap.get(cv2.CAP_PROP_FPS)
-    if fps <= 0 or fps > 60:
-        fps = 30
-    frame_delay = max(1, int(1000 / fps) - 10)
+    if args.http == "async":
+        start_async_server()
+        print("Async HTTP server on port 5000")
+    else:
+        server_thread = threading.Thread(target=run_server, daemon=True)
+        server_thread.start()
+        print("Flask Server on port 5000")
+
+    # The stream URL lookup (a browser page load) runs while the model loads.
+    frame_source.start()
     
-    print(f"Stream FPS: {fps}, Frame delay: {frame_delay}ms")
+    pool = None
+    if args.workers == 0:
+        model = YOLO_TFLite(MODEL_NAME, conf_thres=CONF_THRESHOLD)
+        mark_startup("model_loaded")
+        print("Model loaded")
+        if args.roi:
+            model = RegionDetector(args.roi, model=model, scale=args.decode_scale)
+            print(f"Inferring on {len(args.roi)} regions")
+        scaled = (round(FRAME_SIZE[1] * args.decode_scale), round(FRAME_SIZE[0] * args.decode_scale), 3)
+        print(f"Warm-up inference: {model.warmup(scaled) * 1000:.0f} ms")
+        mark_startup("warmed_up")
+        
+        detector = threading.Thread(target=inference_thread, args=(model, frame_source), daemon=True)
+        detector.start()
     
-    frame_count = 0
+    report_time = time.monotonic()
+    report_frames = report_inferences = 0
+    last_seq = -1
     
     while True:
-        ret, frame = cap.read()
-        if not ret:
-            print("Connection lost, reconnecting...")
-            cap.release()
-            time.sleep(2)
-            m3u8_link = get_fresh_stream_url()
-            if m3u8_link:
-                cap = cv2.VideoCapture(m3u8_link)
-                cap.set(cv2.CAP_PROP_BUFFERSIZE, 3)
+        now = time.monotonic()
+        if now - report_time >= FPS_REPORT_INTERVAL:
+            elapsed = now - report_time
+            print(f"Capture: {(frame_source.frames_decoded - report_frames) / elapsed:.1f} FPS, "
+                  f"inference: {(inference_count - report_inferences) / elapsed:.1f} FPS")
+            report_time, report_frames, report_inferences = now, frame_source.frames_decoded, inference_count
+        
+        if args.headless and args.workers == 0:
+            # The inference thread pulls frames itself; nothing to do here.
+            time.sleep(FPS_REPORT_INTERVAL)
             continue
         
-        frame_count += 1
+        packet = frame_source.read(last_seq, timeout=1.0)
+        if packet is None:
+            continue
+        mark_startup("first_frame")
+        if args.workers > 0 and last_seq >= 0 and packet.seq > last_seq + 1:
+            frames_dropped.inc(packet.seq - last_seq - 1, reason="superseded")
+        last_seq = packet.seq
         
-        with inference_lock:
-            if inference_frame is None:
-                inference_frame = frame.copy()
+        try:
+            if args.workers > 0:
+                if pool is None:
+                    model_kwargs = {"model_path": MODEL_NAME, "conf_thres": CONF_THRESHOLD, "iou_thres": IOU_THRESHOLD,
+                                    "sky_line": SKY_LINE * args.decode_scale}
+                    model_cls = YOLO_TFLite
+                    if args.roi:
+                        model_kwargs = dict(model_kwargs, regions=args.roi, model_cls=YOLO_TFLite, scale=args.decode_scale)
+                        model_cls = RegionDetector
+                    pool = InferencePool(model_cls, model_kwargs, packet.image.shape, args.workers, on_pool_result)
+                    mark_startup("warmed_up")
+                    print(f"Inference pool started with {args.workers} workers")
+                if motion_gate is None or motion_gate.should_infer(packet.image):
+                    if not pool.submit(packet.image, timestamp=packet.timestamp):
+                        frames_dropped.inc(reason="pool_busy")
+                    else:
+                        # Up to the pool's task queue; the wait for a free
+                        # worker is not included.
+                        frame_wait_seconds.observe(time.time() - packet.timestamp)
+                        if motion_gate is not None:
+                            # The inference time is recorded with the result.
+                            motion_gate.record()
+                else:
+                    frames_skipped.inc()
+            
+            if args.headless:
+                continue
+            
+            frame = packet.image.copy()
+        finally:
+            frame_source.release(packet)
         
         with results_lock:
             results = detection_results.copy()
         
-        for res in results:
-            x1, y1, x2, y2 = map(int, res['box'])
-            cv2.rectangle(frame, (x1, y1), (x2, y2), (0, 255, 0), 2)
-            cv2.putText(frame, f"{int(res['conf']*100)}%", (x1, y1 - 10), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 255, 0), 2)
-        
-        l1, l2, l3, l4 = traffic_state["lane1_count"], traffic_state["lane2_count"], traffic_state["lane3_count"], traffic_state["lane4_count"]
-        cv2.putText(frame, f"L1:{l1} L2:{l2} L3:{l3} L4:{l4}", (50, 90), cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 255, 0), 2)
-        
-        cv2.imshow("Traffic Monitor", frame)
+        cv2.imshow("Traffic Monitor", draw_overlay(frame, scale_results(results, frame_source.scale)))
         
-        if cv2.waitKey(frame_delay) & 0xFF == ord('q'): 
+        if cv2.waitKey(1) & 0xFF == ord('q'): 
             break
     
-    cap.release()
+    frame_source.stop()
     cv2.destroyAllWindows()
+    if history is not None:
+        history.flush()
+    if pool is not None:
+        print(f"Inference pool: {pool.stats()}")
+        pool.close()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,149 @@
+import queue
+import threading
+import time
+
+URL_TTL = 600
+REFRESH_AT = 0.8
+RESOLVE_TIMEOUT = 30
+RETRY_DELAY = 5
+BLOCKED_RESOURCES = {"image", "font", "stylesheet"}
+
+
+def is_playlist(request):
+    return ".m3u8" in request.url and "playlist" in request.url
+
+
+class StreamResolver:
+    # Resolves camera page URLs to their .m3u8 playlist and caches the result.
+    # One background thread owns a single persistent Chromium context (the
+    # Playwright sync API is bound to the thread that started it), answers
+    # on-demand lookups and re-resolves cached URLs before their TTL runs out.
+    def __init__(self, ttl=URL_TTL, timeout=RESOLVE_TIMEOUT):
+        self.ttl = ttl
+        self.timeout = timeout
+        self.cache = {}
+        self.attempted = {}
+        self.watched = set()
+        self.requests = queue.Queue()
+        self.cond = threading.Condition()
+        self.thread = None
+
+        self.cache_hits = 0
+        self.resolves = 0
+        self.failures = 0
+        self.resolve_times = []
+
+    def start(self):
+        with self.cond:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.worker, daemon=True)
+                self.thread.start()
+
+    def get(self, page_url, force=False):
+        self.start()
+        with self.cond:
+            self.watched.add(page_url)
+            entry = self.cache.get(page_url)
+            if entry and not force and time.time() - entry[1] < self.ttl:
+                self.cache_hits += 1
+                return entry[0]
+            requested = time.time()
+        self.requests.put((page_url, requested))
+        with self.cond:
+            self.cond.wait_for(lambda: self.attempted.get(page_url, 0) >= requested, self.timeout * 2)
+            entry = self.cache.get(page_url)
+            if entry and entry[1] >= requested:
+                return entry[0]
+            return None
+
+    def next_refresh(self):
+        # The watched page whose URL is closest to expiring, and how long
+        # until it should be refreshed.
+        with self.cond:
+            due = [
+                (
+                    max(
+                        self.cache.get(url, (None, 0))[1] + self.ttl * REFRESH_AT,
+                        self.attempted.get(url, 0) + RETRY_DELAY,
+                    ),
+                    url,
+                )
+                for url in self.watched
+            ]
+        if not due:
+            return None, None
+        when, url = min(due)
+        return url, max(when - time.time(), 0)
+
+    def worker(self):
+        # Playwright is only imported once a stream URL is needed.
+        from playwright.sync_api import sync_playwright
+
+        playwright = sync_playwright().start()
+        browser = context = None
+        while True:
+            page_url, wait = self.next_refresh()
+            try:
+                page_url, requested = self.requests.get(timeout=wait)
+                with self.cond:
+                    if self.attempted.get(page_url, 0) >= requested:
+                        # Already answered by a refresh that ran meanwhile.
+                        continue
+            except queue.Empty:
+                pass
+            if page_url is None:
+                continue
+
+            start = time.time()
+            try:
+                if browser is None or not browser.is_connected():
+                    browser = playwright.chromium.launch(headless=True)
+                    context = browser.new_context()
+                    context.route(
+                        "**/*",
+                        lambda route: route.abort()
+                        if route.request.resource_type in BLOCKED_RESOURCES
+                        else route.continue_(),
+                    )
+                url = self.resolve(context, page_url)
+            except Exception as e:
+                print(f"Browser error while resolving stream URL: {e}")
+                browser = None
+                url = None
+            elapsed = time.time() - start
+            with self.cond:
+                if url:
+                    self.resolves += 1
+                    self.resolve_times.append(elapsed)
+                    self.resolve_times = self.resolve_times[-100:]
+                    self.cache[page_url] = (url, time.time())
+                else:
+                    self.failures += 1
+                self.attempted[page_url] = time.time()
+                self.cond.notify_all()
+            print(f"Stream URL {'resolved' if url else 'not found'} in {elapsed:.1f}s")
+
+    def resolve(self, context, page_url):
+        page = context.new_page()
+        try:
+            # Return as soon as the player requests its playlist instead of
+            # waiting a fixed time after the page loads.
+            with page.expect_request(is_playlist, timeout=self.timeout * 1000) as request_info:
+                page.goto(page_url, wait_until="domcontentloaded", timeout=self.timeout * 1000)
+            return request_info.value.url
+        except Exception as e:
+            print(f"Stream URL lookup failed: {e}")
+            return None
+        finally:
+            page.close()
+
+    def stats(self):
+        with self.cond:
+            times = self.resolve_times
+            return {
+                "cache_hits": self.cache_hits,
+                "resolves": self.resolves,
+                "failures": self.failures,
+                "last_resolve_s": times[-1] if times else None,
+                "mean_resolve_s": sum(times) / len(times) if times else None,
+            }
@@ -0,0 +1,66 @@
+import threading
+import time
+
+import numpy as np
+
+import inference_pool
+from inference_pool import InferencePool
+
+FRAME_SHAPE = (48, 64, 3)
+HANG = 255
+
+
+class HangOnMarkedFrame:
+    # Stands in for YOLO_TFLite in the workers; imported by them by name.
+    # A frame whose first pixel is HANG never returns, like a wedged
+    # delegate.
+    def __init__(self, num_threads=1):
+        pass
+
+    def warmup(self, shape):
+        pass
+
+    def detect(self, frame):
+        if frame[0, 0, 0] == HANG:
+            while True:
+                time.sleep(60)
+        return [{"box": [0, 0, 1, 1], "conf": 0.9, "class_id": int(frame[0, 0, 1])}]
+
+
+def wait_for(condition, timeout=30.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.05)
+    return True
+
+
+def test_hung_worker_is_replaced(monkeypatch):
+    monkeypatch.setattr(inference_pool, "RESULT_TIMEOUT", 1.0)
+    results = []
+    done = threading.Event()
+
+    def on_result(seq, detections, timestamp, duration):
+        results.append((seq, detections[0]["class_id"]))
+        if seq == 3:
+            done.set()
+
+    # One worker: if the hung one were left running, nothing after it
+    # would ever be inferred.
+    pool = InferencePool(HangOnMarkedFrame, {}, FRAME_SHAPE, 1, on_result)
+    try:
+        hung = pool.processes[0]
+        pool.submit(np.full(FRAME_SHAPE, HANG, dtype=np.uint8), block=True)
+        assert wait_for(lambda: pool.restarts == 1)
+        # The hung process itself is gone, not just abandoned.
+        assert hung.exitcode is not None and pool.processes[0] is not hung
+        for i in range(1, 4):
+            frame = np.zeros(FRAME_SHAPE, dtype=np.uint8)
+            frame[0, 0, 1] = i
+            pool.submit(frame, block=True)
+        assert done.wait(30)
+        assert results == [(1, 1), (2, 2), (3, 3)]
+        assert pool.stats()["lost"] == 1
+    finally:
+        pool.close()
@@ -0,0 +1,98 @@
+import json
+import threading
+import time
+
+import numpy as np
+import pytest
+
+import multi_camera
+from multi_camera import Camera, InferenceScheduler, app, single_camera_route
+
+CAR = {"box": [100, 700, 200, 780], "conf": 0.9, "class_id": 2}
+
+
+@pytest.fixture
+def camera(monkeypatch):
+    camera = Camera({"id": "demo", "source": "clip.mp4"})
+    monkeypatch.setattr(multi_camera, "cameras", {"demo": camera})
+    return camera
+
+
+def test_camera_traffic_waits_for_first_frame(camera):
+    client = app.test_client()
+    response = client.get("/traffic/demo")
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "1"
+
+    camera.publish([CAR], time.time() - 0.25)
+    response = client.get("/traffic/demo")
+    assert response.status_code == 200
+    assert response.json["lane3_count"] == 1
+    assert response.json["frame_age_ms"] >= 250
+    etag = response.headers["ETag"]
+    assert client.get("/traffic/demo", headers={"If-None-Match": etag}).status_code == 304
+
+    camera.publish([], time.time())
+    response = client.get("/traffic/demo", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etag
+
+
+def test_camera_stream_sends_counts(camera):
+    camera.publish([CAR], time.time())
+    response = app.test_client().get("/traffic/demo/stream", buffered=False)
+    event = next(response.response).decode()
+    response.close()
+    assert event.startswith(f"id: {camera.state.current.version}\n")
+    assert json.loads(event.split("data: ", 1)[1])["lane3_count"] == 1
+
+
+def test_unknown_camera(camera):
+    assert app.test_client().get("/traffic/other").status_code == 404
+
+
+def test_stream_is_not_a_camera_id():
+    with pytest.raises(ValueError):
+        Camera({"id": "stream", "source": "clip.mp4"})
+
+
+def test_single_camera_routes_point_to_camera_routes(camera):
+    with app.test_request_context("/traffic/stream"):
+        response, status = single_camera_route()
+    assert status == 404
+    assert "/traffic/<camera_id>/stream" in response.json["message"]
+    with app.test_request_context("/traffic/demo"):
+        assert single_camera_route() is None
+
+
+class FailingModel:
+    def __init__(self):
+        self.calls = 0
+
+    def detect(self, frame, sky_line=None):
+        self.calls += 1
+        if self.calls == 1:
+            raise RuntimeError("bad frame")
+        return [CAR]
+
+
+def test_scheduler_survives_a_failed_inference(camera):
+    # Without loading interpreters; the worker gets its model passed in.
+    scheduler = InferenceScheduler.__new__(InferenceScheduler)
+    scheduler.cameras = [camera]
+    scheduler.cursor = 0
+    scheduler.lock = threading.Lock()
+    model = FailingModel()
+    threading.Thread(target=scheduler.worker, args=(model,), daemon=True).start()
+    frame = np.zeros((1080, 1920, 3), dtype=np.uint8)
+    for _ in range(2):
+        with camera.frame_lock:
+            camera.frame, camera.captured_at = frame, time.time()
+        deadline = time.monotonic() + 5
+        while camera.frame is not None and time.monotonic() < deadline:
+            time.sleep(0.01)
+    deadline = time.monotonic() + 5
+    while not camera.ready and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert model.calls == 2
+    assert camera.state.current.counts["lane3_count"] == 1
@@ -0,0 +1,166 @@
+import importlib.util
+import os
+
+import cv2
+import numpy as np
+import pytest
+
+import server
+
+# The dashboard keeps its own copy of YOLO_TFLite; both are checked. Its
+# sibling modules are the same files as the ones here.
+DASHBOARD_SERVER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Dashboard", "yolo-tflite-setup",
+                                "server.py")
+
+INPUT_SIZE = 640
+ANCHORS = 2000
+CLASSES = 4
+SKY_LINE = 200
+RATIO = (640 / 1920, 640 / 1920)
+PAD = (0.0, 140.0)
+
+
+class StubInterpreter:
+    # Just enough of tflite.Interpreter for YOLO_TFLite to be built around a
+    # fixed output, float32 or int8 quantized.
+    def __init__(self, output, quantization=(0.0, 0)):
+        self.input = np.zeros((1, INPUT_SIZE, INPUT_SIZE, 3), dtype=np.float32)
+        self.output = output
+        self.quantization = quantization
+
+    def allocate_tensors(self):
+        pass
+
+    def get_input_details(self):
+        return [{"index": 0, "shape": np.array(self.input.shape), "dtype": np.float32, "quantization": (0.0, 0)}]
+
+    def get_output_details(self):
+        return [{"index": 1, "shape": np.array(self.output.shape), "dtype": self.output.dtype.type,
+                 "quantization": self.quantization}]
+
+    def tensor(self, index):
+        array = self.input if index == 0 else self.output
+        return lambda: array
+
+    def get_tensor(self, index):
+        return (self.input if index == 0 else self.output).copy()
+
+
+def reference_decode(model, output_data, ratio, pad_w, pad_h, sky_line):
+    # The per-row loop decode() replaced, kept as the reference. Rows are
+    # taken as float64, as NumPy 1 promoted this scalar maths; NumPy 2 keeps
+    # it in float32, which can truncate a box a pixel differently.
+    output_data = output_data.astype(np.float64)
+    boxes, confidences, class_ids = [], [], []
+    sample_val = np.max(output_data[:, 0])
+    is_normalized = sample_val < 2.0
+    norm_w = model.input_w if is_normalized else 1
+    norm_h = model.input_h if is_normalized else 1
+
+    for row in output_data:
+        classes_scores = row[4:]
+        max_raw_score = np.amax(classes_scores)
+        score_prob = model.sigmoid(max_raw_score)
+        if score_prob > model.conf_thres:
+            class_id = np.argmax(classes_scores)
+            x1, y1, x2, y2 = row[0] * norm_w, row[1] * norm_h, row[2] * norm_w, row[3] * norm_h
+            x1 = (x1 - pad_w) / ratio[0]
+            y1 = (y1 - pad_h) / ratio[1]
+            x2 = (x2 - pad_w) / ratio[0]
+            y2 = (y2 - pad_h) / ratio[1]
+            left, top = int(x1), int(y1)
+            width, height = int(x2 - x1), int(y2 - y1)
+            if top < sky_line:
+                continue
+            boxes.append([left, top, width, height])
+            confidences.append(float(score_prob))
+            class_ids.append(int(class_id))
+    return boxes, confidences, class_ids
+
+
+def synthetic_output(seed, normalized=True):
+    # (1, 4 + classes, anchors) like the model: mostly background, some hot
+    # anchors, and a few boxes whose top lands right at the sky line.
+    rng = np.random.default_rng(seed)
+    output = np.empty((1, 4 + CLASSES, ANCHORS), dtype=np.float32)
+    output[0, 4:] = rng.uniform(-8.0, -1.0, (CLASSES, ANCHORS))
+    hot = rng.choice(ANCHORS, ANCHORS // 10, replace=False)
+    output[0, 4 + rng.integers(0, CLASSES, len(hot)), hot] = rng.uniform(-1.0, 4.0, len(hot))
+    centers = rng.uniform(0.05, 0.95, (ANCHORS, 2))
+    sizes = rng.uniform(0.01, 0.1, (ANCHORS, 2))
+    xyxy = np.concatenate([centers - sizes / 2, centers + sizes / 2], axis=1)
+    # Tops one pixel either side of the sky line, in frame coordinates.
+    edge = hot[:20]
+    top = (SKY_LINE + rng.uniform(-1.0, 1.0, len(edge))) * RATIO[1] + PAD[1]
+    xyxy[edge, 1] = top / INPUT_SIZE
+    xyxy[edge, 3] = xyxy[edge, 1] + sizes[edge, 1]
+    output[0, :4] = (xyxy if normalized else xyxy * INPUT_SIZE).T
+    return output
+
+
+def load_dashboard_server():
+    spec = importlib.util.spec_from_file_location("dashboard_server", DASHBOARD_SERVER)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+@pytest.fixture(scope="module", params=["yolo-tflite-detection", "dashboard"])
+def model_cls(request):
+    return server.YOLO_TFLite if request.param == "yolo-tflite-detection" else load_dashboard_server().YOLO_TFLite
+
+
+def quantize(output):
+    scale = float(np.abs(output).max()) / 127
+    return np.clip(np.round(output / scale), -128, 127).astype(np.int8), (scale, 0)
+
+
+def model_for(model_cls, output, quantization=(0.0, 0), conf_thres=0.5):
+    return model_cls(None, conf_thres=conf_thres, sky_line=SKY_LINE, interpreter=StubInterpreter(output, quantization))
+
+
+@pytest.mark.parametrize("seed", range(20))
+@pytest.mark.parametrize("normalized", [True, False])
+def test_decode_matches_reference(model_cls, seed, normalized):
+    model = model_for(model_cls, synthetic_output(seed, normalized))
+    output_data = model.read_output()
+    expected = reference_decode(model, output_data, RATIO, *PAD, SKY_LINE)
+    boxes, confidences, class_ids = model.decode(output_data, RATIO, *PAD)
+    assert boxes == expected[0]
+    assert class_ids == expected[2]
+    assert np.allclose(confidences, expected[1], rtol=1e-6)
+    # Some boxes are cut by the sky line and some kept right below it.
+    tops = [box[1] for box in expected[0]]
+    assert min(tops) in (SKY_LINE, SKY_LINE + 1)
+    assert len(model.decode(output_data, RATIO, *PAD, sky_line=-np.inf)[0]) > len(boxes)
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_quantized_decode_matches_reference(model_cls, seed):
+    quantized, quantization = quantize(synthetic_output(seed, normalized=False))
+    model = model_for(model_cls, quantized, quantization)
+    output_data = model.read_output()
+    assert np.array_equal(output_data, (quantized[0].astype(np.float32) * np.float32(quantization[0])).T)
+    expected = reference_decode(model, output_data, RATIO, *PAD, SKY_LINE)
+    boxes, confidences, class_ids = model.decode(output_data, RATIO, *PAD)
+    assert boxes == expected[0]
+    assert class_ids == expected[2]
+    assert np.allclose(confidences, expected[1], rtol=1e-6)
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_postprocess_matches_reference_nms(model_cls, seed):
+    model = model_for(model_cls, synthetic_output(seed), conf_thres=0.4)
+    output_data = model.read_output()
+    boxes, confidences, _ = reference_decode(model, output_data, RATIO, *PAD, SKY_LINE)
+    indices = np.asarray(cv2.dnn.NMSBoxes(boxes, confidences, model.conf_thres, model.iou_thres)).flatten()
+    expected = [[x, y, x + w, y + h] for x, y, w, h in (boxes[i] for i in indices)]
+    assert [res["box"] for res in model.postprocess(output_data, RATIO, *PAD)] == expected
+
+
+def test_nothing_above_threshold(model_cls):
+    output = synthetic_output(0)
+    output[0, 4:] = -10.0
+    model = model_for(model_cls, output)
+    assert model.decode(model.read_output(), RATIO, *PAD) == ([], [], [])
+    assert model.postprocess(model.read_output(), RATIO, *PAD) == []
@@ -0,0 +1,110 @@
+import importlib.util
+import os
+import sys
+
+import cv2
+import numpy as np
+import pytest
+
+from bench_pipeline import StubInterpreter, replay
+from regions import RegionDetector
+from server import YOLO_TFLite
+
+DASHBOARD = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Dashboard", "yolo-tflite-setup")
+
+# The real TFLite interpreter refuses to invoke() while a NumPy view of one
+# of its tensors is alive; StubInterpreter enforces the same rule.
+
+
+def stub_model(model_cls=YOLO_TFLite):
+    return model_cls(None, conf_thres=0.25, interpreter=StubInterpreter(input_size=320, anchors=2100))
+
+
+def load_module(name, path):
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+@pytest.fixture
+def video(tmp_path):
+    path = str(tmp_path / "clip.avi")
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*"MJPG"), 10, (480, 270))
+    rng = np.random.default_rng(0)
+    for _ in range(6):
+        writer.write(rng.integers(0, 255, (270, 480, 3), dtype=np.uint8))
+    writer.release()
+    return path
+
+
+def test_stub_rejects_live_views():
+    model = stub_model()
+    view = model.input_tensor()[0]
+    with pytest.raises(RuntimeError, match="reference to internal data"):
+        model.interpreter.invoke()
+    del view
+    output = model.read_output()
+    with pytest.raises(RuntimeError):
+        model.interpreter.invoke()
+    del output
+    model.interpreter.invoke()
+
+
+def test_detect_runs_repeatedly():
+    model = stub_model()
+    frame = np.zeros((270, 480, 3), dtype=np.uint8)
+    assert model.detect(frame) == model.detect(frame)
+
+
+def test_bench_replay(video):
+    report = replay(stub_model(), video, None, 1)
+    assert report["frames"] == 5
+    assert report["detections_per_frame"] > 0
+
+
+def test_region_detector_runs_tiles():
+    # Every tile after the first invokes while the previous tile's output
+    # would still be in scope.
+    regions = [{"box": [0, 0, 480, 270], "tiles": (2, 1)}, {"box": [240, 135, 480, 270], "tiles": (1, 1)}]
+    detector = RegionDetector(regions, model=stub_model())
+    frame = np.zeros((270, 480, 3), dtype=np.uint8)
+    assert len(detector.tiles(frame.shape[:2])) == 3
+    assert detector.detect(frame) == detector.detect(frame)
+
+
+class Counts:
+    def __init__(self):
+        self.rows = {}
+
+    def add(self, frame, t, counts, occupancy):
+        self.rows[frame] = counts
+
+
+class Video:
+    fps = 10
+
+    def __init__(self):
+        self.out = Counts()
+
+
+def test_batch_analyze_runs_batches(monkeypatch):
+    # batch_analyze imports the dashboard's own server module.
+    dashboard_server = load_module("dashboard_server", os.path.join(DASHBOARD, "server.py"))
+    monkeypatch.setitem(sys.modules, "server", dashboard_server)
+    batch_analyze = load_module("batch_analyze", os.path.join(DASHBOARD, "batch_analyze.py"))
+    model = stub_model(dashboard_server.YOLO_TFLite)
+    assert model.set_batch_size(3) == 3
+    lanes = batch_analyze.LaneMap.quadrants(240, 135, (480, 270))
+    video = Video()
+    frame = np.zeros((270, 480, 3), dtype=np.uint8)
+    for start in (0, 3):
+        items = []
+        for index in range(start, start + 3):
+            canvas = np.empty((model.input_h, model.input_w, 3), dtype=np.uint8)
+            ratio, pad = batch_analyze.letterbox_rgb(model, frame, canvas)
+            items.append(("frame", video, index, canvas, ratio, pad, frame.shape[:2]))
+        batch_analyze.run_batch(model, 3, items, lanes)
+    assert sorted(video.out.rows) == list(range(6))
+    assert sum(video.out.rows[0]) > 0
+    assert all(video.out.rows[i] == video.out.rows[0] for i in range(6))
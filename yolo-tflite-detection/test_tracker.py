@@ -0,0 +1,54 @@
+import numpy as np
+
+from lane_map import LaneMap
+from motion_gate import MotionGate
+from tracker import MAX_AGE, LaneFlow, Tracker, gated_max_age
+
+FRAME_SIZE = (640, 360)
+FPS = 25
+# Three cars standing at a red light.
+CARS = [[60, 220, 120, 260], [140, 222, 200, 262], [400, 230, 470, 275]]
+
+
+def run_static_scene(tracker, gate, seconds=12.0):
+    # What inference_thread does with --track --motion-gate: the tracker is
+    # updated on inferred frames and only predicted on gated ones.
+    lanes = LaneMap.quadrants(FRAME_SIZE[0] // 2, FRAME_SIZE[1] // 2, FRAME_SIZE)
+    flow = LaneFlow(lanes.lane_of, lanes=lanes.signals)
+    frame = np.full((FRAME_SIZE[1], FRAME_SIZE[0], 3), 90, dtype=np.uint8)
+    detections = [{"box": box, "conf": 0.9, "class_id": 2} for box in CARS]
+    published = []
+    for i in range(int(seconds * FPS)):
+        now = 100.0 + i / FPS
+        if gate.should_infer(frame, now):
+            gate.record(0.03, now)
+            tracks = tracker.update(detections, now)
+        else:
+            tracks = tracker.predict(now)
+        flow.update(tracks, now)
+        published.append((now, len(tracks)))
+    return published, flow
+
+
+def test_gated_tracks_outlive_staleness():
+    gate = MotionGate()
+    assert gated_max_age(gate.max_staleness) > gate.max_staleness
+
+
+def test_static_queue_is_counted_with_motion_gate():
+    gate = MotionGate()
+    published, flow = run_static_scene(Tracker(max_age=gated_max_age(gate.max_staleness)), gate)
+    # Confirmed after MIN_HITS inferences (one per staleness period), then
+    # counted on every frame, gated or not.
+    settled = [count for now, count in published if now >= 100.0 + 3 * gate.max_staleness + 0.5]
+    assert settled and all(count == len(CARS) for count in settled)
+    # Each car entered its lane once; re-spawned tracks would count again.
+    assert sum(len(entries) for entries in flow.entries) == len(CARS)
+
+
+def test_default_max_age_loses_gated_queue():
+    # The failure the gated max age avoids.
+    gate = MotionGate()
+    assert MAX_AGE < gate.max_staleness
+    published, _ = run_static_scene(Tracker(max_age=MAX_AGE), gate)
+    assert all(count == 0 for _, count in published)
@@ -0,0 +1,198 @@
+from collections import deque
+
+import numpy as np
+
+MATCH_IOU = 0.3
+MIN_HITS = 3
+MAX_AGE = 1.0
+POSITION_NOISE = 0.05
+VELOCITY_NOISE = 0.5
+FLOW_WINDOW = 60.0
+QUEUE_SPEED = 15.0
+
+
+def gated_max_age(max_staleness, max_age=MAX_AGE):
+    # With the motion gate a still scene is only inferred again every
+    # max_staleness seconds, so tracks must outlive that gap; otherwise a
+    # queue of stopped cars never reaches min_hits.
+    return max(max_age, 2 * max_staleness)
+
+
+def iou_matrix(a, b):
+    x1 = np.maximum(a[:, None, 0], b[None, :, 0])
+    y1 = np.maximum(a[:, None, 1], b[None, :, 1])
+    x2 = np.minimum(a[:, None, 2], b[None, :, 2])
+    y2 = np.minimum(a[:, None, 3], b[None, :, 3])
+    inter = np.clip(x2 - x1, 0, None) * np.clip(y2 - y1, 0, None)
+    area_a = (a[:, 2] - a[:, 0]) * (a[:, 3] - a[:, 1])
+    area_b = (b[:, 2] - b[:, 0]) * (b[:, 3] - b[:, 1])
+    return inter / np.maximum(area_a[:, None] + area_b[None, :] - inter, 1e-6)
+
+
+def to_xyxy(state):
+    cx, cy, w, h = state[:, 0], state[:, 1], state[:, 2], state[:, 3]
+    return np.stack([cx - w / 2, cy - h / 2, cx + w / 2, cy + h / 2], axis=1)
+
+
+def to_cxcywh(boxes):
+    w = boxes[:, 2] - boxes[:, 0]
+    h = boxes[:, 3] - boxes[:, 1]
+    return np.stack([boxes[:, 0] + w / 2, boxes[:, 1] + h / 2, w, h], axis=1)
+
+
+class Tracker:
+    # SORT-style tracker. Every track is a constant-velocity Kalman filter
+    # over (cx, cy, w, h) with velocities in pixels per second, and all
+    # tracks are predicted and updated together as stacked arrays, so the
+    # gap between two inferences can be any length.
+    def __init__(self, match_iou=MATCH_IOU, min_hits=MIN_HITS, max_age=MAX_AGE):
+        self.match_iou = match_iou
+        self.min_hits = min_hits
+        self.max_age = max_age
+
+        self.x = np.zeros((0, 8))
+        self.P = np.zeros((0, 8, 8))
+        self.ids = np.zeros(0, dtype=np.int64)
+        self.hits = np.zeros(0, dtype=np.int64)
+        self.last_seen = np.zeros(0)
+        self.conf = np.zeros(0)
+        self.class_ids = np.zeros(0, dtype=np.int64)
+        self.next_id = 1
+        self.time = None
+
+    def predict(self, now):
+        if self.time is not None and len(self.x):
+            dt = max(now - self.time, 0.0)
+            F = np.eye(8)
+            F[range(4), range(4, 8)] = dt
+            h = np.maximum(self.x[:, 3], 1.0)
+            q = np.empty((len(h), 8))
+            q[:, :4] = (POSITION_NOISE * h[:, None]) ** 2
+            q[:, 4:] = (VELOCITY_NOISE * h[:, None]) ** 2
+            self.x = self.x @ F.T
+            self.P = F @ self.P @ F.T
+            self.P[:, range(8), range(8)] += q * dt
+        self.time = now
+        # Also when frames are skipped and only predict() runs, tracks not
+        # seen for max_age are gone, not counted as phantom vehicles.
+        alive = now - self.last_seen <= self.max_age
+        if not alive.all():
+            self.x, self.P = self.x[alive], self.P[alive]
+            self.ids, self.hits = self.ids[alive], self.hits[alive]
+            self.last_seen, self.conf = self.last_seen[alive], self.conf[alive]
+            self.class_ids = self.class_ids[alive]
+        return self.active()
+
+    def update(self, results, now):
+        self.predict(now)
+        detections = np.array([res["box"] for res in results], dtype=np.float64).reshape(-1, 4)
+        confidences = np.array([res["conf"] for res in results], dtype=np.float64)
+        class_ids = np.array([res.get("class_id", 0) for res in results], dtype=np.int64)
+
+        matched_tracks, matched_dets = self.associate(detections)
+        if len(matched_tracks):
+            self.correct(matched_tracks, to_cxcywh(detections[matched_dets]))
+            self.hits[matched_tracks] += 1
+            self.last_seen[matched_tracks] = now
+            self.conf[matched_tracks] = confidences[matched_dets]
+            self.class_ids[matched_tracks] = class_ids[matched_dets]
+
+        unmatched = np.setdiff1d(np.arange(len(detections)), matched_dets)
+        if len(unmatched):
+            self.spawn(to_cxcywh(detections[unmatched]), confidences[unmatched], class_ids[unmatched], now)
+        return self.active()
+
+    def associate(self, detections):
+        if not len(self.x) or not len(detections):
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        iou = iou_matrix(to_xyxy(self.x), detections)
+        rows, cols = np.nonzero(iou >= self.match_iou)
+        order = np.argsort(-iou[rows, cols])
+        used_tracks, used_dets = set(), set()
+        matched_tracks, matched_dets = [], []
+        for row, col in zip(rows[order], cols[order]):
+            if row in used_tracks or col in used_dets:
+                continue
+            used_tracks.add(row)
+            used_dets.add(col)
+            matched_tracks.append(row)
+            matched_dets.append(col)
+        return np.array(matched_tracks, dtype=np.int64), np.array(matched_dets, dtype=np.int64)
+
+    def correct(self, index, z):
+        P = self.P[index]
+        h = np.maximum(self.x[index, 3], 1.0)
+        S = P[:, :4, :4].copy()
+        S[:, range(4), range(4)] += (POSITION_NOISE * h[:, None]) ** 2
+        K = P[:, :, :4] @ np.linalg.inv(S)
+        innovation = z - self.x[index, :4]
+        self.x[index] += (K @ innovation[:, :, None])[:, :, 0]
+        self.P[index] = P - K @ P[:, :4, :]
+
+    def spawn(self, z, confidences, class_ids, now):
+        n = len(z)
+        x = np.zeros((n, 8))
+        x[:, :4] = z
+        h = np.maximum(z[:, 3], 1.0)
+        P = np.zeros((n, 8, 8))
+        P[:, range(4), range(4)] = (2 * POSITION_NOISE * h[:, None]) ** 2
+        P[:, range(4, 8), range(4, 8)] = (10 * VELOCITY_NOISE * h[:, None]) ** 2
+
+        self.x = np.concatenate([self.x, x])
+        self.P = np.concatenate([self.P, P])
+        self.ids = np.concatenate([self.ids, np.arange(self.next_id, self.next_id + n)])
+        self.hits = np.concatenate([self.hits, np.ones(n, dtype=np.int64)])
+        self.last_seen = np.concatenate([self.last_seen, np.full(n, now)])
+        self.conf = np.concatenate([self.conf, confidences])
+        self.class_ids = np.concatenate([self.class_ids, class_ids])
+        self.next_id += n
+
+    def active(self):
+        confirmed = np.nonzero(self.hits >= self.min_hits)[0]
+        boxes = to_xyxy(self.x[confirmed]).astype(int)
+        speeds = np.hypot(self.x[confirmed, 4], self.x[confirmed, 5])
+        return [
+            {
+                "id": int(self.ids[i]),
+                "box": boxes[n].tolist(),
+                "conf": float(self.conf[i]),
+                "class_id": int(self.class_ids[i]),
+                "speed": float(speeds[n]),
+            }
+            for n, i in enumerate(confirmed)
+        ]
+
+
+class LaneFlow:
+    # Turns tracks into per-lane flow (vehicles entering the lane per minute)
+    # and queue length (tracked vehicles slower than QUEUE_SPEED px/s).
+    def __init__(self, lane_of, lanes=4, window=FLOW_WINDOW, queue_speed=QUEUE_SPEED):
+        self.lane_of = lane_of
+        self.lanes = lanes
+        self.window = window
+        self.queue_speed = queue_speed
+        self.track_lanes = {}
+        self.entries = [deque() for _ in range(lanes)]
+
+    def update(self, tracks, now):
+        queues = [0] * self.lanes
+        seen = {}
+        for track in tracks:
+            lane = self.lane_of(track["box"])
+            if lane is None:
+                continue
+            seen[track["id"]] = lane
+            if track["speed"] < self.queue_speed:
+                queues[lane] += 1
+            if self.track_lanes.get(track["id"]) != lane:
+                self.entries[lane].append(now)
+        # Tracks that coast out of view are forgotten; ids are never reused.
+        self.track_lanes = seen
+
+        flow = {}
+        for lane, entries in enumerate(self.entries):
+            while entries and now - entries[0] > self.window:
+                entries.popleft()
+            flow[f"lane{lane + 1}_vpm"] = round(len(entries) * 60.0 / self.window, 1)
+            flow[f"lane{lane + 1}_queue"] = queues[lane]
+        return flow